@@ -0,0 +1,66 @@
+#! /usr/local/bin/stackless2.6
+
+"""Compare coio.process_pool with coio.thread_pool for CPU-heavy calls.
+
+Usage: speed_process_pool.py [<worker_count> [<call_count>]]
+
+For each pool, prints the wall time of running call_count CPU-heavy calls
+with worker_count workers, and the maximum lag of a ticker tasklet running
+meanwhile (i.e. how long the main loop couldn't serve other tasklets).
+"""
+
+import sys
+import time
+
+from syncless.best_stackless import stackless
+from syncless import coio
+
+
+def CpuHeavy(n):
+  total = 0
+  for i in xrange(n):
+    total += i * i
+  return total
+
+
+def Ticker(lags):
+  while True:
+    start = time.time()
+    coio.sleep(0.001)
+    lags.append(time.time() - start - 0.001)
+
+
+def Benchmark(pool, worker_count, call_count, work_size):
+  results = []
+  def Worker(count):
+    for i in xrange(count):
+      results.append(pool(CpuHeavy, work_size))
+  lags = []
+  ticker = stackless.tasklet(Ticker)(lags)
+  start = time.time()
+  tasklets = [stackless.tasklet(Worker)(call_count // worker_count)
+              for i in xrange(worker_count)]
+  while [t for t in tasklets if t.alive]:
+    coio.sleep(0.01)
+  duration = time.time() - start
+  ticker.kill()
+  assert results == [CpuHeavy(work_size)] * len(results)
+  return duration, max(lags or [0])
+
+
+def main(argv):
+  worker_count = int((argv[1:] or [4])[0])
+  call_count = int((argv[2:] or [worker_count * 8])[0])
+  work_size = 200000
+  print 'workers=%d calls=%d work_size=%d' % (
+      worker_count, call_count, work_size)
+  for name, pool in (('thread_pool', coio.thread_pool(worker_count)),
+                     ('process_pool', coio.process_pool(worker_count))):
+    duration, max_lag = Benchmark(pool, worker_count, call_count, work_size)
+    print '%-12s  %.3fs  max_loop_lag=%.3fs' % (name, duration, max_lag)
+    if isinstance(pool, coio.process_pool):
+      pool.close()
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv) or 0)
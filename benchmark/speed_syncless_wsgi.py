@@ -24,6 +24,10 @@ def WsgiApplication(env, start_response):
 if __name__ == '__main__':
   logging.root.level = logging.DEBUG
   patch.patch_stderr()  # Give Ctrl-<C> a chance at infinite logging.
+  if len(sys.argv) > 1:  # Number of prefork worker processes.
+    wsgi.PreforkWsgiListener(('127.0.0.1', 8080), WsgiApplication,
+                             process_count=int(sys.argv[1]))
+    sys.exit(0)
   ss = coio.new_realsocket(socket.AF_INET, socket.SOCK_STREAM)
   ss.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
   ss.bind(('127.0.0.1', 8080))
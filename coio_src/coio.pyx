@@ -18,7 +18,7 @@ elif coio_event_init() != 0:
 
 _setup_sigint()
 _setup_sigusr1()
-_setup_sigusr2()
+_setup_wakeup()
 
 # Don't publish it, as a safety for read-only.
 cdef tasklet main_loop_tasklet
@@ -20,6 +20,18 @@ static inline void coio_c_set_evlist_internal(struct event *ev) {
 }
 #endif
 
+/* --- Edge-triggered watchers */
+
+/** The ev_arg of an event with EV_ET, as set by coio_c_edge_watch_start. */
+struct coio_edge_watch {
+  /** The tasklet parked in coio_c_wait_eagain (borrowed), or NULL. */
+  PyObject *waiting;
+  /** The callback of the event before coio_c_edge_watch_start. */
+  void (*callback)(int, short, void*);
+  /** Has the fd become ready while no tasklet was parked? */
+  char is_ready;
+};
+
 /* --- Event pool */
 
 /** Not 16384 to give some space for malloc's linked list headers. */
@@ -108,6 +120,13 @@ static inline PyObject *coio_c_wait(struct event *ev,
       return NULL;
     }
     /*write(2, "M", 1);*/
+#if FEATURE_EDGE_TRIGGERED
+    if (ev->ev_events & EV_ET) {  /* Use a one-shot level-triggered event. */
+      event_set(ev2, ev->ev_fd, ev->ev_events & (EV_READ | EV_WRITE),
+                ((struct coio_edge_watch*)ev->ev_arg)->callback,
+                PyStackless_GetCurrent());
+    } else
+#endif
     event_set(ev2, ev->ev_fd, ev->ev_events, ev->ev_callback,
               PyStackless_GetCurrent());
     ev = ev2;
@@ -130,6 +149,122 @@ static inline PyObject *coio_c_wait(struct event *ev,
   return tempval;
 }
 
+/**
+ * Like coio_c_wait, but to be called after an I/O operation on ev->ev_fd
+ * has failed with EAGAIN. If ev is an edge-triggered watcher (see
+ * coio_c_edge_watch_start) and there is no timeout, then just park the
+ * current tasklet until the watcher reports readiness, without
+ * registering or removing any events. Since the watcher might have
+ * reported a readiness which has been consumed since then, a spurious
+ * return (followed by another EAGAIN) is possible.
+ */
+static inline PyObject *coio_c_wait_eagain(struct event *ev,
+                                           const struct timeval *timeout) {
+#if FEATURE_EDGE_TRIGGERED
+  struct coio_edge_watch *watch;
+  PyObject *current;
+  PyObject *tempval;
+  if ((ev->ev_events & EV_ET) && timeout == NULL) {
+    watch = (struct coio_edge_watch*)ev->ev_arg;
+    if (watch->is_ready) {
+      watch->is_ready = 0;
+      Py_INCREF(coio_event_happened_token);
+      return coio_event_happened_token;
+    }
+    if (watch->waiting == NULL) {
+      current = PyStackless_GetCurrent();
+      watch->waiting = current;
+      tempval = PyStackless_Schedule(coio_waiting_token, /*do_remove:*/1);
+      /* The watcher may have been stopped (and watch freed) meanwhile. */
+      if ((ev->ev_events & EV_ET) &&
+          ((struct coio_edge_watch*)ev->ev_arg)->waiting == current)
+        ((struct coio_edge_watch*)ev->ev_arg)->waiting = NULL;
+      Py_DECREF(current);
+      return tempval;
+    }
+  }
+#endif
+  return coio_c_wait(ev, timeout);
+}
+
+/**
+ * Make ev (an event with EV_READ or EV_WRITE, set up with event_set, not
+ * pending) a persistent, edge-triggered watcher with callback wakeup, which
+ * gets a struct coio_edge_watch* as its arg. Return 1 on success, 0 if
+ * edge-triggered events are not supported (FEATURE_EDGE_TRIGGERED), and
+ * -1 with a Python exception set on error.
+ */
+static int coio_c_edge_watch_start(struct event *ev,
+                                   void (*wakeup)(int, short, void*)) {
+#if FEATURE_EDGE_TRIGGERED
+  struct coio_edge_watch *watch;
+  int fd = ev->ev_fd;
+  short events = ev->ev_events;
+  void (*callback)(int, short, void*) = ev->ev_callback;
+  if (events & EV_ET)
+    return 1;
+  if (ev->ev_arg != NULL) {
+    PyErr_SetString(PyExc_ValueError, "fd is being waited for");
+    return -1;
+  }
+  if (NULL == (watch = PyMem_Malloc(sizeof*watch))) {
+    PyErr_NoMemory();
+    return -1;
+  }
+  watch->waiting = NULL;
+  watch->callback = callback;
+  watch->is_ready = 0;
+  event_set(ev, fd, (events & (EV_READ | EV_WRITE)) | EV_PERSIST | EV_ET,
+            wakeup, watch);
+  if (0 != event_add(ev, NULL)) {
+    PyErr_SetFromErrno(PyExc_IOError);
+    event_set(ev, fd, events, callback, NULL);
+    PyMem_Free(watch);
+    return -1;
+  }
+  return 1;
+#else
+  (void)ev;
+  (void)wakeup;
+  return 0;
+#endif
+}
+
+/**
+ * Undo coio_c_edge_watch_start(ev, ...), no-op if ev is not a watcher. The
+ * parked tasklet (if any) gets woken up by ev's callback.
+ */
+static void coio_c_edge_watch_stop(struct event *ev) {
+#if FEATURE_EDGE_TRIGGERED
+  struct coio_edge_watch *watch;
+  void (*wakeup)(int, short, void*) = ev->ev_callback;
+  int fd = ev->ev_fd;
+  short events = ev->ev_events;
+  if (!(events & EV_ET))
+    return;
+  watch = (struct coio_edge_watch*)ev->ev_arg;
+  event_del(ev);
+  event_set(ev, fd, events & (EV_READ | EV_WRITE), watch->callback, NULL);
+  if (watch->waiting != NULL)
+    wakeup(fd, events & (EV_READ | EV_WRITE), watch);
+  PyMem_Free(watch);
+#else
+  (void)ev;
+#endif
+}
+
+/** Change the callback of ev, which may be a watcher. */
+static inline void coio_c_edge_watch_set_callback(
+    struct event *ev, void (*callback)(int, short, void*)) {
+#if FEATURE_EDGE_TRIGGERED
+  if (ev->ev_events & EV_ET) {
+    ((struct coio_edge_watch*)ev->ev_arg)->callback = callback;
+    return;
+  }
+#endif
+  ev->ev_callback = callback;
+}
+
 /**
  * Wait in the current tasklet for (fd, evtype) or timeout to happen, call
  * callback with arg == stackless.current, return what callback has put to
@@ -225,7 +360,7 @@ static inline PyObject *coio_c_handle_eagain(
       evtype == EV_READ ?  &swi->read_ev :
       evtype == EV_WRITE ? &swi->write_ev : 0;
   if (swi->timeout_value < 0.0)
-    return coio_c_wait(wakeup_ev, NULL);
+    return coio_c_wait_eagain(wakeup_ev, NULL);
   retval = coio_c_wait(wakeup_ev, &swi->tv);
   if (retval != coio_event_happened_token && retval != NULL) {
     Py_DECREF(retval);
@@ -352,7 +487,7 @@ static int coio_c_handle_ssl_eagain(
       return -1;
     }
     if (timeout_value < 0.0) {
-      if (NULL == (retval = coio_c_wait(read_ev, NULL)))
+      if (NULL == (retval = coio_c_wait_eagain(read_ev, NULL)))
         return -1;
       Py_DECREF(retval);
       return 1;
@@ -375,7 +510,7 @@ static int coio_c_handle_ssl_eagain(
       return -1;
     }
     if (timeout_value < 0.0) {
-      if (NULL == (retval = coio_c_wait(write_ev, NULL)))
+      if (NULL == (retval = coio_c_wait_eagain(write_ev, NULL)))
         return -1;
       Py_DECREF(retval);
       return 1;
@@ -507,7 +642,7 @@ static inline int coio_c_evbuffer_read(
         owi->fd, (char*)read_eb->buffer + read_eb->off, n))) {
       if (errno == EAGAIN) {
         if (owi->timeout_value < 0) {
-          if (NULL == coio_c_wait(&owi->ev, NULL))
+          if (NULL == coio_c_wait_eagain(&owi->ev, NULL))
             return -1;
         } else {
           if (owi->timeout_value == 0.0) {
@@ -603,7 +738,7 @@ static inline int coio_c_writeall(
         }
         /* Assuming caller has called event_set(...). */
         if (owi->timeout_value < 0) {
-          if (NULL == coio_c_wait(&owi->ev, NULL))
+          if (NULL == coio_c_wait_eagain(&owi->ev, NULL))
             return -1;
         } else {
           if (owi->timeout_value == 0.0) {
@@ -629,6 +764,790 @@ static inline int coio_c_writeall(
   return 0;
 }
 
+#ifdef __linux__
+#include <sys/sendfile.h>
+#endif
+
+/** Size of the buffer used by coio_c_sendfile when sendfile(2) can't be
+ * used.
+ */
+#define COIO_C_SENDFILE_BUFFER_SIZE 65536
+
+/* Send n bytes of file in_fd starting at offset to owi->fd.
+
+Uses sendfile(2) on Linux, waking up based on owi->ev on EAGAIN, just like
+coio_c_writeall(). Falls back to pread(2) and coio_c_writeall() (with a
+buffer of COIO_C_SENDFILE_BUFFER_SIZE bytes outside the Python heap) for
+SSL, on other systems and if sendfile(2) doesn't support in_fd.
+
+Returns:
+  Number of bytes sent (less than n on EOF in in_fd), or -1 on error.
+Raises:
+  owi->exc_class:
+*/
+static Py_ssize_t coio_c_sendfile(
+    struct coio_oneway_wakeup_info *owi,
+    int in_fd,
+    long long offset,
+    Py_ssize_t n) {
+  PyObject *obj;
+  Py_ssize_t got, sent = 0;
+  char *buf;
+  if (n <= 0)
+    return 0;
+#ifdef __linux__
+  if (owi->sslobj == NULL) {
+    off_t off = offset;
+    while (sent < n) {
+      got = sendfile(owi->fd, in_fd, &off, n - sent);
+      if (got > 0) {
+        sent += got;
+      } else if (got == 0) {
+        return sent;  /* EOF in in_fd. */
+      } else if (errno == EINTR) {
+        /* Try again. */
+      } else if (errno != EAGAIN) {
+        if (sent == 0 && (errno == EINVAL || errno == ENOSYS))
+          goto use_pread;  /* in_fd is not supported by sendfile(2). */
+        PyErr_SetFromErrno((PyObject*)owi->exc_class);
+        return -1;
+      } else if (owi->timeout_value < 0) {
+        if (NULL == coio_c_wait_eagain(&owi->ev, NULL))
+          return -1;
+      } else {
+        if (owi->timeout_value == 0.0) {
+          /* This is what methods of socket.socket raise, we just mimic. */
+          PyErr_SetFromErrno((PyObject*)owi->exc_class);  /* EAGAIN */
+          return -1;
+        }
+        obj = coio_c_wait(&owi->ev, &owi->tv);
+        if (obj != coio_event_happened_token && obj != NULL) {
+          Py_DECREF(obj);
+          PyErr_SetString(coio_socket_timeout, "timed out");
+          return -1;
+        }
+        if (obj == NULL)
+          return -1;
+        Py_DECREF(obj);
+      }
+    }
+    return sent;
+  }
+ use_pread:
+#endif
+  if (NULL == (buf = malloc(COIO_C_SENDFILE_BUFFER_SIZE))) {
+    PyErr_SetString(PyExc_MemoryError, "not enough memory for sendfile");
+    return -1;
+  }
+  while (sent < n) {
+    got = n - sent;
+    if (got > COIO_C_SENDFILE_BUFFER_SIZE)
+      got = COIO_C_SENDFILE_BUFFER_SIZE;
+    got = pread(in_fd, buf, got, offset + sent);
+    if (got < 0) {
+      if (errno == EINTR)
+        continue;
+      free(buf);
+      PyErr_SetFromErrno((PyObject*)owi->exc_class);
+      return -1;
+    }
+    if (got == 0)  /* EOF in in_fd. */
+      break;
+    if (0 != coio_c_writeall(owi, buf, got)) {
+      free(buf);
+      return -1;
+    }
+    sent += got;
+  }
+  free(buf);
+  return sent;
+}
+
+/* --- CPU affinity */
+
+#ifdef __linux__
+#include <sched.h>
+#endif
+
+/** Pin the calling process to the CPUs numbered in the iterable cpus.
+ *
+ * Returns 0 on success, or -1 with a Python exception set (OSError with
+ * ENOSYS on non-Linux systems).
+ */
+static int coio_c_set_cpu_affinity(PyObject *cpus) {
+#ifdef __linux__
+  cpu_set_t cpu_set;
+  PyObject *iter, *item;
+  long cpu;
+  CPU_ZERO(&cpu_set);
+  if (NULL == (iter = PyObject_GetIter(cpus)))
+    return -1;
+  while (NULL != (item = PyIter_Next(iter))) {
+    cpu = PyInt_AsLong(item);
+    Py_DECREF(item);
+    if (cpu == -1 && PyErr_Occurred()) {
+      Py_DECREF(iter);
+      return -1;
+    }
+    if (cpu < 0 || cpu >= CPU_SETSIZE) {
+      Py_DECREF(iter);
+      PyErr_SetString(PyExc_ValueError, "CPU number out of range");
+      return -1;
+    }
+    CPU_SET(cpu, &cpu_set);
+  }
+  Py_DECREF(iter);
+  if (PyErr_Occurred())
+    return -1;
+  if (0 != sched_setaffinity(0, sizeof(cpu_set), &cpu_set)) {
+    PyErr_SetFromErrno(PyExc_OSError);
+    return -1;
+  }
+  return 0;
+#else
+  (void)cpus;
+  errno = ENOSYS;
+  PyErr_SetFromErrno(PyExc_OSError);
+  return -1;
+#endif
+}
+
+/* --- Cross-thread wakeup of the main loop */
+
+#ifdef __linux__
+#include <sys/eventfd.h>
+#endif
+#include <poll.h>
+
+/* Both are the same eventfd, or the two ends of a pipe. */
+static int coio_wakeup_read_fd = -1;
+static int coio_wakeup_write_fd = -1;
+/* Nonzero iff a wakeup has been written, but not read yet. */
+static volatile int coio_wakeup_is_pending = 0;
+
+/** (Re)create the wakeup fds. Returns 0 on success, or -1 with a Python
+ * exception set.
+ */
+static int coio_c_wakeup_open(void) {
+  int fds[2];
+  if (coio_wakeup_read_fd >= 0) {
+    if (coio_wakeup_write_fd != coio_wakeup_read_fd)
+      close(coio_wakeup_write_fd);
+    close(coio_wakeup_read_fd);
+    coio_wakeup_read_fd = coio_wakeup_write_fd = -1;
+  }
+  coio_wakeup_is_pending = 0;
+#if defined(__linux__) && defined(EFD_NONBLOCK) && defined(EFD_CLOEXEC)
+  if ((fds[0] = eventfd(0, EFD_NONBLOCK | EFD_CLOEXEC)) >= 0) {
+    coio_wakeup_read_fd = coio_wakeup_write_fd = fds[0];
+    return 0;
+  }
+#endif
+  if (0 != pipe(fds) ||
+      fcntl(fds[0], F_SETFL, fcntl(fds[0], F_GETFL) | O_NONBLOCK) < 0 ||
+      fcntl(fds[1], F_SETFL, fcntl(fds[1], F_GETFL) | O_NONBLOCK) < 0 ||
+      fcntl(fds[0], F_SETFD, FD_CLOEXEC) < 0 ||
+      fcntl(fds[1], F_SETFD, FD_CLOEXEC) < 0) {
+    PyErr_SetFromErrno(PyExc_OSError);
+    return -1;
+  }
+  coio_wakeup_read_fd = fds[0];
+  coio_wakeup_write_fd = fds[1];
+  return 0;
+}
+
+/** Make the wakeup fd readable, unless it already is. Can be called from
+ * any thread, even without the GIL.
+ */
+static void coio_c_wakeup_send(void) {
+  static const unsigned long long one = 1;  /* eventfd needs 8 bytes */
+  if (0 == __sync_lock_test_and_set(&coio_wakeup_is_pending, 1)) {
+    (void)!write(coio_wakeup_write_fd, &one,
+                 coio_wakeup_write_fd == coio_wakeup_read_fd ? 8 : 1);
+  }
+}
+
+/** Event handler for the wakeup fd. It doesn't need the GIL. */
+static void coio_c_handle_wakeup(int fd, short evtype, void *arg) {
+  char buf[64];
+  (void)evtype;
+  (void)arg;
+  while (read(fd, buf, sizeof buf) > 0) {}
+  /* Clear the flag after draining, so a coio_c_wakeup_send() meanwhile
+   * (while the main loop is running anyway) doesn't leave the flag set
+   * with an empty fd.
+   */
+  __sync_lock_release(&coio_wakeup_is_pending);
+}
+
+/** Block until the wakeup fd becomes readable (or a signal arrives), and
+ * drain it. Must be called without the GIL.
+ */
+static void coio_c_wakeup_wait(void) {
+  struct pollfd pfd;
+  pfd.fd = coio_wakeup_read_fd;
+  pfd.events = POLLIN;
+  if (poll(&pfd, 1, -1) > 0)
+    coio_c_handle_wakeup(coio_wakeup_read_fd, 0, NULL);
+}
+
+/** Return nonzero iff reading from fd wouldn't block right now (also on
+ * EOF and on error). Doesn't need the GIL.
+ */
+static int coio_c_is_readable(int fd) {
+  struct pollfd pfd;
+  pfd.fd = fd;
+  pfd.events = POLLIN;
+  return poll(&pfd, 1, 0) > 0;
+}
+
+/* --- Main loop statistics */
+
+#include <time.h>
+#include <sys/time.h>
+
+/* Histogram bucket i (i > 0) counts values v with 2**(i-1) <= v < 2**i, and
+ * bucket 0 counts v == 0. The last bucket also counts all larger values.
+ */
+#define COIO_LOOP_STATS_BUCKET_COUNT 28
+
+struct coio_loop_stats {
+  /* Number of event_loop() calls from _main_loop. */
+  unsigned long long blocking_count;
+  unsigned long long nonblocking_count;
+  /* Microseconds spent in event_loop(), including the callbacks. */
+  unsigned long long loop_usec_total;
+  unsigned long long loop_usec_max;
+  /* Microseconds between event_loop() returning and it being called again,
+   * i.e. the time the other tasklets were running.
+   */
+  unsigned long long run_usec_total;
+  unsigned long long run_usec_max;
+  /* Number of tasklets made runnable by an event_loop() call. */
+  unsigned long long inserted_total;
+  unsigned long long inserted_max;
+  unsigned long long loop_usec_histogram[COIO_LOOP_STATS_BUCKET_COUNT];
+  unsigned long long run_usec_histogram[COIO_LOOP_STATS_BUCKET_COUNT];
+  unsigned long long inserted_histogram[COIO_LOOP_STATS_BUCKET_COUNT];
+  /* Number of busy polls (see coio_c_busy_poll), and how many of them have
+   * found a tasklet to wake up.
+   */
+  unsigned long long busy_poll_count;
+  unsigned long long busy_poll_hit_count;
+  /* Number of event_loop() calls and microseconds spent in busy polls. */
+  unsigned long long busy_poll_loop_count;
+  unsigned long long busy_poll_usec_total;
+  /* Number of completions from threads (see coio_c_completion_push), and
+   * the number of batches _main_loop has taken them in.
+   */
+  unsigned long long completion_count;
+  unsigned long long completion_batch_count;
+};
+
+static struct coio_loop_stats coio_loop_stats;
+/* Monotonic timestamp (in microseconds) of the last event_loop() return, or
+ * 0 if there is none yet.
+ */
+static volatile unsigned long long coio_loop_stats_returned_at = 0;
+static volatile unsigned long long coio_loop_stats_called_at = 0;
+/* Microseconds the other tasklets ran before the last event_loop() call. */
+static unsigned long long coio_loop_stats_last_run_usec = 0;
+static int coio_loop_stats_run_count;
+
+static inline unsigned long long coio_c_monotonic_usec(void) {
+#ifdef CLOCK_MONOTONIC
+  struct timespec ts;
+  if (0 == clock_gettime(CLOCK_MONOTONIC, &ts))
+    return (unsigned long long)ts.tv_sec * 1000000 + ts.tv_nsec / 1000;
+#endif
+  {
+    struct timeval tv;
+    gettimeofday(&tv, NULL);
+    return (unsigned long long)tv.tv_sec * 1000000 + tv.tv_usec;
+  }
+}
+
+static inline void coio_c_loop_stats_add(unsigned long long *histogram,
+                                         unsigned long long *total,
+                                         unsigned long long *max,
+                                         unsigned long long value) {
+  int i = 0;
+  unsigned long long v = value;
+  while (v != 0 && i < COIO_LOOP_STATS_BUCKET_COUNT - 1) {
+    v >>= 1;
+    ++i;
+  }
+  ++histogram[i];
+  *total += value;
+  if (*max < value)
+    *max = value;
+}
+
+/** Called by _main_loop (with the GIL) just before event_loop(). */
+static inline void coio_c_loop_stats_before_loop(void) {
+  unsigned long long now = coio_c_monotonic_usec();
+  if (coio_loop_stats_returned_at != 0) {
+    coio_loop_stats_last_run_usec = now - coio_loop_stats_returned_at;
+    coio_c_loop_stats_add(coio_loop_stats.run_usec_histogram,
+                          &coio_loop_stats.run_usec_total,
+                          &coio_loop_stats.run_usec_max,
+                          coio_loop_stats_last_run_usec);
+  }
+  coio_loop_stats_called_at = now;
+  coio_loop_stats_run_count = PyStackless_GetRunCount();
+}
+
+/** Called by _main_loop (with the GIL) just after event_loop(). */
+static inline void coio_c_loop_stats_after_loop(int is_blocking) {
+  unsigned long long now = coio_c_monotonic_usec();
+  int inserted = PyStackless_GetRunCount() - coio_loop_stats_run_count;
+  if (is_blocking) {
+    ++coio_loop_stats.blocking_count;
+  } else {
+    ++coio_loop_stats.nonblocking_count;
+  }
+  coio_c_loop_stats_add(coio_loop_stats.loop_usec_histogram,
+                        &coio_loop_stats.loop_usec_total,
+                        &coio_loop_stats.loop_usec_max,
+                        now - coio_loop_stats_called_at);
+  coio_c_loop_stats_add(coio_loop_stats.inserted_histogram,
+                        &coio_loop_stats.inserted_total,
+                        &coio_loop_stats.inserted_max,
+                        inserted > 0 ? inserted : 0);
+  coio_loop_stats_returned_at = now;
+}
+
+/** Return the monotonic time in seconds. */
+static inline double coio_c_monotonic(void) {
+  return coio_c_monotonic_usec() / 1e6;
+}
+
+/** Return the number of seconds the other tasklets ran before the last
+ * event_loop() call of _main_loop.
+ */
+static inline double coio_c_loop_last_run_sec(void) {
+  return coio_loop_stats_last_run_usec / 1e6;
+}
+
+/** Return the number of seconds since _main_loop has last given control to
+ * the other tasklets, or 0.0 if it is in event_loop() now (or it hasn't run
+ * yet). Can be called from any thread, even without the GIL. The result
+ * might be inaccurate while the main loop is entering or leaving
+ * event_loop().
+ */
+static double coio_c_loop_stall_sec(void) {
+  unsigned long long returned_at = coio_loop_stats_returned_at;
+  unsigned long long now;
+  if (returned_at == 0 || coio_loop_stats_called_at > returned_at)
+    return 0.0;
+  now = coio_c_monotonic_usec();
+  return now > returned_at ? (now - returned_at) / 1e6 : 0.0;
+}
+
+static PyObject *coio_c_loop_stats_histogram(unsigned long long *histogram) {
+  int i;
+  PyObject *item;
+  PyObject *result = PyTuple_New(COIO_LOOP_STATS_BUCKET_COUNT);
+  if (result == NULL)
+    return NULL;
+  for (i = 0; i < COIO_LOOP_STATS_BUCKET_COUNT; ++i) {
+    if (NULL == (item = PyLong_FromUnsignedLongLong(histogram[i]))) {
+      Py_DECREF(result);
+      return NULL;
+    }
+    PyTuple_SET_ITEM(result, i, item);
+  }
+  return result;
+}
+
+/** Return a new dict with a snapshot of coio_loop_stats, and reset the
+ * statistics afterwards if do_reset is true.
+ */
+static PyObject *coio_c_loop_stats_get(int do_reset) {
+  const struct coio_loop_stats *st = &coio_loop_stats;
+  PyObject *result = Py_BuildValue(
+      "{sKsKsKsKsKsKsKsKsKsKsKsKsKsKsNsNsN}",
+      "blocking_count", st->blocking_count,
+      "nonblocking_count", st->nonblocking_count,
+      "loop_usec_total", st->loop_usec_total,
+      "loop_usec_max", st->loop_usec_max,
+      "run_usec_total", st->run_usec_total,
+      "run_usec_max", st->run_usec_max,
+      "inserted_total", st->inserted_total,
+      "inserted_max", st->inserted_max,
+      "busy_poll_count", st->busy_poll_count,
+      "busy_poll_hit_count", st->busy_poll_hit_count,
+      "busy_poll_loop_count", st->busy_poll_loop_count,
+      "busy_poll_usec_total", st->busy_poll_usec_total,
+      "completion_count", st->completion_count,
+      "completion_batch_count", st->completion_batch_count,
+      "loop_usec_histogram",
+      coio_c_loop_stats_histogram(coio_loop_stats.loop_usec_histogram),
+      "run_usec_histogram",
+      coio_c_loop_stats_histogram(coio_loop_stats.run_usec_histogram),
+      "inserted_histogram",
+      coio_c_loop_stats_histogram(coio_loop_stats.inserted_histogram));
+  if (result != NULL && do_reset)
+    memset(&coio_loop_stats, 0, sizeof coio_loop_stats);
+  return result;
+}
+
+/* --- Duration statistics (e.g. of thread_pool) */
+
+struct coio_duration_stats {
+  unsigned long long count;
+  unsigned long long usec_total;
+  unsigned long long usec_max;
+  unsigned long long usec_histogram[COIO_LOOP_STATS_BUCKET_COUNT];
+};
+
+static inline void coio_c_duration_stats_add(struct coio_duration_stats *st,
+                                             unsigned long long usec) {
+  ++st->count;
+  coio_c_loop_stats_add(st->usec_histogram, &st->usec_total, &st->usec_max,
+                        usec);
+}
+
+/** Return a new tuple (count, usec_total, usec_max, usec_histogram) with a
+ * snapshot of st, and reset st afterwards if do_reset is true.
+ */
+static PyObject *coio_c_duration_stats_get(struct coio_duration_stats *st,
+                                           int do_reset) {
+  PyObject *result = Py_BuildValue(
+      "(KKKN)", st->count, st->usec_total, st->usec_max,
+      coio_c_loop_stats_histogram(st->usec_histogram));
+  if (result != NULL && do_reset)
+    memset(st, 0, sizeof *st);
+  return result;
+}
+
+/* --- Completions from threads */
+
+#include <pthread.h>
+
+/* A (channel, value) pair to be sent by _main_loop. */
+struct coio_completion {
+  struct coio_completion *next;
+  PyObject *channel;
+  PyObject *value;
+};
+
+static pthread_mutex_t coio_completion_lock = PTHREAD_MUTEX_INITIALIZER;
+static struct coio_completion *volatile coio_completion_head = NULL;
+static struct coio_completion **coio_completion_tailp = &coio_completion_head;
+
+/** Return nonzero iff the completion queue is empty. Can be called from any
+ * thread, even without the GIL.
+ */
+static inline int coio_c_completion_is_empty(void) {
+  return coio_completion_head == NULL;
+}
+
+/** Append (channel, value) to the completion queue. Must be called with
+ * the GIL, from any thread. Returns 1 if the queue was empty (so the caller
+ * should wake up the main loop), 0 if not, or -1 with a Python exception
+ * set.
+ */
+static int coio_c_completion_push(PyObject *channel, PyObject *value) {
+  int was_empty;
+  struct coio_completion *c = malloc(sizeof *c);
+  if (c == NULL) {
+    PyErr_NoMemory();
+    return -1;
+  }
+  c->next = NULL;
+  Py_INCREF(c->channel = channel);
+  Py_INCREF(c->value = value);
+  pthread_mutex_lock(&coio_completion_lock);
+  was_empty = coio_completion_head == NULL;
+  *coio_completion_tailp = c;
+  coio_completion_tailp = &c->next;
+  pthread_mutex_unlock(&coio_completion_lock);
+  return was_empty;
+}
+
+/** Take all completions from the queue, and return them as a new list of
+ * (channel, value) tuples, in the order they were pushed. Must be called
+ * with the GIL. Returns NULL with a Python exception set on error.
+ */
+static PyObject *coio_c_completion_pop_all(void) {
+  struct coio_completion *c, *next;
+  PyObject *result, *item;
+  Py_ssize_t size = 0;
+  int is_error = 0;
+  pthread_mutex_lock(&coio_completion_lock);
+  c = coio_completion_head;
+  coio_completion_head = NULL;
+  coio_completion_tailp = &coio_completion_head;
+  pthread_mutex_unlock(&coio_completion_lock);
+  for (next = c; next != NULL; next = next->next)
+    ++size;
+  if (NULL == (result = PyList_New(size)))
+    is_error = 1;
+  for (size = 0; c != NULL; c = next, ++size) {
+    next = c->next;
+    if (!is_error && NULL != (item = PyTuple_New(2))) {
+      PyTuple_SET_ITEM(item, 0, c->channel);  /* Steals the reference. */
+      PyTuple_SET_ITEM(item, 1, c->value);
+      PyList_SET_ITEM(result, size, item);
+    } else {  /* Out of memory, drop the completion. */
+      is_error = 1;
+      Py_DECREF(c->channel);
+      Py_DECREF(c->value);
+    }
+    free(c);
+  }
+  if (is_error) {
+    Py_XDECREF(result);  /* PyList_Type can handle the NULL items. */
+    return NULL;
+  }
+  if (size > 0) {
+    coio_loop_stats.completion_count += size;
+    ++coio_loop_stats.completion_batch_count;
+  }
+  return result;
+}
+
+/* --- Busy polling */
+
+#if defined(__linux__) && !defined(SO_BUSY_POLL)
+#define SO_BUSY_POLL 46
+#endif
+#ifdef SO_BUSY_POLL
+#define COIO_SO_BUSY_POLL SO_BUSY_POLL
+#else
+#define COIO_SO_BUSY_POLL -1
+#endif
+
+/* Set by an event handler which has woken up a tasklet without making it
+ * runnable (see insert_woken in nbevent.pxi).
+ */
+static int coio_busy_poll_is_woken = 0;
+
+static inline void coio_c_busy_poll_set_woken(void) {
+  coio_busy_poll_is_woken = 1;
+}
+
+/** Call event_loop(EVLOOP_ONCE | EVLOOP_NONBLOCK) repeatedly for at most
+ * usec microseconds, until an event handler wakes up a tasklet (so m, the
+ * main_loop_tasklet is not the only runnable tasklet anymore). Must be
+ * called without the GIL. Returns 1 if a tasklet was woken up, 0 otherwise.
+ */
+static int coio_c_busy_poll(PyTaskletObject *m, unsigned usec) {
+  unsigned long long start = coio_c_monotonic_usec(), now;
+  int is_found = 0, is_empty;
+  coio_busy_poll_is_woken = 0;
+  ++coio_loop_stats.busy_poll_count;
+  for (;;) {
+    is_empty = event_loop(EVLOOP_ONCE | EVLOOP_NONBLOCK);
+    ++coio_loop_stats.busy_poll_loop_count;
+    now = coio_c_monotonic_usec();
+    if (m->next != m || coio_busy_poll_is_woken ||
+        !coio_c_completion_is_empty()) {
+      is_found = 1;
+      ++coio_loop_stats.busy_poll_hit_count;
+      break;
+    }
+    if (is_empty || now - start >= usec)  /* No events registered. */
+      break;
+  }
+  coio_loop_stats.busy_poll_usec_total += now - start;
+  return is_found;
+}
+
+/* --- Batched accept */
+
+#include <arpa/inet.h>
+#include <fcntl.h>
+#include <netinet/in.h>
+#include <stddef.h>
+#include <sys/socket.h>
+#include <sys/un.h>
+
+/** The beginning of socket._realsocket objects (PySocketSockObject in
+ * Modules/socketmodule.h of Python 2.x, which is not an installed header).
+ * Python 2.7 also has a weakreflist field after sock_timeout.
+ */
+typedef struct {
+  PyObject_HEAD
+  int sock_fd;
+  int sock_family;
+  int sock_type;
+  int sock_proto;
+  PyObject *(*errorhandler)(void);
+  double sock_timeout;
+} coio_c_realsocket_object;
+
+/** Check that socket_type (socket._realsocket) has the object layout
+ * expected by coio_c_accept_nonblocking().
+ *
+ * Returns 1 if it has, 0 otherwise.
+ */
+static int coio_c_is_realsocket_layout_known(PyObject *socket_type) {
+  PyTypeObject *type = (PyTypeObject*)socket_type;
+  PyObject *args, *obj;
+  coio_c_realsocket_object *sobj;
+  int is_known;
+  if (!PyType_Check(socket_type) || type->tp_new == NULL)
+    return 0;
+  if (!(type->tp_basicsize == sizeof(coio_c_realsocket_object) ||
+        (type->tp_basicsize ==
+         sizeof(coio_c_realsocket_object) + sizeof(PyObject*) &&
+         type->tp_weaklistoffset == sizeof(coio_c_realsocket_object))))
+    return 0;
+  if (NULL == (args = PyTuple_New(0)))
+    goto error;
+  obj = type->tp_new(type, args, NULL);
+  Py_DECREF(args);
+  if (obj == NULL)
+    goto error;
+  sobj = (coio_c_realsocket_object*)obj;
+  /* This is what sock_new sets before calling the constructor. */
+  is_known = sobj->sock_fd == -1 && sobj->sock_timeout == -1.0 &&
+             sobj->errorhandler != NULL;
+  Py_DECREF(obj);
+  return is_known;
+ error:
+  PyErr_Clear();
+  return 0;
+}
+
+/** Return a new reference to the Python socket address of addr, in the
+ * same format as socket.socket.accept() does.
+ */
+static PyObject *coio_c_make_sockaddr(struct sockaddr *addr,
+                                      socklen_t addrlen) {
+  char host[INET6_ADDRSTRLEN];
+  switch (addr->sa_family) {
+   case AF_INET: {
+    struct sockaddr_in *a = (struct sockaddr_in*)addr;
+    if (NULL == inet_ntop(AF_INET, &a->sin_addr, host, sizeof host))
+      return PyErr_SetFromErrno(coio_socket_error);
+    return Py_BuildValue("si", host, (int)ntohs(a->sin_port));
+   }
+   case AF_INET6: {
+    struct sockaddr_in6 *a = (struct sockaddr_in6*)addr;
+    if (NULL == inet_ntop(AF_INET6, &a->sin6_addr, host, sizeof host))
+      return PyErr_SetFromErrno(coio_socket_error);
+    return Py_BuildValue("siII", host, (int)ntohs(a->sin6_port),
+                         (unsigned int)ntohl(a->sin6_flowinfo),
+                         (unsigned int)a->sin6_scope_id);
+   }
+   case AF_UNIX: {
+    struct sockaddr_un *a = (struct sockaddr_un*)addr;
+    Py_ssize_t n =
+        (Py_ssize_t)addrlen - offsetof(struct sockaddr_un, sun_path);
+    if (n <= 0)
+      return PyString_FromStringAndSize("", 0);
+    if (a->sun_path[0] == '\0')  /* Linux abstract namespace. */
+      return PyString_FromStringAndSize(a->sun_path, n);
+    return PyString_FromString(a->sun_path);
+   }
+   default:
+    return Py_BuildValue("is#", (int)addr->sa_family, addr->sa_data,
+                         (int)sizeof addr->sa_data);
+  }
+}
+
+/** Accept a pending connection on the listening socket.
+ *
+ * Uses accept4(2) with SOCK_NONBLOCK | SOCK_CLOEXEC on Linux, so the
+ * accepted socket needs no further fcntl(2) calls. Doesn't wait.
+ *
+ * Args:
+ *   listener: A socket._realsocket for which
+ *     coio_c_is_realsocket_layout_known() has returned 1.
+ * Returns:
+ *   A new reference to a (realsock, address) tuple, where realsock is a
+ *   new socket._realsocket with a non-blocking fd; or a new reference to
+ *   Py_None if there is no pending connection (EAGAIN); or NULL with
+ *   socket.error set on error.
+ */
+static PyObject *coio_c_accept_nonblocking(PyObject *listener) {
+  coio_c_realsocket_object *lobj = (coio_c_realsocket_object*)listener;
+  coio_c_realsocket_object *sobj;
+  PyTypeObject *type = listener->ob_type;
+  PyObject *args, *obj, *addr_obj, *retval;
+  union {
+    struct sockaddr sa;
+    struct sockaddr_in in;
+    struct sockaddr_in6 in6;
+    struct sockaddr_un un;
+  } addr;
+  socklen_t addrlen;
+  int fd, flags;
+#if defined(__linux__) && defined(SOCK_NONBLOCK) && defined(SOCK_CLOEXEC)
+  static char is_accept4_missing = 0;
+#endif
+  for (;;) {
+    addrlen = sizeof addr;
+    memset(&addr, 0, sizeof addr);
+#if defined(__linux__) && defined(SOCK_NONBLOCK) && defined(SOCK_CLOEXEC)
+    if (!is_accept4_missing) {
+      fd = accept4(lobj->sock_fd, &addr.sa, &addrlen,
+                   SOCK_NONBLOCK | SOCK_CLOEXEC);
+      if (fd >= 0)
+        break;
+      if (errno == ENOSYS) {  /* Linux older than 2.6.28. */
+        is_accept4_missing = 1;
+        continue;
+      }
+    } else
+#endif
+    {
+      fd = accept(lobj->sock_fd, &addr.sa, &addrlen);
+      if (fd >= 0) {
+        if ((flags = fcntl(fd, F_GETFL)) < 0 ||
+            fcntl(fd, F_SETFL, flags | O_NONBLOCK) < 0 ||
+            fcntl(fd, F_SETFD, FD_CLOEXEC) < 0) {
+          PyErr_SetFromErrno(coio_socket_error);
+          close(fd);
+          return NULL;
+        }
+        break;
+      }
+    }
+    if (errno == EAGAIN || errno == EWOULDBLOCK) {
+      Py_INCREF(Py_None);
+      return Py_None;
+    }
+    /* The peer has closed the connection before we could accept it. */
+    if (errno != EINTR && errno != ECONNABORTED)
+      return PyErr_SetFromErrno(coio_socket_error);
+  }
+  if (NULL == (args = PyTuple_New(0))) {
+    close(fd);
+    return NULL;
+  }
+  obj = type->tp_new(type, args, NULL);
+  Py_DECREF(args);
+  if (obj == NULL) {
+    close(fd);
+    return NULL;
+  }
+  /* Same as what socket._realsocket.accept does, but with the fd being
+   * non-blocking. obj owns the fd from now on.
+   */
+  sobj = (coio_c_realsocket_object*)obj;
+  sobj->sock_fd = fd;
+  sobj->sock_family = lobj->sock_family;
+  sobj->sock_type = lobj->sock_type;
+  sobj->sock_proto = lobj->sock_proto;
+  if (NULL == (addr_obj = coio_c_make_sockaddr(&addr.sa, addrlen))) {
+    Py_DECREF(obj);
+    return NULL;
+  }
+  retval = PyTuple_New(2);
+  if (retval == NULL) {
+    Py_DECREF(obj);
+    Py_DECREF(addr_obj);
+    return NULL;
+  }
+  PyTuple_SET_ITEM(retval, 0, obj);  /* Transfer ownership. */
+  PyTuple_SET_ITEM(retval, 1, addr_obj);
+  return retval;
+}
+
 /* --- Wrapping exceptions */
 
 static inline PyObject *coio_c_call_wrap_bomb(PyObject *function,
@@ -657,3 +1576,452 @@ static inline PyObject *coio_c_call_wrap_bomb(PyObject *function,
   Py_DECREF(bomb_args);
   return retval;
 }
+
+/* --- HTTP helpers for the WSGI fast path */
+
+#include <strings.h>  /* strncasecmp() */
+
+/** Maximum number of digits in a Content-Length which fits to Py_ssize_t. */
+#define COIO_C_MAX_CONTENT_LENGTH_DIGITS (sizeof(Py_ssize_t) > 4 ? 18 : 9)
+
+/** Return nonzero iff c may appear in a sub-URL (see wsgi.SUB_URL_RE). */
+static inline int coio_c_is_suburl_char(unsigned char c) {
+  return (c >= 'a' && c <= 'z') || (c >= 'A' && c <= 'Z') ||
+         (c >= '0' && c <= '9') ||
+         (c != '\0' && NULL != strchr("-_./,~!@$*()[]';:?&%+=", c));
+}
+
+/** Return nonzero iff the header line at p[:n] has the specified name. */
+static inline int coio_c_is_http_header(const char *p, Py_ssize_t n,
+                                        const char *name, Py_ssize_t size) {
+  return n >= size && 0 == strncasecmp(p, name, size);
+}
+
+/** Check whether the HTTP request head in p[:n] can be served by the WSGI
+ * fast path (wsgi_fast_request).
+ *
+ * Only GET, HEAD and POST requests with HTTP/1.0 or HTTP/1.1, with a valid
+ * sub-URL and without an Upgrade:, Expect:, Transfer-Encoding: or
+ * Sec-WebSocket-*: header qualify. POST requests must have a numeric
+ * Content-Length:, GET and HEAD requests must not have a nonzero one.
+ *
+ * Returns -1 if p[:n] doesn't contain the whole request head yet, 0 if the
+ * request must be served by the slow path (wsgi.WsgiWorker), and 1 if it
+ * can be served by the fast path. p[:n] is not modified.
+ */
+static int coio_c_wsgi_prescan(const char *p, Py_ssize_t n) {
+  const char *end = p + n, *q, *r;
+  char is_post = 0;
+  /* 0: missing, 1: zero, 2: nonzero. */
+  char content_length_state = 0;
+  q = memchr(p, '\n', n);
+  if (q == NULL)
+    return -1;
+  r = q;
+  if (r > p && r[-1] == '\r')
+    --r;
+  if (r - p >= 4 && 0 == memcmp(p, "GET ", 4)) {
+    p += 4;
+  } else if (r - p >= 5 && 0 == memcmp(p, "HEAD ", 5)) {
+    p += 5;
+  } else if (r - p >= 5 && 0 == memcmp(p, "POST ", 5)) {
+    p += 5;
+    is_post = 1;
+  } else {
+    return 0;
+  }
+  if (p == r || *p != '/')
+    return 0;
+  for (++p; p != r && *p != ' '; ++p) {
+    if (!coio_c_is_suburl_char(*(unsigned char*)p))
+      return 0;
+  }
+  if (r - p != 9 || 0 != memcmp(p, " HTTP/1.", 8) ||
+      (p[8] != '0' && p[8] != '1'))
+    return 0;
+  for (;;) {
+    p = q + 1;
+    if (p == end)
+      return -1;
+    q = memchr(p, '\n', end - p);
+    if (q == NULL)
+      return -1;
+    if (q == p || (q == p + 1 && *p == '\r'))  /* Empty line. */
+      break;
+    switch (*p | 32) {  /* Fast lower case of the first letter. */
+     case 'c':
+      if (coio_c_is_http_header(p, q - p, "content-length:", 15)) {
+        content_length_state = 1;
+        for (p += 15; p != q && (*p == ' ' || *p == '\t'); ++p) {}
+        if (p == q || *p < '0' || *p > '9')
+          return 0;
+        for (r = p; p != q && *p >= '0' && *p <= '9'; ++p) {
+          if (*p != '0')
+            content_length_state = 2;
+        }
+        if (p - r > COIO_C_MAX_CONTENT_LENGTH_DIGITS)
+          return 0;
+        for (; p != q && (*p == ' ' || *p == '\t' || *p == '\r'); ++p) {}
+        if (p != q)
+          return 0;
+      }
+      break;
+     case 'e':
+      if (coio_c_is_http_header(p, q - p, "expect:", 7))
+        return 0;
+      break;
+     case 's':
+      if (coio_c_is_http_header(p, q - p, "sec-websocket-", 14))
+        return 0;
+      break;
+     case 't':
+      if (coio_c_is_http_header(p, q - p, "transfer-encoding:", 18))
+        return 0;
+      break;
+     case 'u':
+      if (coio_c_is_http_header(p, q - p, "upgrade:", 8))
+        return 0;
+      break;
+    }
+  }
+  if (is_post ? content_length_state == 0 : content_length_state == 2)
+    return 0;
+  return 1;
+}
+
+/** Return nonzero iff p[:n] matches wsgi.HTTP_RESPONSE_STATUS_RE, and it
+ * doesn't end with whitespace.
+ */
+static int coio_c_is_http_response_status(const char *p, Py_ssize_t n) {
+  Py_ssize_t i;
+  if (n < 5 || p[0] < '2' || p[0] > '5' || p[1] < '0' || p[1] > '9' ||
+      p[2] < '0' || p[2] > '9' || p[3] != ' ' || p[4] < 'A' || p[4] > 'Z' ||
+      p[n - 1] == ' ')
+    return 0;
+  for (i = 5; i < n; ++i) {
+    if (p[i] < ' ' || p[i] > '~')
+      return 0;
+  }
+  return 1;
+}
+
+/** Return nonzero iff p[:n] matches wsgi.HEADER_KEY_RE. */
+static int coio_c_is_http_header_key(const char *p, Py_ssize_t n) {
+  Py_ssize_t i;
+  if (n == 0 || ((p[0] | 32) < 'a' || (p[0] | 32) > 'z'))
+    return 0;
+  for (i = 1; i < n; ++i) {
+    if (p[i] != '-' && ((p[i] | 32) < 'a' || (p[i] | 32) > 'z'))
+      return 0;
+  }
+  return 1;
+}
+
+/** Return nonzero iff p[:n] matches wsgi.HEADER_VALUE_RE. */
+static int coio_c_is_http_header_value(const char *p, Py_ssize_t n) {
+  Py_ssize_t i;
+  if (n == 0)
+    return 0;
+  for (i = 0; i < n; ++i) {
+    if (p[i] < ' ' || p[i] > '~')
+      return 0;
+  }
+  return 1;
+}
+
+/** Append a `Key: value\r\n' HTTP response header line to eb.
+ *
+ * The lower case key is capitalized the same way as
+ * wsgi.HEADER_WORD_LOWER_LETTER_RE does it.
+ *
+ * Returns -1 on out-of-memory, 0 otherwise.
+ */
+static int coio_c_evbuffer_add_http_header(
+    struct coio_evbuffer *eb, const char *key, Py_ssize_t key_size,
+    const char *value, Py_ssize_t value_size) {
+  Py_ssize_t i;
+  char *p;
+  char c, is_word_start = 1;
+  if (0 != coio_evbuffer_expand(eb, key_size + value_size + 4))
+    return -1;
+  p = (char*)eb->buffer + eb->off;
+  for (i = 0; i < key_size; ++i) {
+    c = key[i];
+    if (is_word_start && c >= 'a' && c <= 'z')
+      c -= 32;
+    is_word_start = c == '-';
+    *p++ = c;
+  }
+  *p++ = ':';
+  *p++ = ' ';
+  memcpy(p, value, value_size);
+  p += value_size;
+  *p++ = '\r';
+  *p++ = '\n';
+  eb->off = p - (char*)eb->buffer;
+  return 0;
+}
+
+/** Return the size of the HTTP request head (including the terminating
+ * empty line) in p[:n], or -1 if p[:n] doesn't contain the whole head yet.
+ */
+static Py_ssize_t coio_c_http_reqhead_size(const char *p, Py_ssize_t n) {
+  const char *q = p, *end = p + n;
+  while (NULL != (q = memchr(q, '\n', end - q))) {
+    if (++q == end)
+      break;
+    if (*q == '\n')
+      return q + 1 - p;
+    if (*q == '\r' && q + 1 != end && q[1] == '\n')
+      return q + 2 - p;
+  }
+  return -1;
+}
+
+enum coio_c_http_header_kind {
+  COIO_HTTP_HEADER_SINGLE = 0,
+  COIO_HTTP_HEADER_COMMA_SEPARATED = 1,
+  COIO_HTTP_HEADER_CONTENT_LENGTH = 2,
+  COIO_HTTP_HEADER_CONNECTION = 3,
+  COIO_HTTP_HEADER_IGNORED = 4,
+};
+
+/** Well-known HTTP request headers, with their WSGI environment keys.
+ *
+ * The comma-separated ones must be kept in sync with
+ * wsgi.COMMA_SEPARATED_REQHEAD.
+ */
+static const struct coio_c_http_known_header {
+  const char *name;
+  const char *env_key;
+  char kind;
+} coio_c_http_known_headers[] = {
+  {"host", "HTTP_HOST", COIO_HTTP_HEADER_SINGLE},
+  {"user-agent", "HTTP_USER_AGENT", COIO_HTTP_HEADER_SINGLE},
+  {"accept", "HTTP_ACCEPT", COIO_HTTP_HEADER_COMMA_SEPARATED},
+  {"accept-charset", "HTTP_ACCEPT_CHARSET", COIO_HTTP_HEADER_COMMA_SEPARATED},
+  {"accept-encoding", "HTTP_ACCEPT_ENCODING",
+   COIO_HTTP_HEADER_COMMA_SEPARATED},
+  {"accept-language", "HTTP_ACCEPT_LANGUAGE",
+   COIO_HTTP_HEADER_COMMA_SEPARATED},
+  {"accept-ranges", "HTTP_ACCEPT_RANGES", COIO_HTTP_HEADER_COMMA_SEPARATED},
+  {"allow", "HTTP_ALLOW", COIO_HTTP_HEADER_COMMA_SEPARATED},
+  {"authorization", "HTTP_AUTHORIZATION", COIO_HTTP_HEADER_SINGLE},
+  {"cache-control", "HTTP_CACHE_CONTROL", COIO_HTTP_HEADER_COMMA_SEPARATED},
+  {"connection", "HTTP_CONNECTION", COIO_HTTP_HEADER_CONNECTION},
+  {"content-encoding", "HTTP_CONTENT_ENCODING",
+   COIO_HTTP_HEADER_COMMA_SEPARATED},
+  {"content-language", "HTTP_CONTENT_LANGUAGE",
+   COIO_HTTP_HEADER_COMMA_SEPARATED},
+  {"content-length", "CONTENT_LENGTH", COIO_HTTP_HEADER_CONTENT_LENGTH},
+  {"content-type", "CONTENT_TYPE", COIO_HTTP_HEADER_SINGLE},
+  {"cookie", "HTTP_COOKIE", COIO_HTTP_HEADER_SINGLE},
+  {"expect", "HTTP_EXPECT", COIO_HTTP_HEADER_COMMA_SEPARATED},
+  {"if-match", "HTTP_IF_MATCH", COIO_HTTP_HEADER_COMMA_SEPARATED},
+  {"if-modified-since", "HTTP_IF_MODIFIED_SINCE", COIO_HTTP_HEADER_SINGLE},
+  {"if-none-match", "HTTP_IF_NONE_MATCH", COIO_HTTP_HEADER_COMMA_SEPARATED},
+  {"keep-alive", "HTTP_KEEP_ALIVE", COIO_HTTP_HEADER_IGNORED},
+  {"origin", "HTTP_ORIGIN", COIO_HTTP_HEADER_SINGLE},
+  {"pragma", "HTTP_PRAGMA", COIO_HTTP_HEADER_COMMA_SEPARATED},
+  {"range", "HTTP_RANGE", COIO_HTTP_HEADER_SINGLE},
+  {"referer", "HTTP_REFERER", COIO_HTTP_HEADER_SINGLE},
+  {"te", "HTTP_TE", COIO_HTTP_HEADER_COMMA_SEPARATED},
+  {"trailer", "HTTP_TRAILER", COIO_HTTP_HEADER_COMMA_SEPARATED},
+  {"transfer-encoding", "HTTP_TRANSFER_ENCODING",
+   COIO_HTTP_HEADER_COMMA_SEPARATED},
+  {"upgrade", "HTTP_UPGRADE", COIO_HTTP_HEADER_COMMA_SEPARATED},
+  {"vary", "HTTP_VARY", COIO_HTTP_HEADER_COMMA_SEPARATED},
+  {"via", "HTTP_VIA", COIO_HTTP_HEADER_COMMA_SEPARATED},
+  {"warning", "HTTP_WARNING", COIO_HTTP_HEADER_COMMA_SEPARATED},
+  {"www-authenticate", "HTTP_WWW_AUTHENTICATE",
+   COIO_HTTP_HEADER_COMMA_SEPARATED},
+  {"x-forwarded-for", "HTTP_X_FORWARDED_FOR", COIO_HTTP_HEADER_SINGLE},
+  {"x-forwarded-proto", "HTTP_X_FORWARDED_PROTO", COIO_HTTP_HEADER_SINGLE},
+  {"x-requested-with", "HTTP_X_REQUESTED_WITH", COIO_HTTP_HEADER_SINGLE},
+};
+
+#define COIO_C_HTTP_KNOWN_HEADER_COUNT ((int)( \
+    sizeof(coio_c_http_known_headers) / sizeof(coio_c_http_known_headers[0])))
+
+static inline const char *coio_c_http_known_header_env_key(int i) {
+  return coio_c_http_known_headers[i].env_key;
+}
+
+static inline int coio_c_http_known_header_kind(int i) {
+  return coio_c_http_known_headers[i].kind;
+}
+
+/** Return the index of the HTTP request header named p[:n] in
+ * coio_c_http_known_headers (case insensitive), or -1 if not found.
+ */
+static int coio_c_http_find_known_header(const char *p, Py_ssize_t n) {
+  int i;
+  for (i = 0; i < COIO_C_HTTP_KNOWN_HEADER_COUNT; ++i) {
+    if ((p[0] | 32) == coio_c_http_known_headers[i].name[0] &&
+        0 == strncasecmp(p, coio_c_http_known_headers[i].name, n) &&
+        coio_c_http_known_headers[i].name[n] == '\0')
+      return i;
+  }
+  return -1;
+}
+
+/** Return a new WSGI environment key ('HTTP_' + name in upper case, with
+ * '-' replaced by '_') for the HTTP request header named p[:n].
+ */
+static PyObject *coio_c_http_new_env_key(const char *p, Py_ssize_t n) {
+  PyObject *key = PyString_FromStringAndSize(NULL, n + 5);
+  char *q, c;
+  if (key == NULL)
+    return NULL;
+  q = PyString_AS_STRING(key);
+  memcpy(q, "HTTP_", 5);
+  for (q += 5; n > 0; --n) {
+    c = *p++;
+    if (c == '-') {
+      c = '_';
+    } else if (c >= 'a' && c <= 'z') {
+      c -= 32;
+    }
+    *q++ = c;
+  }
+  return key;
+}
+
+/** Parse an HTTP Content-Length: value in p[:n].
+ *
+ * Leading and trailing whitespace is ignored.
+ *
+ * Returns the value, or -1 if it is invalid (or too large).
+ */
+static Py_ssize_t coio_c_http_parse_content_length(const char *p,
+                                                   Py_ssize_t n) {
+  const char *end = p + n, *q;
+  Py_ssize_t retval = 0;
+  for (; p != end && (*p == ' ' || *p == '\t'); ++p) {}
+  if (p == end || *p < '0' || *p > '9')
+    return -1;
+  for (q = p; p != end && *p >= '0' && *p <= '9'; ++p) {
+    if (p - q == COIO_C_MAX_CONTENT_LENGTH_DIGITS)
+      return -1;
+    retval = retval * 10 + (*p - '0');
+  }
+  for (; p != end && (*p == ' ' || *p == '\t'); ++p) {}
+  return p == end ? retval : -1;
+}
+
+/** Parse the head line of a chunk in a HTTP/1.1 chunked request body, in
+ * p[:n], without the trailing '\n' (but maybe with a trailing '\r').
+ *
+ * The chunk size is a hexadecimal number, it may be followed by whitespace
+ * and chunk extensions (starting with ';'), which are ignored.
+ *
+ * Returns the chunk size, or -1 if it is invalid (or too large).
+ */
+static Py_ssize_t coio_c_http_parse_chunk_size(const char *p, Py_ssize_t n) {
+  const char *end = p + n, *q;
+  Py_ssize_t retval = 0;
+  char c;
+  if (p != end && end[-1] == '\r')
+    --end;
+  for (q = p; p != end; ++p) {
+    c = *p;
+    if (c >= '0' && c <= '9') {
+      c -= '0';
+    } else if ((c | 32) >= 'a' && (c | 32) <= 'f') {
+      c = (c | 32) - 'a' + 10;
+    } else {
+      break;
+    }
+    if (p - q == sizeof(Py_ssize_t) * 2 - 1)
+      return -1;
+    retval = retval << 4 | c;
+  }
+  if (p == q)
+    return -1;
+  for (; p != end && (*p == ' ' || *p == '\t'); ++p) {}
+  return p == end || *p == ';' ? retval : -1;
+}
+
+/** Size of the chunk head placeholder added by
+ * coio_c_evbuffer_begin_http_chunk: 8 hex digits and CRLF.
+ */
+#define COIO_C_HTTP_CHUNK_PLACEHOLDER_SIZE 10
+
+/** Append the head of a HTTP/1.1 chunk of size n ("%x\r\n") to eb.
+ *
+ * Returns -1 on out-of-memory, 0 otherwise.
+ */
+static int coio_c_evbuffer_add_http_chunk_head(struct coio_evbuffer *eb,
+                                               Py_ssize_t n) {
+  char buf[sizeof(Py_ssize_t) * 2 + 2], *p = buf + sizeof(buf);
+  *--p = '\n';
+  *--p = '\r';
+  do {
+    *--p = "0123456789abcdef"[n & 15];
+    n >>= 4;
+  } while (n > 0);
+  return coio_evbuffer_add(eb, p, buf + sizeof(buf) - p);
+}
+
+/** Append a placeholder for the head of a HTTP/1.1 chunk to eb, and
+ * return its offset in eb (to be passed to coio_c_evbuffer_end_http_chunk),
+ * or -1 on out-of-memory.
+ *
+ * The chunk size is written to the placeholder as 8 hex digits with leading
+ * zeros (which is valid according to RFC 2616), so the chunk data can be
+ * added to eb before its size is known.
+ */
+static Py_ssize_t coio_c_evbuffer_begin_http_chunk(struct coio_evbuffer *eb) {
+  Py_ssize_t off = eb->off;
+  if (0 != coio_evbuffer_add(eb, "00000000\r\n",
+                             COIO_C_HTTP_CHUNK_PLACEHOLDER_SIZE))
+    return -1;
+  return off;
+}
+
+/** Finish the HTTP/1.1 chunk started at offset off by
+ * coio_c_evbuffer_begin_http_chunk: fill in its size and append a CRLF.
+ *
+ * The chunk data (added after the placeholder) must be shorter than 4 GiB.
+ *
+ * Returns -1 on out-of-memory, 0 otherwise.
+ */
+static int coio_c_evbuffer_end_http_chunk(struct coio_evbuffer *eb,
+                                          Py_ssize_t off) {
+  char *p = (char*)eb->buffer + off + 8;
+  size_t n = eb->off - off - COIO_C_HTTP_CHUNK_PLACEHOLDER_SIZE;
+  int i;
+  for (i = 0; i < 8; ++i) {
+    *--p = "0123456789abcdef"[n & 15];
+    n >>= 4;
+  }
+  return coio_evbuffer_add(eb, "\r\n", 2);
+}
+
+/** Return nonzero iff p[:n] starts with a whole HTTP request (head and body)
+ * which can be served by coio.wsgi_fast_request (see coio_c_wsgi_prescan).
+ *
+ * Used for deciding whether responses to pipelined requests can be kept in
+ * the write buffer: a request found by this function can be served without
+ * blocking on reads.
+ */
+static int coio_c_wsgi_is_request_buffered(const char *p, Py_ssize_t n) {
+  const char *q, *r, *end;
+  Py_ssize_t content_length = 0;
+  if (coio_c_wsgi_prescan(p, n) <= 0)
+    return 0;
+  end = p + coio_c_http_reqhead_size(p, n);
+  for (q = p; NULL != (q = memchr(q, '\n', end - q)); ) {
+    if (++q == end)
+      break;
+    if ((*q | 32) == 'c' &&
+        coio_c_is_http_header(q, end - q, "content-length:", 15)) {
+      r = memchr(q, '\n', end - q);
+      if (r > q && r[-1] == '\r')
+        --r;
+      content_length = coio_c_http_parse_content_length(q + 15, r - q - 15);
+      break;
+    }
+  }
+  return content_length <= p + n - end;
+}
@@ -16,6 +16,10 @@ static struct event_base *coio_default_base = NULL;
  */
 #define FEATURE_MAY_EVENT_LOOP_RETURN_1    0
 #define FEATURE_MULTIPLE_EVENTS_ON_SAME_FD 1
+/* Edge-triggered events in libevent2 can't be mixed with level-triggered
+ * events on the same fd, and coio_c_wait needs that.
+ */
+#define FEATURE_EDGE_TRIGGERED             0
 #define coio_event_reinit_low() event_reinit(coio_default_base)
 #define coio_event_init_low() event_init()
 #endif
@@ -25,6 +29,7 @@ static struct event_base *coio_default_base = NULL;
 #include "./coio_event1_event.h"
 #define FEATURE_MAY_EVENT_LOOP_RETURN_1    1
 #define FEATURE_MULTIPLE_EVENTS_ON_SAME_FD 0
+#define FEATURE_EDGE_TRIGGERED             0
 #define coio_event_reinit_low() event_reinit(coio_default_base)
 #define coio_event_init_low() event_init()
 #endif
@@ -34,7 +39,15 @@ static struct event_base *coio_default_base = NULL;
 #include "./coio_minievent.h"
 #define FEATURE_MAY_EVENT_LOOP_RETURN_1    1
 #define FEATURE_MULTIPLE_EVENTS_ON_SAME_FD 1
-#define coio_event_reinit_low() 0
+#ifdef COIO_USE_MINIEVENT_EPOLL
+#define FEATURE_EDGE_TRIGGERED             1
+#else
+#define FEATURE_EDGE_TRIGGERED             0
+#endif
+/* This is a no-op for coio_minievent.c, but coio_minievent_epoll.c
+ * recreates its epoll fd.
+ */
+#define coio_event_reinit_low() event_reinit(coio_default_base)
 #define coio_event_init_low() event_init()
 #endif
 
@@ -43,6 +56,7 @@ static struct event_base *coio_default_base = NULL;
 #include "./coio_ev_event.h"
 #define FEATURE_MAY_EVENT_LOOP_RETURN_1    0
 #define FEATURE_MULTIPLE_EVENTS_ON_SAME_FD 1
+#define FEATURE_EDGE_TRIGGERED             0
 static inline void coio_event_set(struct event *ev, int fd, short events,
                                   void (*cb)(int, short, void*), void *arg) {
   event_set(ev, fd, events, cb, arg);
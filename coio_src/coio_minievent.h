@@ -3,6 +3,10 @@
  * by pts@fazekas.hu at Mon May 10 20:47:07 CEST 2010
  *
  * Tested on Linux 2.6 with gcc 4.4.1, glibc 2.10.1.
+ *
+ * There are three implementations: coio_minievent.c (portable, uses
+ * select(2)), coio_minievent_epoll.c (Linux only, uses epoll(7)) and
+ * coio_minievent_uring.c (Linux >= 5.5 only, uses io_uring(7)).
  */
 
 #ifndef COIO_MINIEVENT_H
@@ -17,6 +21,9 @@
 #define EV_WRITE	0x04
 #define EV_SIGNAL	0x08
 #define EV_PERSIST	0x10	/* Persistant event */
+/* Edge-triggered, value copied from libevent2. Only coio_minievent_epoll.c
+ * supports it. */
+#define EV_ET		0x20
 #define EVLOOP_ONCE     0x01    /**< Block at most once. */
 #define EVLOOP_NONBLOCK 0x02    /**< Do not block. */
 
@@ -25,6 +32,12 @@ struct event_base;
 struct event {
   struct event* evx_next;
   struct event* evx_prev;
+  /* Index in the timer heap, only coio_minievent_epoll.c and
+   * coio_minievent_uring.c use it.
+   */
+  int evx_timer_index;
+  /* Index of the submitted poll, only coio_minievent_uring.c uses it. */
+  int evx_slot_index;
   int ev_fd;
   short ev_events;
   struct timeval ev_timeout;
@@ -0,0 +1,652 @@
+/*
+ * coio_minievent_epoll.c: epoll(7)-based variant of coio_minievent.c (Linux)
+ *
+ * This file implements the same API (coio_minievent.h) as coio_minievent.c,
+ * and setup.py uses it instead of coio_minievent.c on Linux. The difference
+ * is that coio_minievent.c rebuilds fd_sets from all registered events and
+ * calls select(2) in each event_loop() iteration, which is limited to
+ * FD_SETSIZE, and it is O(number of registered events) per wakeup. This
+ * file keeps an fd-indexed table of the registered events instead, it
+ * updates the epoll registration of an fd in event_add() and event_del()
+ * only if the set of interesting event types (EV_READ and EV_WRITE) for the
+ * fd changes, and event_loop() visits only the events of the fds reported
+ * ready by epoll_wait(2), and the expired events.
+ *
+ * The events with a timeout are kept in a binary min-heap ordered by
+ * ev_expire, so event_add() and event_del() are O(log n), finding the
+ * nearest timeout is O(1), and an expiry pass visits the expired events
+ * only.
+ *
+ * Signals are delivered using a self-pipe, registered to epoll.
+ *
+ * Regular files (which are not supported by epoll, but select(2) reports
+ * them ready) are reported always ready.
+ *
+ * EV_ET (edge-triggered, only in this file) is honored if all events
+ * registered for the fd have it: then the fd is registered with EPOLLET.
+ * Edge-triggered events are never reported for regular files (because
+ * they never change state).
+ */
+
+#include "./coio_minievent.h"
+
+#include <sys/epoll.h>
+#include <sys/time.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <signal.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+
+/* Constants copied from event.h in libevent1 1.4.13, for ev_flags. */
+#define EVLIST_TIMEOUT  0x01
+#define EVLIST_INSERTED 0x02
+
+#define MINIEVENT_HIGH_SEC (0x7fffffffL)
+#define MINIEVENT_FIX_TV_AFTER_ADD(tv) do { \
+  if ((tv).tv_usec >= 1000000L) { (tv).tv_usec -= 1000000L; ++(tv).tv_sec; } \
+} while (0)
+/* The fd has to be reported ready in each event_loop() iteration. */
+#define MINIEVENT_IS_LEVEL_READY(mask) ((mask) != 0 && !((mask) & EV_ET))
+#define MINIEVENT_TV_LT(tva, tvb) \
+    ((tva).tv_sec < (tvb).tv_sec || \
+     ((tva).tv_sec == (tvb).tv_sec && (tva).tv_usec < (tvb).tv_usec))
+
+/** Maximum number of ready fds processed by an event_loop() iteration. The
+ * rest is reported by the next epoll_wait(2) call.
+ */
+#define MINIEVENT_MAX_EPOLL_EVENTS 256
+
+/** Registered events of an fd. */
+struct minievent_fd {
+  /* Doubly linked list (using evx_next and evx_prev) of events. */
+  struct event *first;
+  struct event *last;
+  /* EV_READ | EV_WRITE bits registered to epoll, and EV_ET if all events
+   * of the fd are edge-triggered.
+   */
+  short mask;
+  /* The fd is a regular file (or similar), not supported by epoll. */
+  char is_always_ready;
+};
+
+static int minievent_epfd = -1;
+static struct minievent_fd *minievent_fds = NULL;
+static int minievent_fd_count = 0;
+/* Number of fds with is_always_ready and MINIEVENT_IS_LEVEL_READY(mask). */
+static int minievent_always_ready_count = 0;
+/* Doubly linked list (using evx_next and evx_prev) of EV_SIGNAL events. */
+static struct event *minievent_signal_first = NULL;
+/* Binary min-heap of the events with a timeout, ordered by ev_expire. The
+ * children of minievent_timer_heap[i] are at 2 * i + 1 and 2 * i + 2.
+ */
+static struct event **minievent_timer_heap = NULL;
+static int minievent_timer_count = 0;
+static int minievent_timer_capacity = 0;
+static int minievent_event_count = 0;
+static int minievent_internal_event_count = 0;
+/* The next event to visit by event_loop(), updated by event_del(). */
+static struct event *minievent_loop_ev = NULL;
+static char minievent_is_in_loop = 0;
+static struct epoll_event minievent_epoll_events[MINIEVENT_MAX_EPOLL_EVENTS];
+
+typedef unsigned minievent_signal_mask_t;
+
+static volatile minievent_signal_mask_t minievent_got_signal_mask = 0;
+static int minievent_signal_pipe[2] = {-1, -1};
+
+static void minievent_signal_handler(int signum) {
+  int saved_errno = errno;
+  minievent_got_signal_mask |= 1L << signum;
+  /* Wake up epoll_wait(2) in event_loop(). If the pipe is full, there is
+   * a pending wakeup already.
+   */
+  if (minievent_signal_pipe[1] >= 0)
+    (void)!write(minievent_signal_pipe[1], "", 1);
+  errno = saved_errno;
+}
+
+const char *event_get_version(void) {
+  return "0.02";
+}
+const char *event_get_method(void) {
+  return "minievent-epoll";
+}
+
+static int minievent_set_cloexec_nonblock(int fd) {
+  int flags = fcntl(fd, F_GETFL);
+  if (flags < 0 || fcntl(fd, F_SETFL, flags | O_NONBLOCK) < 0)
+    return -1;
+  return fcntl(fd, F_SETFD, FD_CLOEXEC);
+}
+
+/** Return the epoll_event.events corresponding to the mask of an fd. */
+static unsigned minievent_get_epoll_events(short mask) {
+  return (mask & EV_READ ? EPOLLIN : 0) | (mask & EV_WRITE ? EPOLLOUT : 0) |
+         (mask & EV_ET ? EPOLLET : 0);
+}
+
+static int minievent_epoll_create(void) {
+  int epfd;
+#ifdef EPOLL_CLOEXEC
+  if ((epfd = epoll_create1(EPOLL_CLOEXEC)) >= 0 || errno != ENOSYS)
+    return epfd;
+#endif
+  if ((epfd = epoll_create(1024)) >= 0)
+    fcntl(epfd, F_SETFD, FD_CLOEXEC);
+  return epfd;
+}
+
+static void minievent_close_signal_pipe(void) {
+  if (minievent_signal_pipe[0] >= 0) {
+    close(minievent_signal_pipe[0]);
+    close(minievent_signal_pipe[1]);
+    minievent_signal_pipe[0] = minievent_signal_pipe[1] = -1;
+  }
+}
+
+/** Create the signal self-pipe (if not created yet), and register it. */
+static int minievent_open_signal_pipe(void) {
+  struct epoll_event eev;
+  int fds[2];
+  if (minievent_signal_pipe[0] >= 0)
+    return 0;
+  if (0 != pipe(fds))
+    return -1;
+  memset(&eev, '\0', sizeof eev);
+  eev.events = EPOLLIN;
+  eev.data.fd = fds[0];
+  if (0 != minievent_set_cloexec_nonblock(fds[0]) ||
+      0 != minievent_set_cloexec_nonblock(fds[1]) ||
+      0 != epoll_ctl(minievent_epfd, EPOLL_CTL_ADD, fds[0], &eev)) {
+    close(fds[0]);
+    close(fds[1]);
+    return -1;
+  }
+  minievent_signal_pipe[0] = fds[0];
+  minievent_signal_pipe[1] = fds[1];
+  return 0;
+}
+
+struct event_base *event_init(void) {
+  /* Forget about all events, if any; this is compatible to libevent1 */
+  if (minievent_epfd >= 0)
+    close(minievent_epfd);
+  minievent_close_signal_pipe();
+  if ((minievent_epfd = minievent_epoll_create()) < 0)
+    return NULL;
+  if (minievent_fds != NULL)
+    memset(minievent_fds, '\0', minievent_fd_count * sizeof*minievent_fds);
+  minievent_always_ready_count = 0;
+  minievent_signal_first = NULL;
+  minievent_timer_count = 0;
+  minievent_event_count = minievent_internal_event_count = 0;
+  return (struct event_base*)1;
+}
+
+/** Recreate the epoll fd and the signal pipe, e.g. after a fork(), so the
+ * parent and the child don't share them.
+ */
+int event_reinit(struct event_base *base) {
+  struct epoll_event eev;
+  int fd;
+  char had_signal_pipe = minievent_signal_pipe[0] >= 0;
+  (void)base;
+  if (minievent_epfd >= 0)
+    close(minievent_epfd);
+  minievent_close_signal_pipe();
+  if ((minievent_epfd = minievent_epoll_create()) < 0)
+    return -1;
+  if (had_signal_pipe && 0 != minievent_open_signal_pipe())
+    return -1;
+  memset(&eev, '\0', sizeof eev);
+  for (fd = 0; fd < minievent_fd_count; ++fd) {
+    short mask = minievent_fds[fd].mask;
+    if (mask != 0 && !minievent_fds[fd].is_always_ready) {
+      eev.events = minievent_get_epoll_events(mask);
+      eev.data.fd = fd;
+      if (0 != epoll_ctl(minievent_epfd, EPOLL_CTL_ADD, fd, &eev))
+        return -1;
+    }
+  }
+  return 0;
+}
+
+void event_base_free(struct event_base *base) {
+  (void)base;
+}
+
+void event_set(struct event *ev, int fd,
+               short events, void (*cb)(int, short, void *), void *arg) {
+  ev->evx_next = ev->evx_prev = NULL;
+  ev->evx_timer_index = -1;
+  ev->ev_fd = fd;
+  ev->ev_events = events;
+  /* do not set ev->ev_timeout */
+  ev->ev_callback = cb;
+  ev->ev_arg = arg;
+  ev->ev_flags = 0;
+}
+
+int event_pending(struct event *ev, short events, struct timeval *tv) {
+  if (tv != NULL) {
+    fprintf(stderr, "minievent: got timeout for event_pending\n");
+    abort();
+  }
+  return (ev->ev_flags & EVLIST_INSERTED) && (ev->ev_events & events);
+}
+
+/** Move the event at index i of the timer heap up to its place. */
+static void minievent_timer_sift_up(int i) {
+  struct event **heap = minievent_timer_heap;
+  struct event *ev = heap[i];
+  int parent;
+  while (i > 0) {
+    parent = (i - 1) >> 1;
+    if (!MINIEVENT_TV_LT(ev->ev_expire, heap[parent]->ev_expire))
+      break;
+    heap[i] = heap[parent];
+    heap[i]->evx_timer_index = i;
+    i = parent;
+  }
+  heap[i] = ev;
+  ev->evx_timer_index = i;
+}
+
+/** Move the event at index i of the timer heap down to its place. */
+static void minievent_timer_sift_down(int i) {
+  struct event **heap = minievent_timer_heap;
+  struct event *ev = heap[i];
+  int n = minievent_timer_count;
+  int child;
+  while ((child = 2 * i + 1) < n) {
+    if (child + 1 < n &&
+        MINIEVENT_TV_LT(heap[child + 1]->ev_expire, heap[child]->ev_expire))
+      ++child;
+    if (!MINIEVENT_TV_LT(heap[child]->ev_expire, ev->ev_expire))
+      break;
+    heap[i] = heap[child];
+    heap[i]->evx_timer_index = i;
+    i = child;
+  }
+  heap[i] = ev;
+  ev->evx_timer_index = i;
+}
+
+static int minievent_timer_push(struct event *ev) {
+  if (minievent_timer_count == minievent_timer_capacity) {
+    int new_capacity = minievent_timer_capacity < 64 ?
+        64 : minievent_timer_capacity << 1;
+    struct event **new_heap = realloc(
+        minievent_timer_heap, new_capacity * sizeof*new_heap);
+    if (new_heap == NULL) {
+      errno = ENOMEM;
+      return -1;
+    }
+    minievent_timer_heap = new_heap;
+    minievent_timer_capacity = new_capacity;
+  }
+  minievent_timer_heap[minievent_timer_count] = ev;
+  minievent_timer_sift_up(minievent_timer_count++);
+  return 0;
+}
+
+static void minievent_timer_remove(struct event *ev) {
+  int i = ev->evx_timer_index;
+  struct event *last = minievent_timer_heap[--minievent_timer_count];
+  ev->evx_timer_index = -1;
+  if (last != ev) {
+    minievent_timer_heap[i] = last;
+    last->evx_timer_index = i;
+    if (i > 0 && MINIEVENT_TV_LT(
+        last->ev_expire, minievent_timer_heap[(i - 1) >> 1]->ev_expire)) {
+      minievent_timer_sift_up(i);
+    } else {
+      minievent_timer_sift_down(i);
+    }
+  }
+}
+
+/** Make the epoll registration of fd match minievent_fds[fd].mask. */
+static int minievent_update_fd(int fd, short old_mask) {
+  struct minievent_fd *mfd = &minievent_fds[fd];
+  struct epoll_event eev;
+  int op;
+  if (mfd->is_always_ready) {
+    minievent_always_ready_count += MINIEVENT_IS_LEVEL_READY(mfd->mask) -
+                                    MINIEVENT_IS_LEVEL_READY(old_mask);
+    if (mfd->mask == 0)
+      mfd->is_always_ready = 0;
+    return 0;
+  }
+  memset(&eev, '\0', sizeof eev);
+  eev.events = minievent_get_epoll_events(mfd->mask);
+  eev.data.fd = fd;
+  op = mfd->mask == 0 ? EPOLL_CTL_DEL :
+       old_mask == 0 ? EPOLL_CTL_ADD : EPOLL_CTL_MOD;
+  if (0 == epoll_ctl(minievent_epfd, op, fd, &eev))
+    return 0;
+  /* The fd may have been closed (and reopened) without event_del(), so the
+   * kernel has already dropped it from epoll.
+   */
+  if (op == EPOLL_CTL_DEL)
+    return 0;  /* Ignore EBADF and ENOENT. */
+  if (op == EPOLL_CTL_MOD && errno == ENOENT) {
+    op = EPOLL_CTL_ADD;
+  } else if (op == EPOLL_CTL_ADD && errno == EEXIST) {
+    op = EPOLL_CTL_MOD;
+  } else if (errno == EPERM && old_mask == 0) {
+    /* A regular file, which is always ready for select(2). */
+    mfd->is_always_ready = 1;
+    minievent_always_ready_count += MINIEVENT_IS_LEVEL_READY(mfd->mask);
+    return 0;
+  } else {
+    return -1;
+  }
+  return epoll_ctl(minievent_epfd, op, fd, &eev);
+}
+
+/** Return the mask of an fd after adding ev to its events. */
+static short minievent_get_added_mask(short old_mask, struct event *ev) {
+  short mask = (old_mask | ev->ev_events) & (EV_READ | EV_WRITE);
+  if ((old_mask == 0 || (old_mask & EV_ET)) && (ev->ev_events & EV_ET))
+    mask |= EV_ET;
+  return mask;
+}
+
+/** Make minievent_fds large enough for fd. */
+static int minievent_grow_fds(int fd) {
+  int new_count = minievent_fd_count < 64 ? 64 : minievent_fd_count;
+  struct minievent_fd *new_fds;
+  while (new_count <= fd)
+    new_count <<= 1;
+  new_fds = realloc(minievent_fds, new_count * sizeof*new_fds);
+  if (new_fds == NULL) {
+    errno = ENOMEM;
+    return -1;
+  }
+  memset(new_fds + minievent_fd_count, '\0',
+         (new_count - minievent_fd_count) * sizeof*new_fds);
+  minievent_fds = new_fds;
+  minievent_fd_count = new_count;
+  return 0;
+}
+
+int event_add(struct event *ev, const struct timeval *tv) {
+  if (ev->ev_flags & EVLIST_INSERTED)
+    event_del(ev);  /* Just update the timeout, like libevent. */
+  if (ev->ev_events & EV_SIGNAL) {
+    struct sigaction sa;
+    if (tv != NULL) {
+      fprintf(stderr, "minievent: timeout not supported for signals\n");
+      abort();
+    }
+    if (ev->ev_events & (EV_READ | EV_WRITE)) {
+      fprintf(stderr, "minievent: cannot combine EV_SIGNAL in event\n");
+      abort();
+    }
+    if (0 != minievent_open_signal_pipe())
+      return -1;
+    sa.sa_handler = minievent_signal_handler;
+    /* See the comment in coio_minievent.c about SA_RESTART. */
+    sa.sa_flags = (ev->ev_fd == SIGCHLD) ? SA_NOCLDSTOP | SA_RESTART
+                                         : SA_RESTART;
+    sigemptyset(&sa.sa_mask);
+    if (0 != sigaction(/*signum:*/ev->ev_fd, &sa, NULL))
+      return -1;
+    ev->evx_prev = NULL;
+    ev->evx_next = minievent_signal_first;
+    if (minievent_signal_first != NULL)
+      minievent_signal_first->evx_prev = ev;
+    minievent_signal_first = ev;
+  } else if (ev->ev_events & (EV_READ | EV_WRITE)) {
+    int fd = ev->ev_fd;
+    struct minievent_fd *mfd;
+    short old_mask;
+    if (fd < 0) {
+      errno = EBADF;
+      return -1;
+    }
+    if (fd >= minievent_fd_count && 0 != minievent_grow_fds(fd))
+      return -1;
+    mfd = &minievent_fds[fd];
+    old_mask = mfd->mask;
+    mfd->mask = minievent_get_added_mask(old_mask, ev);
+    if (mfd->mask != old_mask && 0 != minievent_update_fd(fd, old_mask)) {
+      mfd->mask = old_mask;
+      return -1;
+    }
+    ev->evx_next = NULL;
+    ev->evx_prev = mfd->last;
+    if (mfd->last != NULL) {
+      mfd->last->evx_next = ev;
+    } else {
+      mfd->first = ev;
+    }
+    mfd->last = ev;
+  }
+  ev->ev_flags |= EVLIST_INSERTED;
+  ++minievent_event_count;
+  if (ev->ev_flags & EVLIST_INTERNAL)
+    ++minievent_internal_event_count;
+  if (tv != NULL && tv->tv_sec < MINIEVENT_HIGH_SEC) {
+    if (gettimeofday(&ev->ev_expire, NULL) != 0) {
+      event_del(ev);
+      return -1;
+    }
+    ev->ev_timeout = *tv;
+    ev->ev_expire.tv_sec  += tv->tv_sec;
+    ev->ev_expire.tv_usec += tv->tv_usec;
+    MINIEVENT_FIX_TV_AFTER_ADD(ev->ev_expire);
+    if (0 != minievent_timer_push(ev)) {
+      event_del(ev);
+      return -1;
+    }
+    ev->ev_flags |= EVLIST_TIMEOUT;
+  } else {
+    ev->ev_timeout.tv_sec = MINIEVENT_HIGH_SEC;
+    ev->ev_timeout.tv_usec = 0;
+    ev->ev_expire.tv_sec = MINIEVENT_HIGH_SEC;
+    ev->ev_expire.tv_usec = 0;
+  }
+  return 0;
+}
+
+int event_del(struct event *ev) {
+  if (!(ev->ev_flags & EVLIST_INSERTED))
+    return 0;
+  if (ev == minievent_loop_ev)
+    minievent_loop_ev = ev->evx_next;
+  if (ev->ev_events & EV_SIGNAL) {
+    struct sigaction sa;
+    /* TODO(pts): Restore previous value (before event_add). */
+    sa.sa_handler = SIG_DFL;
+    sa.sa_flags = (ev->ev_fd == SIGCHLD) ? SA_NOCLDSTOP | SA_RESTART
+                                         : SA_RESTART;
+    sigemptyset(&sa.sa_mask);
+    sigaction(/*signum:*/ev->ev_fd, &sa, NULL);  /* Ignore return value. */
+    if (ev->evx_prev != NULL) {
+      ev->evx_prev->evx_next = ev->evx_next;
+    } else {
+      minievent_signal_first = ev->evx_next;
+    }
+    if (ev->evx_next != NULL)
+      ev->evx_next->evx_prev = ev->evx_prev;
+  } else if (ev->ev_events & (EV_READ | EV_WRITE)) {
+    struct minievent_fd *mfd = &minievent_fds[ev->ev_fd];
+    struct event *ev2;
+    short old_mask = mfd->mask;
+    if (ev->evx_prev != NULL) {
+      ev->evx_prev->evx_next = ev->evx_next;
+    } else {
+      mfd->first = ev->evx_next;
+    }
+    if (ev->evx_next != NULL) {
+      ev->evx_next->evx_prev = ev->evx_prev;
+    } else {
+      mfd->last = ev->evx_prev;
+    }
+    mfd->mask = 0;
+    for (ev2 = mfd->first; ev2 != NULL; ev2 = ev2->evx_next)
+      mfd->mask = minievent_get_added_mask(mfd->mask, ev2);
+    if (mfd->mask != old_mask)
+      minievent_update_fd(ev->ev_fd, old_mask);  /* Ignore errors. */
+  }
+  if (ev->ev_flags & EVLIST_TIMEOUT)
+    minievent_timer_remove(ev);
+  ev->evx_next = ev->evx_prev = NULL;
+  --minievent_event_count;
+  if (ev->ev_flags & EVLIST_INTERNAL)
+    --minievent_internal_event_count;
+  ev->ev_flags &= ~(EVLIST_INSERTED | EVLIST_TIMEOUT);
+  return 0;
+}
+
+/** Run the callback of ev, which has fired with fire_events. */
+static void minievent_fire(struct event *ev, short fire_events) {
+  if (ev->ev_events & EV_PERSIST) {
+    if (ev->ev_flags & EVLIST_TIMEOUT) {
+      ev->ev_expire.tv_sec  += ev->ev_timeout.tv_sec;
+      ev->ev_expire.tv_usec += ev->ev_timeout.tv_usec;
+      MINIEVENT_FIX_TV_AFTER_ADD(ev->ev_expire);
+      minievent_timer_sift_down(ev->evx_timer_index);
+    }
+  } else {
+    event_del(ev);
+  }
+  ev->ev_callback(ev->ev_fd, fire_events, ev->ev_arg);
+}
+
+/** Fire the events of fd matching got_events (EV_READ | EV_WRITE). */
+static void minievent_dispatch_fd(int fd, short got_events) {
+  struct event *ev;
+  short events, fire_events;
+  if (fd >= minievent_fd_count)
+    return;
+  for (ev = minievent_fds[fd].first; ev != NULL; ev = minievent_loop_ev) {
+    minievent_loop_ev = ev->evx_next;
+    events = ev->ev_events;
+    if ((events & (EV_READ | EV_WRITE)) == (EV_READ | EV_WRITE)) {
+      fire_events = got_events;
+    } else {
+      fire_events = events & got_events;
+    }
+    if (fire_events != 0)
+      minievent_fire(ev, fire_events);
+  }
+  minievent_loop_ev = NULL;
+}
+
+/* Return 0 if there are events registered with EVLOOP_ONCE, 1 if there are
+ * no more events registered.
+ *
+ * This function and all other functions in this file are not thread-safe or
+ * reentrant.
+ */
+int event_loop(int flags) {
+  struct event *ev;
+  struct timeval expire;
+  struct timeval now;
+  int got, i, fd, timeout_ms;
+  unsigned revents;
+  minievent_signal_mask_t interesting_signal_mask, got_signal_mask;
+  char buf[64];
+  if ((flags & EVLOOP_NONBLOCK) && !(flags & EVLOOP_ONCE)) {
+    fprintf(stderr, "minievent: EVLOOP_NONBLOCK but not EVLOOP_ONCE\n");
+    abort();
+  }
+  if (minievent_is_in_loop) {
+    fprintf(stderr, "minievent: event_loop() already in progress\n");
+    abort();
+  }
+  do {
+    /* This doesn't make sense for internal events, but we keep it for
+     * libevent 1.4.13 compatibility, see also coio_minievent.c.
+     */
+    if (minievent_event_count == minievent_internal_event_count)
+      return 1;
+    interesting_signal_mask = 0;
+    for (ev = minievent_signal_first; ev != NULL; ev = ev->evx_next)
+      interesting_signal_mask |= 1L << ev->ev_fd;
+    if ((flags & EVLOOP_NONBLOCK) || minievent_always_ready_count > 0 ||
+        (minievent_got_signal_mask & interesting_signal_mask)) {
+      timeout_ms = 0;
+    } else if (minievent_timer_count == 0) {
+      timeout_ms = -1;
+    } else {
+      expire = minievent_timer_heap[0]->ev_expire;
+      if (gettimeofday(&now, NULL) != 0)
+        return -1;
+      if (!MINIEVENT_TV_LT(now, expire)) {
+        timeout_ms = 0;
+      } else {
+        if (expire.tv_sec - now.tv_sec > 1000000L) {
+          timeout_ms = 1000000000;  /* Avoid overflow. */
+        } else {
+          /* Round up, so we don't wake up too early. */
+          timeout_ms = ((expire.tv_sec - now.tv_sec) * 1000000L +
+                        (expire.tv_usec - now.tv_usec) + 999) / 1000;
+        }
+      }
+    }
+    minievent_is_in_loop = 1;
+    got = epoll_wait(minievent_epfd, minievent_epoll_events,
+                     MINIEVENT_MAX_EPOLL_EVENTS, timeout_ms);
+    if (got < 0) {
+      if (errno != EINTR) {
+        minievent_is_in_loop = 0;
+        return -1;
+      }
+      got = 0;  /* A signal may have arrived. */
+    }
+    for (i = 0; i < got; ++i) {
+      fd = minievent_epoll_events[i].data.fd;
+      if (fd == minievent_signal_pipe[0]) {
+        while (read(fd, buf, sizeof buf) > 0) {}
+        continue;
+      }
+      revents = minievent_epoll_events[i].events;
+      minievent_dispatch_fd(fd,
+          (revents & (EPOLLIN | EPOLLERR | EPOLLHUP) ? EV_READ : 0) |
+          (revents & (EPOLLOUT | EPOLLERR | EPOLLHUP) ? EV_WRITE : 0));
+    }
+    if (minievent_always_ready_count > 0) {
+      for (fd = 0; fd < minievent_fd_count; ++fd) {
+        if (minievent_fds[fd].is_always_ready &&
+            MINIEVENT_IS_LEVEL_READY(minievent_fds[fd].mask))
+          minievent_dispatch_fd(fd, EV_READ | EV_WRITE);
+      }
+    }
+    got_signal_mask = minievent_got_signal_mask;
+    if (got_signal_mask != 0) {
+      for (ev = minievent_signal_first; ev != NULL; ev = minievent_loop_ev) {
+        minievent_loop_ev = ev->evx_next;
+        if (got_signal_mask & 1L << ev->ev_fd) {
+          /* This doesn't contain a race condition, because we use the copy
+           * (got_signal_mask) to decide which event handlers to run.
+           */
+          minievent_got_signal_mask &= ~(1L << ev->ev_fd);
+          minievent_fire(ev, EV_SIGNAL);
+        }
+      }
+      minievent_loop_ev = NULL;
+    }
+    if (minievent_timer_count > 0) {
+      if (gettimeofday(&now, NULL) != 0) {
+        minievent_is_in_loop = 0;
+        return -1;
+      }
+      /* Limit the number of callbacks, because an EV_PERSIST event with a
+       * zero timeout would stay expired.
+       */
+      for (i = minievent_timer_count; i > 0 && minievent_timer_count > 0 &&
+           !MINIEVENT_TV_LT(now, minievent_timer_heap[0]->ev_expire); --i) {
+        minievent_fire(minievent_timer_heap[0], EV_TIMEOUT);
+      }
+    }
+    minievent_is_in_loop = 0;
+  } while (!(flags & EVLOOP_ONCE));
+  return 0;
+}
@@ -0,0 +1,839 @@
+/*
+ * coio_minievent_uring.c: io_uring(7)-based variant of coio_minievent.c
+ * (Linux >= 5.5)
+ *
+ * This file implements the same API (coio_minievent.h) as coio_minievent.c
+ * and coio_minievent_epoll.c, and setup.py uses it instead of them if
+ * SYNCLESS_USE_URING=1 is set. There is no liburing dependency, the rings
+ * are set up with the raw system calls.
+ *
+ * Each fd event added by event_add() becomes an IORING_OP_POLL_ADD (a
+ * one-shot poll) submission, and event_del() of a pending one becomes an
+ * IORING_OP_POLL_REMOVE submission. These are not submitted one by one,
+ * but they are collected in the submission queue, and event_loop()
+ * submits all of them and waits for the completions in a single
+ * io_uring_enter(2) call, instead of an epoll_ctl(2) per change plus an
+ * epoll_wait(2). The nearest timeout (from the same binary min-heap as in
+ * coio_minievent_epoll.c) is submitted as an IORING_OP_TIMEOUT in the same
+ * call. Completions are reaped in a batch from the completion queue, and
+ * the callbacks are run then. Since the kernel posts the completions to
+ * the shared completion queue, event_loop(EVLOOP_ONCE | EVLOOP_NONBLOCK)
+ * doesn't need any system call if it has nothing to submit.
+ *
+ * A poll submission refers to its event through a slot index (in
+ * user_data), because event_del() can't wait for the completion of the
+ * removed poll, and the struct event may be freed or reused meanwhile.
+ *
+ * Signals are delivered using a self-pipe, polled like other fds.
+ *
+ * Regular files are reported ready by the kernel's poll.
+ */
+
+#include "./coio_minievent.h"
+
+#include <linux/io_uring.h>
+#include <sys/mman.h>
+#include <sys/syscall.h>
+#include <sys/time.h>
+#include <endian.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <poll.h>
+#include <signal.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+
+/* Constants copied from event.h in libevent1 1.4.13, for ev_flags. */
+#define EVLIST_TIMEOUT  0x01
+#define EVLIST_INSERTED 0x02
+
+#define MINIEVENT_HIGH_SEC (0x7fffffffL)
+#define MINIEVENT_FIX_TV_AFTER_ADD(tv) do { \
+  if ((tv).tv_usec >= 1000000L) { (tv).tv_usec -= 1000000L; ++(tv).tv_sec; } \
+} while (0)
+#define MINIEVENT_TV_LT(tva, tvb) \
+    ((tva).tv_sec < (tvb).tv_sec || \
+     ((tva).tv_sec == (tvb).tv_sec && (tva).tv_usec < (tvb).tv_usec))
+
+/** Number of submission queue entries. If the submission queue gets full,
+ * it is submitted before event_loop().
+ */
+#define MINIEVENT_URING_ENTRIES 256
+/* The completion queue is larger, because many polls may complete at the
+ * same time.
+ */
+#define MINIEVENT_URING_CQ_ENTRIES (MINIEVENT_URING_ENTRIES * 8)
+
+/* Not all kernels and headers have these. */
+#ifndef IORING_SETUP_COOP_TASKRUN
+#define IORING_SETUP_COOP_TASKRUN (1U << 8)
+#endif
+#ifndef IORING_SETUP_TASKRUN_FLAG
+#define IORING_SETUP_TASKRUN_FLAG (1U << 9)
+#endif
+#ifndef IORING_SETUP_SINGLE_ISSUER
+#define IORING_SETUP_SINGLE_ISSUER (1U << 12)
+#endif
+#ifndef IORING_SETUP_DEFER_TASKRUN
+#define IORING_SETUP_DEFER_TASKRUN (1U << 13)
+#endif
+#ifndef IORING_SQ_TASKRUN
+#define IORING_SQ_TASKRUN (1U << 2)
+#endif
+
+/* user_data values of submissions not belonging to an event. */
+#define MINIEVENT_UD_IGNORE      0  /* IORING_OP_POLL_REMOVE, _TIMEOUT */
+#define MINIEVENT_UD_SIGNAL_PIPE 1
+/* user_data is MINIEVENT_UD_SLOT_BASE + the slot index for event polls. */
+#define MINIEVENT_UD_SLOT_BASE   2
+
+/** A poll submitted for an event. */
+struct minievent_slot {
+  /* The event, or NULL if event_del() has removed it (then the slot is
+   * freed when the completion of the poll arrives).
+   */
+  struct event *ev;
+  /* Index of the next free slot, or -1. */
+  int next_free;
+};
+
+/** The io_uring instance with its mapped rings. */
+struct minievent_ring {
+  int fd;
+  unsigned *sq_head;
+  unsigned *sq_tail;
+  unsigned *sq_flags;
+  unsigned sq_mask;
+  unsigned sq_entries;
+  /* Includes the submissions not yet published to the kernel. */
+  unsigned sq_tail_local;
+  struct io_uring_sqe *sqes;
+  unsigned *cq_head;
+  unsigned *cq_tail;
+  unsigned cq_mask;
+  struct io_uring_cqe *cqes;
+  void *sq_map;
+  size_t sq_map_size;
+  void *cq_map;  /* May be the same as sq_map. */
+  size_t cq_map_size;
+  size_t sqes_map_size;
+};
+
+static struct minievent_ring minievent_ring = {-1};
+static struct minievent_slot *minievent_slots = NULL;
+static int minievent_slot_count = 0;
+static int minievent_first_free_slot = -1;
+/* Doubly linked list (using evx_next and evx_prev) of EV_SIGNAL events. */
+static struct event *minievent_signal_first = NULL;
+/* Binary min-heap of the events with a timeout, ordered by ev_expire. The
+ * children of minievent_timer_heap[i] are at 2 * i + 1 and 2 * i + 2.
+ */
+static struct event **minievent_timer_heap = NULL;
+static int minievent_timer_count = 0;
+static int minievent_timer_capacity = 0;
+static int minievent_event_count = 0;
+static int minievent_internal_event_count = 0;
+/* The next signal event to visit by event_loop(), updated by event_del(). */
+static struct event *minievent_loop_ev = NULL;
+static char minievent_is_in_loop = 0;
+/* The relative timeout of the IORING_OP_TIMEOUT submitted by event_loop().
+ * The kernel reads it when the submission is consumed.
+ */
+static struct __kernel_timespec minievent_timeout_ts;
+
+typedef unsigned minievent_signal_mask_t;
+
+static volatile minievent_signal_mask_t minievent_got_signal_mask = 0;
+static int minievent_signal_pipe[2] = {-1, -1};
+
+static void minievent_signal_handler(int signum) {
+  int saved_errno = errno;
+  minievent_got_signal_mask |= 1L << signum;
+  /* Wake up io_uring_enter(2) in event_loop(). If the pipe is full, there
+   * is a pending wakeup already.
+   */
+  if (minievent_signal_pipe[1] >= 0)
+    (void)!write(minievent_signal_pipe[1], "", 1);
+  errno = saved_errno;
+}
+
+const char *event_get_version(void) {
+  return "0.02";
+}
+const char *event_get_method(void) {
+  return "minievent-uring";
+}
+
+static int minievent_set_cloexec_nonblock(int fd) {
+  int flags = fcntl(fd, F_GETFL);
+  if (flags < 0 || fcntl(fd, F_SETFL, flags | O_NONBLOCK) < 0)
+    return -1;
+  return fcntl(fd, F_SETFD, FD_CLOEXEC);
+}
+
+static void minievent_ring_close(void) {
+  struct minievent_ring *ring = &minievent_ring;
+  if (ring->fd < 0)
+    return;
+  munmap(ring->sqes, ring->sqes_map_size);
+  if (ring->cq_map != ring->sq_map)
+    munmap(ring->cq_map, ring->cq_map_size);
+  munmap(ring->sq_map, ring->sq_map_size);
+  close(ring->fd);
+  ring->fd = -1;
+}
+
+/** Create and map a new io_uring instance to minievent_ring. */
+static int minievent_ring_open(void) {
+  struct minievent_ring *ring = &minievent_ring;
+  /* The kernel doesn't have to interrupt us to post the completions,
+   * because event_loop() calls io_uring_enter(2) (which runs the deferred
+   * work) before waiting, or if IORING_SQ_TASKRUN is set. Older kernels
+   * reject the newer flags with EINVAL.
+   */
+  static const unsigned setup_flags_ary[] = {
+      IORING_SETUP_CQSIZE | IORING_SETUP_SINGLE_ISSUER |
+      IORING_SETUP_DEFER_TASKRUN | IORING_SETUP_TASKRUN_FLAG,
+      IORING_SETUP_CQSIZE | IORING_SETUP_COOP_TASKRUN |
+      IORING_SETUP_TASKRUN_FLAG,
+      IORING_SETUP_CQSIZE,
+  };
+  struct io_uring_params p;
+  unsigned i;
+  int fd;
+  char *sq_map;
+  char *cq_map;
+  for (i = 0; ; ++i) {
+    memset(&p, '\0', sizeof p);
+    p.flags = setup_flags_ary[i];
+    p.cq_entries = MINIEVENT_URING_CQ_ENTRIES;
+    if ((fd = syscall(__NR_io_uring_setup, MINIEVENT_URING_ENTRIES, &p)) >= 0)
+      break;
+    if (errno != EINVAL ||
+        i + 1 == sizeof setup_flags_ary / sizeof setup_flags_ary[0])
+      return -1;
+  }
+  /* The io_uring fd is already close-on-exec. */
+  ring->sq_map_size = p.sq_off.array + p.sq_entries * sizeof(unsigned);
+  ring->cq_map_size = p.cq_off.cqes +
+                      p.cq_entries * sizeof(struct io_uring_cqe);
+  if (p.features & IORING_FEAT_SINGLE_MMAP) {
+    if (ring->sq_map_size < ring->cq_map_size)
+      ring->sq_map_size = ring->cq_map_size;
+    ring->cq_map_size = ring->sq_map_size;
+  }
+  ring->sqes_map_size = p.sq_entries * sizeof(struct io_uring_sqe);
+  sq_map = mmap(NULL, ring->sq_map_size, PROT_READ | PROT_WRITE,
+                MAP_SHARED | MAP_POPULATE, fd, IORING_OFF_SQ_RING);
+  if (sq_map == MAP_FAILED)
+    goto error_close;
+  if (p.features & IORING_FEAT_SINGLE_MMAP) {
+    cq_map = sq_map;
+  } else {
+    cq_map = mmap(NULL, ring->cq_map_size, PROT_READ | PROT_WRITE,
+                  MAP_SHARED | MAP_POPULATE, fd, IORING_OFF_CQ_RING);
+    if (cq_map == MAP_FAILED)
+      goto error_unmap_sq;
+  }
+  ring->sqes = mmap(NULL, ring->sqes_map_size, PROT_READ | PROT_WRITE,
+                    MAP_SHARED | MAP_POPULATE, fd, IORING_OFF_SQES);
+  if (ring->sqes == MAP_FAILED)
+    goto error_unmap_cq;
+  ring->fd = fd;
+  ring->sq_map = sq_map;
+  ring->cq_map = cq_map;
+  ring->sq_head = (unsigned*)(sq_map + p.sq_off.head);
+  ring->sq_tail = (unsigned*)(sq_map + p.sq_off.tail);
+  ring->sq_flags = (unsigned*)(sq_map + p.sq_off.flags);
+  ring->sq_mask = *(unsigned*)(sq_map + p.sq_off.ring_mask);
+  ring->sq_entries = *(unsigned*)(sq_map + p.sq_off.ring_entries);
+  ring->sq_tail_local = *ring->sq_tail;
+  /* We use the submission queue entries in order. */
+  for (i = 0; i < ring->sq_entries; ++i)
+    ((unsigned*)(sq_map + p.sq_off.array))[i] = i;
+  ring->cq_head = (unsigned*)(cq_map + p.cq_off.head);
+  ring->cq_tail = (unsigned*)(cq_map + p.cq_off.tail);
+  ring->cq_mask = *(unsigned*)(cq_map + p.cq_off.ring_mask);
+  ring->cqes = (struct io_uring_cqe*)(cq_map + p.cq_off.cqes);
+  return 0;
+ error_unmap_cq:
+  if (cq_map != sq_map)
+    munmap(cq_map, ring->cq_map_size);
+ error_unmap_sq:
+  munmap(sq_map, ring->sq_map_size);
+ error_close:
+  close(fd);
+  return -1;
+}
+
+/** Submit the queued submissions, and wait for min_complete completions
+ * (at most 1, but a signal may interrupt the wait).
+ */
+static int minievent_ring_enter(unsigned min_complete) {
+  struct minievent_ring *ring = &minievent_ring;
+  unsigned to_submit;
+  __atomic_store_n(ring->sq_tail, ring->sq_tail_local, __ATOMIC_RELEASE);
+  to_submit = ring->sq_tail_local -
+              __atomic_load_n(ring->sq_head, __ATOMIC_ACQUIRE);
+  if (0 > syscall(__NR_io_uring_enter, ring->fd, to_submit, min_complete,
+                  IORING_ENTER_GETEVENTS, NULL, 0) &&
+      errno != EINTR && errno != EAGAIN && errno != EBUSY) {
+    return -1;
+  }
+  return 0;
+}
+
+/** Return a cleared submission queue entry, to be submitted by the next
+ * minievent_ring_enter(). Return NULL on error.
+ */
+static struct io_uring_sqe *minievent_get_sqe(void) {
+  struct minievent_ring *ring = &minievent_ring;
+  struct io_uring_sqe *sqe;
+  if (ring->sq_tail_local - __atomic_load_n(ring->sq_head, __ATOMIC_ACQUIRE)
+      >= ring->sq_entries) {
+    /* The submission queue is full, submit it early. */
+    if (0 != minievent_ring_enter(0))
+      return NULL;
+    if (ring->sq_tail_local - __atomic_load_n(ring->sq_head, __ATOMIC_ACQUIRE)
+        >= ring->sq_entries) {
+      errno = EBUSY;
+      return NULL;
+    }
+  }
+  sqe = &ring->sqes[ring->sq_tail_local & ring->sq_mask];
+  memset(sqe, '\0', sizeof*sqe);
+  ++ring->sq_tail_local;
+  return sqe;
+}
+
+/** Submit a poll for the event in slot i. */
+static int minievent_submit_poll(int i) {
+  struct event *ev = minievent_slots[i].ev;
+  struct io_uring_sqe *sqe = minievent_get_sqe();
+  unsigned poll_events;
+  if (sqe == NULL)
+    return -1;
+  poll_events = (ev->ev_events & EV_READ ? POLLIN : 0) |
+                (ev->ev_events & EV_WRITE ? POLLOUT : 0);
+#if __BYTE_ORDER == __BIG_ENDIAN
+  poll_events = poll_events << 16 | poll_events >> 16;
+#endif
+  sqe->opcode = IORING_OP_POLL_ADD;
+  sqe->fd = ev->ev_fd;
+  sqe->poll32_events = poll_events;
+  sqe->user_data = MINIEVENT_UD_SLOT_BASE + i;
+  return 0;
+}
+
+/** Submit the poll of the signal pipe (which must be open). */
+static int minievent_submit_signal_pipe_poll(void) {
+  struct io_uring_sqe *sqe = minievent_get_sqe();
+  if (sqe == NULL)
+    return -1;
+  sqe->opcode = IORING_OP_POLL_ADD;
+  sqe->fd = minievent_signal_pipe[0];
+  sqe->poll32_events = POLLIN;
+#if __BYTE_ORDER == __BIG_ENDIAN
+  sqe->poll32_events = POLLIN << 16;
+#endif
+  sqe->user_data = MINIEVENT_UD_SIGNAL_PIPE;
+  return 0;
+}
+
+/** Allocate a slot for ev, return its index, or -1 on error. */
+static int minievent_slot_alloc(struct event *ev) {
+  int i;
+  if (minievent_first_free_slot < 0) {
+    int new_count = minievent_slot_count < 64 ? 64 : minievent_slot_count * 2;
+    struct minievent_slot *new_slots = realloc(
+        minievent_slots, new_count * sizeof*new_slots);
+    if (new_slots == NULL) {
+      errno = ENOMEM;
+      return -1;
+    }
+    for (i = new_count - 1; i >= minievent_slot_count; --i) {
+      new_slots[i].ev = NULL;
+      new_slots[i].next_free = minievent_first_free_slot;
+      minievent_first_free_slot = i;
+    }
+    minievent_slots = new_slots;
+    minievent_slot_count = new_count;
+  }
+  i = minievent_first_free_slot;
+  minievent_first_free_slot = minievent_slots[i].next_free;
+  minievent_slots[i].ev = ev;
+  return i;
+}
+
+static void minievent_slot_free(int i) {
+  minievent_slots[i].ev = NULL;
+  minievent_slots[i].next_free = minievent_first_free_slot;
+  minievent_first_free_slot = i;
+}
+
+/** Forget all slots. */
+static void minievent_slots_reset(void) {
+  int i;
+  minievent_first_free_slot = -1;
+  for (i = minievent_slot_count - 1; i >= 0; --i)
+    minievent_slot_free(i);
+}
+
+static void minievent_close_signal_pipe(void) {
+  if (minievent_signal_pipe[0] >= 0) {
+    close(minievent_signal_pipe[0]);
+    close(minievent_signal_pipe[1]);
+    minievent_signal_pipe[0] = minievent_signal_pipe[1] = -1;
+  }
+}
+
+/** Create the signal self-pipe (if not created yet), and poll it. */
+static int minievent_open_signal_pipe(void) {
+  int fds[2];
+  if (minievent_signal_pipe[0] >= 0)
+    return 0;
+  if (0 != pipe(fds))
+    return -1;
+  if (0 != minievent_set_cloexec_nonblock(fds[0]) ||
+      0 != minievent_set_cloexec_nonblock(fds[1])) {
+    close(fds[0]);
+    close(fds[1]);
+    return -1;
+  }
+  minievent_signal_pipe[0] = fds[0];
+  minievent_signal_pipe[1] = fds[1];
+  if (0 != minievent_submit_signal_pipe_poll()) {
+    minievent_close_signal_pipe();
+    return -1;
+  }
+  return 0;
+}
+
+struct event_base *event_init(void) {
+  /* Forget about all events, if any; this is compatible to libevent1 */
+  minievent_ring_close();
+  minievent_close_signal_pipe();
+  if (0 != minievent_ring_open())
+    return NULL;
+  minievent_slots_reset();
+  minievent_signal_first = NULL;
+  minievent_timer_count = 0;
+  minievent_event_count = minievent_internal_event_count = 0;
+  return (struct event_base*)1;
+}
+
+/** Recreate the io_uring instance and the signal pipe, e.g. after a fork(),
+ * so the parent and the child don't share them, and resubmit the polls.
+ */
+int event_reinit(struct event_base *base) {
+  int i;
+  char had_signal_pipe = minievent_signal_pipe[0] >= 0;
+  (void)base;
+  minievent_ring_close();
+  minievent_close_signal_pipe();
+  if (0 != minievent_ring_open())
+    return -1;
+  if (had_signal_pipe && 0 != minievent_open_signal_pipe())
+    return -1;
+  /* The completions of the removed polls won't arrive, so free their
+   * slots as well.
+   */
+  minievent_first_free_slot = -1;
+  for (i = minievent_slot_count - 1; i >= 0; --i) {
+    if (minievent_slots[i].ev == NULL) {
+      minievent_slot_free(i);
+    } else if (0 != minievent_submit_poll(i)) {
+      return -1;
+    }
+  }
+  return 0;
+}
+
+void event_base_free(struct event_base *base) {
+  (void)base;
+}
+
+void event_set(struct event *ev, int fd,
+               short events, void (*cb)(int, short, void *), void *arg) {
+  ev->evx_next = ev->evx_prev = NULL;
+  ev->evx_timer_index = -1;
+  ev->evx_slot_index = -1;
+  ev->ev_fd = fd;
+  ev->ev_events = events;
+  /* do not set ev->ev_timeout */
+  ev->ev_callback = cb;
+  ev->ev_arg = arg;
+  ev->ev_flags = 0;
+}
+
+int event_pending(struct event *ev, short events, struct timeval *tv) {
+  if (tv != NULL) {
+    fprintf(stderr, "minievent: got timeout for event_pending\n");
+    abort();
+  }
+  return (ev->ev_flags & EVLIST_INSERTED) && (ev->ev_events & events);
+}
+
+/** Move the event at index i of the timer heap up to its place. */
+static void minievent_timer_sift_up(int i) {
+  struct event **heap = minievent_timer_heap;
+  struct event *ev = heap[i];
+  int parent;
+  while (i > 0) {
+    parent = (i - 1) >> 1;
+    if (!MINIEVENT_TV_LT(ev->ev_expire, heap[parent]->ev_expire))
+      break;
+    heap[i] = heap[parent];
+    heap[i]->evx_timer_index = i;
+    i = parent;
+  }
+  heap[i] = ev;
+  ev->evx_timer_index = i;
+}
+
+/** Move the event at index i of the timer heap down to its place. */
+static void minievent_timer_sift_down(int i) {
+  struct event **heap = minievent_timer_heap;
+  struct event *ev = heap[i];
+  int n = minievent_timer_count;
+  int child;
+  while ((child = 2 * i + 1) < n) {
+    if (child + 1 < n &&
+        MINIEVENT_TV_LT(heap[child + 1]->ev_expire, heap[child]->ev_expire))
+      ++child;
+    if (!MINIEVENT_TV_LT(heap[child]->ev_expire, ev->ev_expire))
+      break;
+    heap[i] = heap[child];
+    heap[i]->evx_timer_index = i;
+    i = child;
+  }
+  heap[i] = ev;
+  ev->evx_timer_index = i;
+}
+
+static int minievent_timer_push(struct event *ev) {
+  if (minievent_timer_count == minievent_timer_capacity) {
+    int new_capacity = minievent_timer_capacity < 64 ?
+        64 : minievent_timer_capacity << 1;
+    struct event **new_heap = realloc(
+        minievent_timer_heap, new_capacity * sizeof*new_heap);
+    if (new_heap == NULL) {
+      errno = ENOMEM;
+      return -1;
+    }
+    minievent_timer_heap = new_heap;
+    minievent_timer_capacity = new_capacity;
+  }
+  minievent_timer_heap[minievent_timer_count] = ev;
+  minievent_timer_sift_up(minievent_timer_count++);
+  return 0;
+}
+
+static void minievent_timer_remove(struct event *ev) {
+  int i = ev->evx_timer_index;
+  struct event *last = minievent_timer_heap[--minievent_timer_count];
+  ev->evx_timer_index = -1;
+  if (last != ev) {
+    minievent_timer_heap[i] = last;
+    last->evx_timer_index = i;
+    if (i > 0 && MINIEVENT_TV_LT(
+        last->ev_expire, minievent_timer_heap[(i - 1) >> 1]->ev_expire)) {
+      minievent_timer_sift_up(i);
+    } else {
+      minievent_timer_sift_down(i);
+    }
+  }
+}
+
+
+int event_add(struct event *ev, const struct timeval *tv) {
+  if (ev->ev_flags & EVLIST_INSERTED)
+    event_del(ev);  /* Just update the timeout, like libevent. */
+  if (ev->ev_events & EV_SIGNAL) {
+    struct sigaction sa;
+    if (tv != NULL) {
+      fprintf(stderr, "minievent: timeout not supported for signals\n");
+      abort();
+    }
+    if (ev->ev_events & (EV_READ | EV_WRITE)) {
+      fprintf(stderr, "minievent: cannot combine EV_SIGNAL in event\n");
+      abort();
+    }
+    if (0 != minievent_open_signal_pipe())
+      return -1;
+    sa.sa_handler = minievent_signal_handler;
+    /* See the comment in coio_minievent.c about SA_RESTART. */
+    sa.sa_flags = (ev->ev_fd == SIGCHLD) ? SA_NOCLDSTOP | SA_RESTART
+                                         : SA_RESTART;
+    sigemptyset(&sa.sa_mask);
+    if (0 != sigaction(/*signum:*/ev->ev_fd, &sa, NULL))
+      return -1;
+    ev->evx_prev = NULL;
+    ev->evx_next = minievent_signal_first;
+    if (minievent_signal_first != NULL)
+      minievent_signal_first->evx_prev = ev;
+    minievent_signal_first = ev;
+  } else if (ev->ev_events & (EV_READ | EV_WRITE)) {
+    int i;
+    if (ev->ev_fd < 0) {
+      errno = EBADF;
+      return -1;
+    }
+    if ((i = minievent_slot_alloc(ev)) < 0)
+      return -1;
+    if (0 != minievent_submit_poll(i)) {
+      minievent_slot_free(i);
+      return -1;
+    }
+    ev->evx_slot_index = i;
+  }
+  ev->ev_flags |= EVLIST_INSERTED;
+  ++minievent_event_count;
+  if (ev->ev_flags & EVLIST_INTERNAL)
+    ++minievent_internal_event_count;
+  if (tv != NULL && tv->tv_sec < MINIEVENT_HIGH_SEC) {
+    if (gettimeofday(&ev->ev_expire, NULL) != 0) {
+      event_del(ev);
+      return -1;
+    }
+    ev->ev_timeout = *tv;
+    ev->ev_expire.tv_sec  += tv->tv_sec;
+    ev->ev_expire.tv_usec += tv->tv_usec;
+    MINIEVENT_FIX_TV_AFTER_ADD(ev->ev_expire);
+    if (0 != minievent_timer_push(ev)) {
+      event_del(ev);
+      return -1;
+    }
+    ev->ev_flags |= EVLIST_TIMEOUT;
+  } else {
+    ev->ev_timeout.tv_sec = MINIEVENT_HIGH_SEC;
+    ev->ev_timeout.tv_usec = 0;
+    ev->ev_expire.tv_sec = MINIEVENT_HIGH_SEC;
+    ev->ev_expire.tv_usec = 0;
+  }
+  return 0;
+}
+
+int event_del(struct event *ev) {
+  if (!(ev->ev_flags & EVLIST_INSERTED))
+    return 0;
+  if (ev->ev_events & EV_SIGNAL) {
+    struct sigaction sa;
+    if (ev == minievent_loop_ev)
+      minievent_loop_ev = ev->evx_next;
+    /* TODO(pts): Restore previous value (before event_add). */
+    sa.sa_handler = SIG_DFL;
+    sa.sa_flags = (ev->ev_fd == SIGCHLD) ? SA_NOCLDSTOP | SA_RESTART
+                                         : SA_RESTART;
+    sigemptyset(&sa.sa_mask);
+    sigaction(/*signum:*/ev->ev_fd, &sa, NULL);  /* Ignore return value. */
+    if (ev->evx_prev != NULL) {
+      ev->evx_prev->evx_next = ev->evx_next;
+    } else {
+      minievent_signal_first = ev->evx_next;
+    }
+    if (ev->evx_next != NULL)
+      ev->evx_next->evx_prev = ev->evx_prev;
+    ev->evx_next = ev->evx_prev = NULL;
+  } else if (ev->evx_slot_index >= 0) {
+    /* The slot is freed when the completion of the poll arrives. If we can't
+     * remove the poll, it will complete when the fd becomes ready.
+     */
+    struct io_uring_sqe *sqe = minievent_get_sqe();
+    minievent_slots[ev->evx_slot_index].ev = NULL;
+    if (sqe != NULL) {
+      sqe->opcode = IORING_OP_POLL_REMOVE;
+      sqe->addr = MINIEVENT_UD_SLOT_BASE + ev->evx_slot_index;
+      sqe->user_data = MINIEVENT_UD_IGNORE;
+    }
+    ev->evx_slot_index = -1;
+  }
+  if (ev->ev_flags & EVLIST_TIMEOUT)
+    minievent_timer_remove(ev);
+  --minievent_event_count;
+  if (ev->ev_flags & EVLIST_INTERNAL)
+    --minievent_internal_event_count;
+  ev->ev_flags &= ~(EVLIST_INSERTED | EVLIST_TIMEOUT);
+  return 0;
+}
+
+/** Run the callback of ev, which has fired with fire_events. */
+static void minievent_fire(struct event *ev, short fire_events) {
+  if (ev->ev_events & EV_PERSIST) {
+    if (ev->ev_flags & EVLIST_TIMEOUT) {
+      ev->ev_expire.tv_sec  += ev->ev_timeout.tv_sec;
+      ev->ev_expire.tv_usec += ev->ev_timeout.tv_usec;
+      MINIEVENT_FIX_TV_AFTER_ADD(ev->ev_expire);
+      minievent_timer_sift_down(ev->evx_timer_index);
+    }
+  } else {
+    event_del(ev);
+  }
+  ev->ev_callback(ev->ev_fd, fire_events, ev->ev_arg);
+}
+
+/** Process the completion (with result res) of the poll in slot i. */
+static void minievent_dispatch_slot(int i, int res) {
+  struct event *ev = minievent_slots[i].ev;
+  short events, got_events, fire_events;
+  if (ev == NULL) {  /* Removed by event_del(). */
+    minievent_slot_free(i);
+    return;
+  }
+  events = ev->ev_events;
+  if (res < 0) {
+    /* E.g. EBADF. Let the callback find out by retrying the I/O. */
+    got_events = EV_READ | EV_WRITE;
+  } else {
+    got_events =
+        (res & (POLLIN | POLLERR | POLLHUP | POLLNVAL) ? EV_READ : 0) |
+        (res & (POLLOUT | POLLERR | POLLHUP | POLLNVAL) ? EV_WRITE : 0);
+  }
+  if ((events & (EV_READ | EV_WRITE)) == (EV_READ | EV_WRITE)) {
+    fire_events = got_events;
+  } else {
+    fire_events = events & got_events;
+  }
+  if (res >= 0 && (fire_events == 0 || (events & EV_PERSIST))) {
+    /* Keep the slot, and poll again. */
+    if (0 == minievent_submit_poll(i)) {
+      if (fire_events != 0)
+        minievent_fire(ev, fire_events);
+      return;
+    }
+    if (fire_events == 0)
+      fire_events = events & (EV_READ | EV_WRITE);
+  }
+  minievent_slot_free(i);
+  ev->evx_slot_index = -1;
+  event_del(ev);  /* Also for EV_PERSIST, since there is no poll. */
+  minievent_fire(ev, fire_events);
+}
+
+/* Return 0 if there are events registered with EVLOOP_ONCE, 1 if there are
+ * no more events registered.
+ *
+ * This function and all other functions in this file are not thread-safe or
+ * reentrant.
+ */
+int event_loop(int flags) {
+  struct minievent_ring *ring = &minievent_ring;
+  struct event *ev;
+  struct io_uring_sqe *sqe;
+  struct io_uring_cqe cqe;
+  struct timeval expire;
+  struct timeval now;
+  unsigned head, tail;
+  int i;
+  char do_wait;
+  minievent_signal_mask_t interesting_signal_mask, got_signal_mask;
+  char buf[64];
+  if ((flags & EVLOOP_NONBLOCK) && !(flags & EVLOOP_ONCE)) {
+    fprintf(stderr, "minievent: EVLOOP_NONBLOCK but not EVLOOP_ONCE\n");
+    abort();
+  }
+  if (minievent_is_in_loop) {
+    fprintf(stderr, "minievent: event_loop() already in progress\n");
+    abort();
+  }
+  do {
+    /* This doesn't make sense for internal events, but we keep it for
+     * libevent 1.4.13 compatibility, see also coio_minievent.c.
+     */
+    if (minievent_event_count == minievent_internal_event_count)
+      return 1;
+    interesting_signal_mask = 0;
+    for (ev = minievent_signal_first; ev != NULL; ev = ev->evx_next)
+      interesting_signal_mask |= 1L << ev->ev_fd;
+    do_wait = !(flags & EVLOOP_NONBLOCK) &&
+              !(minievent_got_signal_mask & interesting_signal_mask) &&
+              *ring->cq_head == __atomic_load_n(ring->cq_tail,
+                                                __ATOMIC_ACQUIRE);
+    if (do_wait && minievent_timer_count > 0) {
+      expire = minievent_timer_heap[0]->ev_expire;
+      if (gettimeofday(&now, NULL) != 0)
+        return -1;
+      if (!MINIEVENT_TV_LT(now, expire)) {
+        do_wait = 0;
+      } else {
+        if (expire.tv_usec < now.tv_usec) {
+          expire.tv_usec += 1000000L;
+          --expire.tv_sec;
+        }
+        minievent_timeout_ts.tv_sec = expire.tv_sec - now.tv_sec;
+        minievent_timeout_ts.tv_nsec = (expire.tv_usec - now.tv_usec) * 1000L;
+        if (NULL == (sqe = minievent_get_sqe()))
+          return -1;
+        /* Completes at the timeout, or when any other completion arrives,
+         * so it doesn't have to be removed.
+         */
+        sqe->opcode = IORING_OP_TIMEOUT;
+        sqe->addr = (uintptr_t)&minievent_timeout_ts;
+        sqe->len = 1;
+        sqe->off = 1;
+        sqe->user_data = MINIEVENT_UD_IGNORE;
+      }
+    }
+    minievent_is_in_loop = 1;
+    /* Skip the system call if there is nothing to submit or wait for. */
+    if (do_wait || ring->sq_tail_local != *ring->sq_tail ||
+        ring->sq_tail_local !=
+            __atomic_load_n(ring->sq_head, __ATOMIC_ACQUIRE) ||
+        (__atomic_load_n(ring->sq_flags, __ATOMIC_ACQUIRE) &
+         (IORING_SQ_CQ_OVERFLOW | IORING_SQ_TASKRUN))) {
+      if (0 != minievent_ring_enter(do_wait)) {
+        minievent_is_in_loop = 0;
+        return -1;
+      }
+    }
+    /* Reap the completions available now in a batch. The completions of
+     * submissions made by the callbacks are reaped in the next iteration.
+     */
+    head = *ring->cq_head;
+    tail = __atomic_load_n(ring->cq_tail, __ATOMIC_ACQUIRE);
+    while (head != tail) {
+      cqe = ring->cqes[head & ring->cq_mask];
+      __atomic_store_n(ring->cq_head, ++head, __ATOMIC_RELEASE);
+      if (cqe.user_data >= MINIEVENT_UD_SLOT_BASE) {
+        minievent_dispatch_slot(cqe.user_data - MINIEVENT_UD_SLOT_BASE,
+                                cqe.res);
+      } else if (cqe.user_data == MINIEVENT_UD_SIGNAL_PIPE &&
+                 minievent_signal_pipe[0] >= 0) {
+        while (read(minievent_signal_pipe[0], buf, sizeof buf) > 0) {}
+        minievent_submit_signal_pipe_poll();  /* Ignore errors. */
+      }
+    }
+    got_signal_mask = minievent_got_signal_mask;
+    if (got_signal_mask != 0) {
+      for (ev = minievent_signal_first; ev != NULL; ev = minievent_loop_ev) {
+        minievent_loop_ev = ev->evx_next;
+        if (got_signal_mask & 1L << ev->ev_fd) {
+          /* This doesn't contain a race condition, because we use the copy
+           * (got_signal_mask) to decide which event handlers to run.
+           */
+          minievent_got_signal_mask &= ~(1L << ev->ev_fd);
+          minievent_fire(ev, EV_SIGNAL);
+        }
+      }
+      minievent_loop_ev = NULL;
+    }
+    if (minievent_timer_count > 0) {
+      if (gettimeofday(&now, NULL) != 0) {
+        minievent_is_in_loop = 0;
+        return -1;
+      }
+      /* Limit the number of callbacks, because an EV_PERSIST event with a
+       * zero timeout would stay expired.
+       */
+      for (i = minievent_timer_count; i > 0 && minievent_timer_count > 0 &&
+           !MINIEVENT_TV_LT(now, minievent_timer_heap[0]->ev_expire); --i) {
+        minievent_fire(minievent_timer_heap[0], EV_TIMEOUT);
+      }
+    }
+    minievent_is_in_loop = 0;
+  } while (!(flags & EVLOOP_ONCE));
+  return 0;
+}
@@ -40,6 +40,7 @@
 import os
 import stackless
 import socket
+import time
 #import __builtin__
 import types
 
@@ -108,22 +109,25 @@ cdef extern from "errno.h":
     cdef extern char *strerror(int)
     cdef enum errno_dummy:
         EAGAIN
+        EISDIR
+        EINVAL
         EINPROGRESS
         EALREADY
         EIO
         EISCONN
+        ENOPROTOOPT
 cdef extern from "fcntl.h":
     cdef int fcntl2 "fcntl"(int fd, int cmd)
     cdef int fcntl3 "fcntl"(int fd, int cmd, long arg)
     int O_NONBLOCK
     int F_GETFL
     int F_SETFL
+    int F_GETFD
+    int F_SETFD
+    int FD_CLOEXEC
 cdef extern from "signal.h":
     int SIGINT
     int SIGUSR1
-    int SIGUSR2
-    int kill(int pid, int signum)
-    int getpid()
 cdef extern from "sys/socket.h":
     int AF_INET6
     int AF_INET
@@ -146,6 +150,7 @@ ctypedef void (*event_handler)(int fd, short evtype, void *arg)
 cdef extern from "./coio_c_include_libevent.h":
     int c_FEATURE_MAY_EVENT_LOOP_RETURN_1 "FEATURE_MAY_EVENT_LOOP_RETURN_1"
     int c_FEATURE_MULTIPLE_EVENTS_ON_SAME_FD "FEATURE_MULTIPLE_EVENTS_ON_SAME_FD"
+    int c_FEATURE_EDGE_TRIGGERED "FEATURE_EDGE_TRIGGERED"
 
 
     struct event_t "event":
@@ -285,6 +290,37 @@ cdef extern from "./coio_c_helper.h":
     object coio_c_wait_for(int fd, short evtype, event_handler handler,
                            timeval *timeout)
     char coio_loaded()
+    int coio_c_wakeup_open() except -1
+    void coio_c_wakeup_send()
+    void coio_c_handle_wakeup(int fd, short evtype, void *arg)
+    void coio_c_wakeup_wait() nogil
+    int coio_c_is_readable(int fd)
+    void coio_c_loop_stats_before_loop()
+    void coio_c_loop_stats_after_loop(int is_blocking)
+    object coio_c_loop_stats_get(int do_reset)
+    double coio_c_monotonic()
+    unsigned long long coio_c_monotonic_usec()
+    ctypedef struct duration_stats_s "struct coio_duration_stats":
+        unsigned long long count
+    void coio_c_duration_stats_add(duration_stats_s *st,
+                                   unsigned long long usec)
+    object coio_c_duration_stats_get(duration_stats_s *st, int do_reset)
+    int coio_c_completion_is_empty()
+    int coio_c_completion_push(object channel, object value) except -1
+    object coio_c_completion_pop_all()
+    double coio_c_loop_last_run_sec()
+    int COIO_SO_BUSY_POLL
+    void coio_c_busy_poll_set_woken()
+    int coio_c_busy_poll(PyTaskletObject *m, unsigned usec) nogil
+    double coio_c_loop_stall_sec()
+    int coio_wakeup_read_fd
+    ctypedef struct edge_watch_s "struct coio_edge_watch":
+        void *waiting
+        char is_ready
+    # Returns 1 if started, 0 if not supported by the event library.
+    int coio_c_edge_watch_start(event_t *ev, event_handler wakeup) except -1
+    void coio_c_edge_watch_stop(event_t *ev)
+    void coio_c_edge_watch_set_callback(event_t *ev, event_handler callback)
     object coio_c_handle_eagain(socket_wakeup_info_s *swi, short evtype) 
     object coio_c_socket_call(object function, object args,
                               socket_wakeup_info_s *swi, short evtype)
@@ -292,6 +328,11 @@ cdef extern from "./coio_c_helper.h":
                              int n) except -1
     int coio_c_writeall(oneway_wakeup_info_s *owi, char_constp p,
                         Py_ssize_t n) except -1
+    Py_ssize_t coio_c_sendfile(oneway_wakeup_info_s *owi, int in_fd,
+                               long long offset, Py_ssize_t n) except -1
+    int coio_c_set_cpu_affinity(object cpus) except -1
+    int coio_c_is_realsocket_layout_known(object socket_type)
+    object coio_c_accept_nonblocking(object listener)
     int c_SSL_ERROR_WANT_READ "coio_c_SSL_ERROR_WANT_READ"
     int c_SSL_ERROR_WANT_WITE "coio_c_SSL_ERROR_WANT_WRITE"
     int c_SSL_ERROR_EOF "coio_c_SSL_ERROR_EOF"
@@ -302,6 +343,35 @@ cdef extern from "./coio_c_helper.h":
     object coio_c_ssl_call(object function, object args,
                            socket_wakeup_info_s *swi,
                            char do_handle_read_eof)
+    int coio_c_wsgi_prescan(char_constp p, Py_ssize_t n)
+    int coio_c_wsgi_is_request_buffered(char_constp p, Py_ssize_t n)
+    int coio_c_is_http_response_status(char_constp p, Py_ssize_t n)
+    int coio_c_is_http_header_key(char_constp p, Py_ssize_t n)
+    int coio_c_is_http_header_value(char_constp p, Py_ssize_t n)
+    int coio_c_evbuffer_add_http_header(
+        evbuffer_s *eb, char_constp key, Py_ssize_t key_size,
+        char_constp value, Py_ssize_t value_size)
+    int coio_c_is_suburl_char(char c)
+    int coio_c_is_http_header(char_constp p, Py_ssize_t n,
+                              char_constp name, Py_ssize_t size)
+    Py_ssize_t coio_c_http_reqhead_size(char_constp p, Py_ssize_t n)
+    cdef enum coio_c_http_header_kind:
+        COIO_HTTP_HEADER_SINGLE
+        COIO_HTTP_HEADER_COMMA_SEPARATED
+        COIO_HTTP_HEADER_CONTENT_LENGTH
+        COIO_HTTP_HEADER_CONNECTION
+        COIO_HTTP_HEADER_IGNORED
+    int COIO_C_HTTP_KNOWN_HEADER_COUNT
+    char_constp coio_c_http_known_header_env_key(int i)
+    int coio_c_http_known_header_kind(int i)
+    int coio_c_http_find_known_header(char_constp p, Py_ssize_t n)
+    object coio_c_http_new_env_key(char_constp p, Py_ssize_t n)
+    Py_ssize_t coio_c_http_parse_content_length(char_constp p, Py_ssize_t n)
+    Py_ssize_t coio_c_http_parse_chunk_size(char_constp p, Py_ssize_t n)
+    int coio_c_evbuffer_add_http_chunk_head(evbuffer_s *eb, Py_ssize_t n)
+    int COIO_C_HTTP_CHUNK_PLACEHOLDER_SIZE
+    Py_ssize_t coio_c_evbuffer_begin_http_chunk(evbuffer_s *eb)
+    int coio_c_evbuffer_end_http_chunk(evbuffer_s *eb, Py_ssize_t off)
 
 # --- Low-level event functions
 
@@ -313,14 +383,32 @@ def has_feature_multiple_events_on_same_fd():
     """Return true iff multiple events can be reliably registered on an fd."""
     return c_FEATURE_MULTIPLE_EVENTS_ON_SAME_FD
 
+def has_feature_edge_triggered():
+    """Return true iff set_persistent_watch(True) has an effect."""
+    return c_FEATURE_EDGE_TRIGGERED
+
 def version():
     return event_get_version()
 
 def method():
     return event_get_method()
 
+def set_cpu_affinity(cpus):
+    """Pin the current process to the specified CPUs (Linux only).
+
+    Args:
+      cpus: Iterable of CPU numbers (nonnegative integers).
+    Raises:
+      OSError: On error, with errno ENOSYS on non-Linux systems.
+    """
+    coio_c_set_cpu_affinity(cpus)
+
 def reinit(int do_recreate=0):
     cdef int got
+    # Don't share the wakeup fd with the parent process after a fork().
+    if wakeup_ev.ev_flags:
+        event_del(&wakeup_ev)
+        wakeup_ev.ev_flags = 0
     if do_recreate:
         if sigint_ev.ev_flags:
             event_del(&sigint_ev)
@@ -333,6 +421,7 @@ def reinit(int do_recreate=0):
         got = coio_event_reinit(0)
     if got < 0:
         raise OSError(EIO, 'event_reinit failed')
+    _setup_wakeup()
 
 def nonblocking_loop_for_tests():
     """Run event_loop(EVLOOP_ONCE | EVLOOP_NONBLOCK).
@@ -473,9 +562,286 @@ cdef char is_main_loop_waiting
 is_main_loop_waiting = 0
 
 def cancel_main_loop_wait():
-    """Cancel the waiting for events to happen in the main loop."""
+    """Cancel the waiting for events to happen in the main loop.
+
+    Can be called from any thread. Multiple calls before the main loop wakes
+    up result in a single wakeup.
+    """
     if is_main_loop_waiting:
-        kill(getpid(), SIGUSR2)
+        coio_c_wakeup_send()
+
+# Scheduling policy of _main_loop, see set_schedule_policy.
+cdef int schedule_run_batch
+schedule_run_batch = 0
+cdef double schedule_time_budget
+schedule_time_budget = 0.0
+cdef char schedule_is_wakeup_first
+schedule_is_wakeup_first = 1
+cdef unsigned schedule_busy_poll_usec
+schedule_busy_poll_usec = 0
+# Number of tasklets _main_loop has let run before its next event_loop().
+cdef int last_round_size
+last_round_size = 0
+
+def set_schedule_policy(run_batch=None, time_budget=None, wakeup_first=None,
+                        busy_poll_usec=None):
+    """Change the scheduling policy of the main loop.
+
+    After each event_loop() call, the main loop (main_loop_tasklet) positions
+    itself in the run queue, thus it decides how many tasklets run before the
+    next I/O poll (a round). Arguments which are None are left unchanged.
+
+    Args:
+      run_batch: Maximum number of tasklets to run in a round, or 0 (the
+        default) for no limit (all runnable tasklets).
+      time_budget: If positive, and the previous round took longer than this
+        many seconds, then the next round runs only half as many tasklets
+        (but at least 1). 0.0 (the default) disables this.
+      wakeup_first: If true (the default), tasklets woken up by I/O (or
+        timers) run before the tasklets already runnable, otherwise after
+        them.
+      busy_poll_usec: If positive, then when no tasklet is runnable, poll
+        for events without blocking for up to this many microseconds before
+        blocking. This reduces the wakeup latency at the cost of CPU time;
+        see the busy_poll_* keys of loop_stats() for the trade-off, and
+        nbsocket.set_busy_poll for the socket-level counterpart. 0 (the
+        default) disables this.
+    """
+    global schedule_run_batch, schedule_time_budget, schedule_is_wakeup_first
+    global schedule_busy_poll_usec
+    if run_batch is not None:
+        if run_batch < 0:
+            raise ValueError('run_batch must not be negative')
+        schedule_run_batch = run_batch
+    if time_budget is not None:
+        if time_budget < 0:
+            raise ValueError('time_budget must not be negative')
+        schedule_time_budget = time_budget
+    if wakeup_first is not None:
+        schedule_is_wakeup_first = bool(wakeup_first)
+    if busy_poll_usec is not None:
+        if busy_poll_usec < 0:
+            raise ValueError('busy_poll_usec must not be negative')
+        schedule_busy_poll_usec = busy_poll_usec
+
+def get_schedule_policy():
+    """Return the scheduling policy of the main loop as a dict.
+
+    The dict can be passed as keyword arguments to set_schedule_policy.
+    """
+    return {'run_batch': schedule_run_batch,
+            'time_budget': schedule_time_budget,
+            'wakeup_first': bool(schedule_is_wakeup_first),
+            'busy_poll_usec': schedule_busy_poll_usec}
+
+# Move m (main_loop_tasklet) in the run queue so that only the next
+# round_size tasklets run before it. Returns the tasklet to be run next
+# (instead of m.next), or NULL if m was not moved.
+cdef PyTaskletObject *_limit_round(PyTaskletObject *m):
+    global last_round_size
+    cdef int runnable_count
+    cdef int round_size
+    cdef PyTaskletObject *first
+    cdef PyTaskletObject *q
+    runnable_count = PyStackless_GetRunCount() - 1
+    round_size = schedule_run_batch
+    if (schedule_time_budget > 0 and
+        coio_c_loop_last_run_sec() > schedule_time_budget):
+        round_size = last_round_size >> 1
+        if round_size < 1:
+            round_size = 1
+    if round_size <= 0 or round_size >= runnable_count:
+        last_round_size = runnable_count
+        return NULL
+    last_round_size = round_size
+    first = m.next
+    q = m
+    while round_size > 0:
+        q = q.next
+        round_size = round_size - 1
+    m.prev.next = m.next
+    m.next.prev = m.prev
+    m.next = q.next
+    m.prev = q
+    q.next.prev = m
+    q.next = m
+    return first
+
+# --- Tasklet priorities
+
+PRIORITY_HIGH = 1
+PRIORITY_NORMAL = 0
+PRIORITY_BACKGROUND = -1
+
+# Maps tasklets to their priority, if not PRIORITY_NORMAL.
+cdef object tasklet_priorities
+tasklet_priorities = __import__('weakref').WeakKeyDictionary()
+# Nonzero iff set_priority() has ever been called with a non-normal priority.
+# This makes the wakeups cheaper in programs not using priorities.
+cdef char has_tasklet_priorities
+has_tasklet_priorities = 0
+# High-priority tasklets woken up since the last event_loop() call.
+cdef list high_ready_tasklets
+high_ready_tasklets = []
+# Background tasklets woken up (or yielded with schedule_background()),
+# waiting for no other tasklet to be runnable.
+cdef list background_ready_tasklets
+background_ready_tasklets = []
+
+def set_priority(tasklet tasklet_obj, int priority):
+    """Set the priority class of a tasklet.
+
+    The priority affects tasklets woken up by coio (because of I/O, a timer,
+    or a sleep() finishing):
+
+    * PRIORITY_HIGH: runs first, before the tasklets already runnable.
+    * PRIORITY_NORMAL (the default): runs as scheduled by
+      set_schedule_policy().
+    * PRIORITY_BACKGROUND: runs only when no other tasklet is runnable.
+
+    Tasklets calling stackless.schedule() are not affected, use
+    schedule_background() in background tasklets instead.
+    """
+    global has_tasklet_priorities
+    if priority > 0:
+        priority = PRIORITY_HIGH
+    elif priority < 0:
+        priority = PRIORITY_BACKGROUND
+    if priority == PRIORITY_NORMAL:
+        if tasklet_obj in tasklet_priorities:
+            del tasklet_priorities[tasklet_obj]
+    else:
+        tasklet_priorities[tasklet_obj] = priority
+        has_tasklet_priorities = 1
+
+def get_priority(tasklet tasklet_obj):
+    """Return the priority class of a tasklet, see set_priority()."""
+    return tasklet_priorities.get(tasklet_obj, PRIORITY_NORMAL)
+
+def schedule_background():
+    """Like stackless.schedule(), but continue only if nothing else runs.
+
+    The current tasklet is resumed by the main loop when no other tasklet is
+    runnable, even if the current tasklet doesn't have PRIORITY_BACKGROUND.
+    """
+    cdef tasklet current
+    current = PyStackless_GetCurrent()
+    background_ready_tasklets.append(current)
+    try:
+        PyStackless_Schedule(None, 1)  # remove=1
+    finally:
+        # Not found if resumed by the main loop.
+        if current in background_ready_tasklets:
+            background_ready_tasklets.remove(current)
+
+def insert_background(tasklet tasklet_obj):
+    """Make tasklet_obj run next when no other tasklet is runnable.
+
+    tasklet_obj is removed from the runnables first (if there), so e.g.
+    insert_background(stackless.tasklet(f)()) doesn't run f before the
+    tasklets already runnable. Use set_priority() to keep the tasklet in the
+    background after it gets blocked.
+    """
+    if PyTasklet_GetBlocked(tasklet_obj):
+        raise RuntimeError('cannot insert a blocked tasklet')
+    if tasklet_obj is PyStackless_GetCurrent():
+        raise RuntimeError('use schedule_background() for the current tasklet')
+    PyTasklet_Remove(tasklet_obj)
+    background_ready_tasklets.append(tasklet_obj)
+
+# Make tasklet_obj runnable after it has been woken up by an event handler,
+# according to its priority.
+cdef int insert_woken(tasklet tasklet_obj) except -1:
+    if has_tasklet_priorities:
+        priority = tasklet_priorities.get(tasklet_obj)
+        if priority is not None:
+            if priority > 0:
+                high_ready_tasklets.append(tasklet_obj)
+            else:
+                background_ready_tasklets.append(tasklet_obj)
+            coio_c_busy_poll_set_woken()
+            return 0
+    return PyTasklet_Insert(tasklet_obj)
+
+# Make the woken up high-priority tasklets run right after m
+# (main_loop_tasklet).
+cdef int _insert_high_ready(PyTaskletObject *m) except -1:
+    cdef PyTaskletObject *h
+    cdef tasklet tasklet_obj
+    while high_ready_tasklets:
+        # Pop from the end, so the tasklet woken up first will run first.
+        tasklet_obj = high_ready_tasklets.pop()
+        if (not PyTasklet_Alive(tasklet_obj) or
+            PyTasklet_GetBlocked(tasklet_obj)):
+            continue
+        PyTasklet_Insert(tasklet_obj)
+        h = <PyTaskletObject*>tasklet_obj
+        if m.next != h:
+            h.prev.next = h.next
+            h.next.prev = h.prev
+            h.next = m.next
+            h.prev = m
+            m.next.prev = h
+            m.next = h
+    return 0
+
+# Make a background tasklet runnable if m (main_loop_tasklet) is the only
+# runnable tasklet.
+cdef int _insert_background_ready(PyTaskletObject *m) except -1:
+    cdef tasklet tasklet_obj
+    while m.next == m and background_ready_tasklets:
+        tasklet_obj = background_ready_tasklets.pop(0)
+        if (PyTasklet_Alive(tasklet_obj) and
+            not PyTasklet_GetBlocked(tasklet_obj)):
+            PyTasklet_Insert(tasklet_obj)
+    return 0
+
+# --- Results from threads
+
+# Threads (such as the workers of thread_pool) push (channel, value) pairs
+# to the completion queue in C with send_from_thread, for _main_loop to
+# send value to channel. The main loop is woken up only for the first pair
+# in the queue, and it takes all pairs in a single batch.
+
+def send_from_thread(channel, value):
+    """Make the main loop send value to channel, as soon as possible.
+
+    Can be called from any thread. The send doesn't block the main loop
+    (channel.preference is ignored): the receivers are inserted to the
+    runnables list together, in the order of the sends. If no tasklet is
+    receiving from channel by then (e.g. because the receiver has been
+    interrupted), the value is dropped.
+    """
+    if coio_c_completion_push(channel, value):
+        cancel_main_loop_wait()
+
+# Number of thread_pool calls running in a worker thread. _main_loop doesn't
+# exit while there are some, because they will push their results.
+cdef int running_thread_call_count
+running_thread_call_count = 0
+
+cdef class thread_pool
+
+# Maps the result channels of thread_pool workers whose caller has been
+# interrupted while the call was running to (pool, thread_worker) pairs.
+# Such a worker is released when its call finishes, see
+# thread_pool.abandon_worker.
+cdef dict abandoned_thread_workers
+abandoned_thread_workers = {}
+
+cdef int _send_thread_results() except -1:
+    cdef thread_pool pool
+    for pair in coio_c_completion_pop_all():
+        if pair[0].balance < 0:
+            pair[0].send(pair[1])  # Prefer the sender.
+        else:
+            # Drop the value if the receiver has given up receiving, so it
+            # doesn't get to the next receiver of the channel.
+            abandoned = abandoned_thread_workers.pop(pair[0], None)
+            if abandoned is not None:
+                pool = abandoned[0]
+                pool.release_worker(abandoned[1])
+    return 0
 
 # A cdef wouldn't work here, because we call `stackless.tasklet(_main_loop)'.
 def _main_loop():
@@ -483,13 +849,17 @@ def _main_loop():
     #cdef PyTaskletObject *pprev
     #cdef PyTaskletObject *pnext
     cdef int loop_retval
+    cdef int is_found
     cdef PyTaskletObject *p
+    cdef PyTaskletObject *first
     cdef PyTaskletObject *m
     cdef tasklet tm
     tm = PyStackless_GetCurrent()
     m = <PyTaskletObject*>tm
 
     while 1:  # `while 1' is more efficient in Pyrex than `while True'
+        if not coio_c_completion_is_empty():
+            _send_thread_results()
         # This runs 1 iteration of the libevent main loop: waiting for
         # I/O events and calling callbacks.
         #
@@ -504,14 +874,18 @@ def _main_loop():
         #
         # We compare against 2 because of stackless.current
         # (main_loop_tasklet) and link_helper_tasklet.
-        if m.next != m:  # PyStackless_GetRunCount() > 1:
+        if m.next != m or background_ready_tasklets:
             p = m.prev
             # We must and do make sure that there are no non-local exits
             # (e.g. exceptions) until the corresponding Py_DECREF.
             Py_INCREF(<object>p)
+            coio_c_loop_stats_before_loop()
             with nogil:
                 event_loop(EVLOOP_ONCE | EVLOOP_NONBLOCK)
-            if (p.next != NULL and
+            coio_c_loop_stats_after_loop(0)
+            if (schedule_is_wakeup_first and
+                p != m and
+                p.next != NULL and
                 not PyTasklet_GetBlocked(<tasklet>p) and
                 p.next != m):
                 # Move m (main_loop_tasklet) after p (last_tasklet).
@@ -526,12 +900,43 @@ def _main_loop():
                 p.next.prev = m
                 p.next = m
             Py_DECREF(<object>p)
+            if high_ready_tasklets:
+                _insert_high_ready(m)
+            if m.next == m:
+                _insert_background_ready(m)
+            first = NULL
+            if m.next != m:
+                first = _limit_round(m)
         else:
-            # Block, wait for events once, without timeout.
-            is_main_loop_waiting = 1
-            with nogil:
-                loop_retval = event_loop(EVLOOP_ONCE)
-            is_main_loop_waiting = 0
+            coio_c_loop_stats_before_loop()
+            loop_retval = 0
+            if schedule_busy_poll_usec:
+                with nogil:
+                    is_found = coio_c_busy_poll(m, schedule_busy_poll_usec)
+            else:
+                is_found = 0
+            if is_found:
+                coio_c_loop_stats_after_loop(0)
+            else:
+                # Block, wait for events once, without timeout.
+                is_main_loop_waiting = 1
+                # Check again after setting is_main_loop_waiting, because a
+                # thread may have pushed to the completion queue since the
+                # check above (the GIL can be released in between, e.g. by
+                # greenstackless). Then don't wait.
+                if coio_c_completion_is_empty():
+                    with nogil:
+                        loop_retval = event_loop(EVLOOP_ONCE)
+                    if loop_retval and running_thread_call_count:
+                        # No events registered, but a worker thread will
+                        # push its result (if it hasn't done so yet) and
+                        # wake us up.
+                        if coio_c_completion_is_empty():
+                            with nogil:
+                                coio_c_wakeup_wait()
+                        loop_retval = 0
+                coio_c_loop_stats_after_loop(1)
+                is_main_loop_waiting = 0
             if loop_retval:
                 # No events registered, and no tasklets in the queue. This
                 # means that nothing more can happen in this program. By
@@ -543,8 +948,248 @@ def _main_loop():
                 #
                 # !! SUXX: there are registered events after an evdns lookup.
                 return
+            if high_ready_tasklets:
+                _insert_high_ready(m)
+            if m.next == m:
+                _insert_background_ready(m)
+            first = NULL
+            if m.next != m:
+                first = _limit_round(m)
+
+        if first == NULL:
+            PyStackless_Schedule(None, 0)  # remove=0
+        else:
+            # Run the round from first, ending just before m.
+            (<tasklet>first).run()
+
+# --- Main loop statistics
+
+def loop_stats(reset=False):
+    """Return a snapshot of the main loop statistics as a new dict.
+
+    The statistics are collected by _main_loop for each event_loop() call.
+    A high run_usec_max (with mostly nonblocking iterations) means that a
+    tasklet is hogging the CPU, and a high loop_usec_total (with mostly
+    blocking iterations) means that the process is waiting for I/O.
+
+    Keys in the dict:
+
+    * blocking_count: number of event_loop() calls waiting for an event
+      (because no other tasklet was runnable).
+    * nonblocking_count: number of event_loop() calls which didn't wait.
+    * loop_usec_total, loop_usec_max: microseconds spent in event_loop(),
+      including the event handlers.
+    * run_usec_total, run_usec_max: microseconds spent by other tasklets
+      before _main_loop got control again.
+    * inserted_total, inserted_max: number of tasklets made runnable by an
+      event_loop() call.
+    * loop_usec_histogram, run_usec_histogram, inserted_histogram: tuples of
+      counts, element i (i > 0) counting values v with
+      2 ** (i - 1) <= v < 2 ** i, element 0 counting v == 0. The last
+      element also counts all larger values.
+
+    Args:
+      reset: If true, reset the statistics after taking the snapshot.
+    """
+    return coio_c_loop_stats_get(bool(reset))
+
+cdef event_t loop_stats_hook_ev
+loop_stats_hook_ev.ev_flags = 0
+cdef timeval loop_stats_hook_tv
+cdef object loop_stats_hook
+loop_stats_hook = None
+
+cdef void HandleCLoopStatsHook(int fd, short evtype, void *arg) with gil:
+    # Add first, so the hook can cancel itself by set_loop_stats_hook(None).
+    event_add(&loop_stats_hook_ev, &loop_stats_hook_tv)
+    # Should an exception occur, Pyrex will print it to stderr, and ignore it.
+    loop_stats_hook(coio_c_loop_stats_get(1))
+
+def set_loop_stats_hook(hook, double interval=1.0):
+    """Call hook periodically with loop_stats(reset=True).
+
+    The hook is called from an event handler in the main loop, so it must
+    return quickly, and it must not block (e.g. call coio.sleep). Exceptions
+    raised by the hook are printed to stderr and ignored. The pending hook
+    doesn't prevent the process from exiting.
+
+    Args:
+      hook: Callable taking the loop_stats dict, or None to stop calling the
+        previous hook.
+      interval: Number of seconds between two hook calls.
+    """
+    global loop_stats_hook
+    if loop_stats_hook_ev.ev_flags:
+        event_del(&loop_stats_hook_ev)
+        loop_stats_hook_ev.ev_flags = 0
+    loop_stats_hook = None
+    if hook is None:
+        return
+    if interval <= 0:
+        raise ValueError('interval must be positive')
+    loop_stats_hook = hook
+    loop_stats_hook_tv.tv_sec = <long>interval
+    loop_stats_hook_tv.tv_usec = <unsigned int>(
+        (interval - <double>loop_stats_hook_tv.tv_sec) * 1000000.0)
+    event_set(&loop_stats_hook_ev, -1, 0, HandleCLoopStatsHook, NULL)
+    # Equivalent to:
+    # loop_stats_hook_ev.ev_flags |= c_EVLIST_INTERNAL
+    coio_c_set_evlist_internal(&loop_stats_hook_ev)
+    event_add(&loop_stats_hook_ev, &loop_stats_hook_tv)
+
+# --- Loop-lag watchdog
 
-        PyStackless_Schedule(None, 0)  # remove=0
+# The original time.sleep, even if syncless.patch has replaced it later.
+cdef object real_time_sleep
+real_time_sleep = time.sleep
+
+def log_watchdog_report(kind, double lag, stack):
+    """Default watchdog callback: log the report with logging.warning."""
+    import logging
+    if kind == 'stall':
+        msg = 'coio watchdog: main loop blocked for %.3fs' % lag
+    else:
+        msg = 'coio watchdog: timer fired %.3fs late' % lag
+    if stack:
+        msg = '%s, at:\n%s' % (msg, ''.join(stack).rstrip('\n'))
+    logging.warning(msg)
+
+cdef class watchdog_state:
+    cdef double threshold
+    cdef double interval
+    # Monotonic time when the timer is expected to fire.
+    cdef double due_at
+    cdef object callback
+    # thread.get_ident() of the thread running the main loop.
+    cdef object thread_id
+    cdef char is_stopped
+
+cdef object current_watchdog
+current_watchdog = None
+cdef event_t watchdog_ev
+watchdog_ev.ev_flags = 0
+cdef timeval watchdog_tv
+
+cdef void HandleCWatchdogTimer(int fd, short evtype, void *arg) with gil:
+    cdef watchdog_state w
+    cdef double now
+    cdef double lag
+    w = current_watchdog
+    now = coio_c_monotonic()
+    lag = now - w.due_at
+    w.due_at = now + w.interval
+    event_add(&watchdog_ev, &watchdog_tv)
+    if lag >= w.threshold:
+        # Should an exception occur, Pyrex will print it to stderr, and
+        # ignore it.
+        w.callback('lag', lag, None)
+
+def _watchdog_thread_function(watchdog_state w):
+    """Function which runs in the watchdog thread until stop_watchdog()."""
+    cdef double stall
+    # Nonzero iff the stall in progress has already been reported. Since the
+    # stall is checked more often than the threshold, a new stall will be
+    # shorter than the previous one.
+    cdef double reported_stall
+    reported_stall = 0.0
+    while not w.is_stopped:
+        real_time_sleep(w.threshold / 4)
+        if w.is_stopped:
+            break
+        stall = coio_c_loop_stall_sec()
+        if stall < w.threshold:
+            reported_stall = 0.0
+        elif reported_stall == 0.0 or stall < reported_stall:
+            reported_stall = stall
+            # The frame of the tasklet running in the main thread.
+            frame = sys._current_frames().get(w.thread_id)
+            if frame is None:
+                stack = None
+            else:
+                stack = __import__('traceback').format_stack(frame)
+            try:
+                w.callback('stall', stall, stack)
+            except Exception, e:
+                sys.stderr.write('coio watchdog callback failed: %r\n' % e)
+
+def start_watchdog(double threshold=0.1, callback=None, double interval=-1.0,
+                   thread=None):
+    """Start reporting tasklets which block the main loop for too long.
+
+    A tasklet doing CPU-intensive work or calling a blocking function (e.g.
+    an unpatched time.sleep) prevents all other tasklets from running. The
+    watchdog detects this in two ways:
+
+    * A helper thread checks whether the main loop hasn't got back control
+      for threshold seconds, and then reports a 'stall' with the stack
+      of the tasklet running in the main thread, once per stall. Please
+      note that the helper thread can't run if the blocking function doesn't
+      release the GIL.
+    * A timer (firing every interval seconds) reports a 'lag' if it fires
+      threshold seconds late or later. The stack is not available in this
+      case, since the offending tasklets are not running anymore.
+
+    The watchdog doesn't prevent the process from exiting. After a fork(),
+    call start_watchdog() again in the child, because threads are not
+    inherited.
+
+    Args:
+      threshold: Number of seconds of blocking to report.
+      callback: Called as callback(kind, lag, stack), where kind is 'stall'
+        or 'lag', lag is the number of seconds, and stack is None or a list
+        of strings as returned by traceback.format_stack. 'stall' reports
+        are called from the helper thread, and 'lag' reports from an event
+        handler in the main loop, so the callback must return quickly, and
+        it must not block. Defaults to log_watchdog_report.
+      interval: Number of seconds between two timer firings. Defaults to
+        threshold.
+      thread: The thread module to use, or None for the default.
+    """
+    cdef watchdog_state w
+    global current_watchdog
+    if threshold <= 0:
+        raise ValueError('threshold must be positive')
+    if interval < 0:
+        interval = threshold
+    elif interval == 0:
+        raise ValueError('interval must be positive')
+    if callback is None:
+        callback = log_watchdog_report
+    if thread is None:
+        thread = __import__('thread')
+    stop_watchdog()
+    w = watchdog_state()
+    w.threshold = threshold
+    w.interval = interval
+    w.callback = callback
+    w.thread_id = thread.get_ident()
+    w.is_stopped = 0
+    w.due_at = coio_c_monotonic() + interval
+    watchdog_tv.tv_sec = <long>interval
+    watchdog_tv.tv_usec = <unsigned int>(
+        (interval - <double>watchdog_tv.tv_sec) * 1000000.0)
+    thread.start_new_thread(_watchdog_thread_function, (w,))
+    current_watchdog = w
+    event_set(&watchdog_ev, -1, 0, HandleCWatchdogTimer, NULL)
+    # Equivalent to:
+    # watchdog_ev.ev_flags |= c_EVLIST_INTERNAL
+    coio_c_set_evlist_internal(&watchdog_ev)
+    event_add(&watchdog_ev, &watchdog_tv)
+
+def stop_watchdog():
+    """Stop the watchdog started by start_watchdog(), if any.
+
+    The helper thread exits within threshold / 4 seconds.
+    """
+    cdef watchdog_state w
+    global current_watchdog
+    if watchdog_ev.ev_flags:
+        event_del(&watchdog_ev)
+        watchdog_ev.ev_flags = 0
+    if current_watchdog is not None:
+        w = current_watchdog
+        w.is_stopped = 1
+        current_watchdog = None
 
 
 # TODO(pts): Use a cdef, and hard-code event_add().
@@ -596,17 +1241,23 @@ cdef void _setup_sigusr1():
     coio_c_set_evlist_internal(&sigusr1_ev)
     event_add(&sigusr1_ev, NULL)
 
-cdef event_t sigusr2_ev
-sigusr2_ev.ev_flags = 0
-
-# Set up a null handler for SIGUSR2.
-cdef void _setup_sigusr2():
-    event_set(&sigusr2_ev, SIGUSR2, c_EV_SIGNAL | c_EV_PERSIST,
-              <event_handler>coio_c_nop, NULL)
+cdef event_t wakeup_ev
+wakeup_ev.ev_flags = 0
+
+# Set up the (new) wakeup fd for cancel_main_loop_wait. It is an eventfd
+# (or a pipe), registered once for the lifetime of the event loop.
+cdef int _setup_wakeup() except -1:
+    if wakeup_ev.ev_flags:
+        event_del(&wakeup_ev)
+        wakeup_ev.ev_flags = 0
+    coio_c_wakeup_open()
+    event_set(&wakeup_ev, coio_wakeup_read_fd, c_EV_READ | c_EV_PERSIST,
+              coio_c_handle_wakeup, NULL)
     # Equivalent to:
-    # sigusr2_ev.ev_flags |= c_EVLIST_INTERNAL
-    coio_c_set_evlist_internal(&sigusr2_ev)
-    event_add(&sigusr2_ev, NULL)
+    # wakeup_ev.ev_flags |= c_EVLIST_INTERNAL
+    coio_c_set_evlist_internal(&wakeup_ev)
+    event_add(&wakeup_ev, NULL)
+    return 0
 
 # The token in waiting_tasklet.tempval to signify that the event-waiting is
 # pending. This token is intentionally not exported to Python code, so they
@@ -640,7 +1291,7 @@ cdef void HandleCWakeup(int fd, short evtype, void *arg) with gil:
     #os_write(2, <char_constp>'W', 1)
     if (<tasklet>arg).tempval is waiting_token:
         (<tasklet>arg).tempval = coio_event_happened_token
-    PyTasklet_Insert(<tasklet>arg)
+    insert_woken(<tasklet>arg)
 
 cdef void HandleCTimeoutWakeup(int fd, short evtype, void *arg) with gil:
     # PyStackless_Schedule will return tempval.
@@ -651,7 +1302,21 @@ cdef void HandleCTimeoutWakeup(int fd, short evtype, void *arg) with gil:
             (<tasklet>arg).tempval = None
         else:
             (<tasklet>arg).tempval = coio_event_happened_token
-    PyTasklet_Insert(<tasklet>arg)
+    insert_woken(<tasklet>arg)
+
+cdef void HandleCEdgeWakeup(int fd, short evtype, void *arg) with gil:
+    # arg is the struct coio_edge_watch* of a persistent, edge-triggered
+    # watcher. Wake up the tasklet parked in coio_c_wait_eagain, or remember
+    # the readiness for the next coio_c_wait_eagain.
+    cdef edge_watch_s *watch
+    cdef void *waiting
+    watch = <edge_watch_s*>arg
+    waiting = watch.waiting
+    if waiting == NULL:
+        watch.is_ready = 1
+    else:
+        watch.waiting = NULL
+        HandleCWakeup(fd, evtype, waiting)
 
 #cdef char *(*_orig_readline_pointer)(FILE *, FILE *, char *)
 #
@@ -1035,6 +1700,278 @@ cdef object nbfile_read_http_reqhead(nbfile self, Py_ssize_t limit):
     return method, suburl, http_version, None, req_lines
   
 
+# Interned WSGI environment keys of the well-known HTTP request headers,
+# indexed like coio_c_http_known_headers.
+cdef list http_known_env_keys
+http_known_env_keys = []
+for i in range(COIO_C_HTTP_KNOWN_HEADER_COUNT):
+    http_known_env_keys.append(intern(PyString_FromString(
+        coio_c_http_known_header_env_key(i))))
+cdef object http_method_get
+http_method_get = intern('GET')
+cdef object http_method_head
+http_method_head = intern('HEAD')
+cdef object http_method_post
+http_method_post = intern('POST')
+cdef object http_version_1_0
+http_version_1_0 = intern('HTTP/1.0')
+cdef object http_version_1_1
+http_version_1_1 = intern('HTTP/1.1')
+
+# See the docstring of nbfile.read_http_request_env for documenation.
+#
+# Sets content_length_out[0] to the Content-Length (or -1 if missing), and
+# keep_alive_out[0] to a bool indicating if the client has requested
+# keep-alive.
+cdef object nbfile_read_http_request_env(
+    nbfile self, Py_ssize_t limit, object default_env,
+    Py_ssize_t *content_length_out, char *keep_alive_out):
+    cdef evbuffer_s *read_eb
+    cdef Py_ssize_t head_size
+    cdef Py_ssize_t n
+    cdef char_constp p
+    cdef char_constp q
+    cdef char_constp r
+    cdef char_constp end
+    cdef char c
+    cdef int i
+    cdef int kind
+    cdef dict env
+
+    read_eb = &self.read_eb
+    if read_eb.off == 0:
+        nbfile_read_more1(self, limit)
+    c = (<char*>read_eb.buf)[0]
+    if c < c'A' or c > c'Z':
+        raise ValueError('bad HTTP request method')
+    while 1:
+        head_size = coio_c_http_reqhead_size(
+            <char_constp>read_eb.buf, read_eb.off)
+        if head_size >= 0:
+            break
+        nbfile_read_more1(self, limit)
+    p = <char_constp>read_eb.buf
+    end = p + head_size
+
+    # Parse the first line of the the HTTP request.
+    q = <char_constp>memchr(<void_constp>p, c'\n', head_size)
+    r = q
+    if (<char*>r)[-1] == c'\r':
+        r -= 1
+    q = <char_constp>memchr(<void_constp>p, c' ', r - p)
+    if q == NULL:
+        raise ValueError('bad HTTP request line')
+    n = q - p
+    if n == 3 and 0 == memcmp(<void_constp>p, <void_constp><char*>'GET', 3):
+        method = http_method_get
+    elif n == 4 and 0 == memcmp(<void_constp>p, <void_constp><char*>'HEAD', 4):
+        method = http_method_head
+    elif n == 4 and 0 == memcmp(<void_constp>p, <void_constp><char*>'POST', 4):
+        method = http_method_post
+    else:
+        while p != q:
+            if (<char*>p)[0] < c'A' or (<char*>p)[0] > c'Z':
+                raise ValueError('bad HTTP request method')
+            p += 1
+        method = PyString_FromStringAndSize(q - n, n)
+    p = q + 1
+    if p == r or (<char*>p)[0] != c'/':
+        raise ValueError('bad suburl')
+    q = p + 1
+    while q != r and (<char*>q)[0] != c' ':
+        if not coio_c_is_suburl_char((<char*>q)[0]):
+            raise ValueError('bad suburl')
+        q += 1
+    if r - q != 9 or 0 != memcmp(<void_constp>q,
+                                 <void_constp><char*>' HTTP/1.', 8):
+        raise ValueError('bad HTTP version')
+    c = (<char*>q)[8]
+    if c == c'1':
+        http_version = http_version_1_1
+        keep_alive_out[0] = 1
+    elif c == c'0':
+        http_version = http_version_1_0
+        keep_alive_out[0] = 0
+    else:
+        raise ValueError('bad HTTP version')
+
+    env = dict(default_env)
+    env['REQUEST_METHOD'] = method
+    env['SERVER_PROTOCOL'] = http_version
+    env['SCRIPT_NAME'] = ''
+    r = <char_constp>memchr(<void_constp>p, c'?', q - p)
+    if r == NULL:
+        env['PATH_INFO'] = PyString_FromStringAndSize(p, q - p)
+        env['QUERY_STRING'] = ''
+    else:
+        env['PATH_INFO'] = PyString_FromStringAndSize(p, r - p)
+        env['QUERY_STRING'] = PyString_FromStringAndSize(r + 1, q - r - 1)
+
+    # Parse the request header lines (key--value pairs).
+    content_length_out[0] = -1
+    p = <char_constp>memchr(<void_constp>q, c'\n', end - q) + 1
+    while 1:
+        q = <char_constp>memchr(<void_constp>p, c'\n', end - p)
+        r = q
+        if r != p and (<char*>r)[-1] == c'\r':
+            r -= 1
+        if r == p:  # Received an empty line.
+            break
+        c = (<char*>p)[0] | 32
+        if r - p < 5 or c < c'a' or c > c'z':
+            raise ValueError('bad HTTP request header')
+        q = <char_constp>memchr(<void_constp>p, c':', r - p)
+        if q == NULL:
+            raise ValueError('bad HTTP request header')
+        n = q - p
+        while p != q:
+            c = (<char*>p)[0]
+            if (c != c'-' and <unsigned>(c | 32) - c'a' > <unsigned>c'z' - c'a'
+                and <unsigned>c - c'0' > <unsigned>c'9' - c'0'):
+                raise ValueError('bad HTTP request header')
+            p += 1
+        p = q - n  # Start of the header name.
+        q += 1
+        if q != r and (<char*>q)[0] == c' ':
+            q += 1
+        # Now p[:n] is the header name, and q[:r - q] is the value.
+        i = coio_c_http_find_known_header(p, n)
+        if i < 0:
+            if not coio_c_is_http_header(p, n, <char_constp><char*>'proxy-', 6):
+                env[coio_c_http_new_env_key(p, n)] = (
+                    PyString_FromStringAndSize(q, r - q))
+        else:
+            kind = coio_c_http_known_header_kind(i)
+            if kind == COIO_HTTP_HEADER_SINGLE:
+                env[http_known_env_keys[i]] = PyString_FromStringAndSize(
+                    q, r - q)
+            elif kind == COIO_HTTP_HEADER_COMMA_SEPARATED:
+                key = http_known_env_keys[i]
+                value = PyString_FromStringAndSize(q, r - q)
+                if key in env:
+                    env[key] = '%s, %s' % (env[key], value)
+                else:
+                    env[key] = value
+            elif kind == COIO_HTTP_HEADER_CONTENT_LENGTH:
+                content_length_out[0] = coio_c_http_parse_content_length(
+                    q, r - q)
+                if content_length_out[0] < 0:
+                    raise ValueError('bad content-length')
+                env[http_known_env_keys[i]] = PyString_FromStringAndSize(
+                    q, r - q)
+            elif kind == COIO_HTTP_HEADER_CONNECTION:
+                keep_alive_out[0] = r - q == 10 and coio_c_is_http_header(
+                    q, 10, <char_constp><char*>'keep-alive', 10)
+            # Ignore COIO_HTTP_HEADER_IGNORED (Keep-Alive:).
+        p = <char_constp>memchr(<void_constp>p, c'\n', end - p) + 1
+
+    evbuffer_drain(read_eb, head_size)
+    return env
+
+cdef int nbfile_write(nbfile self, char_constp p, Py_ssize_t n) except -1:
+    # TODO(pts): Flush the buffer eventually automatically.
+    cdef Py_ssize_t k
+    cdef int wlimit
+    cdef int keepc
+    if n <= 0:
+        return 0
+    wlimit = self.c_write_buffer_limit
+    # Adding write_eb as a local variable here wouldn't make it any
+    # faster.
+    if wlimit == 2:  # Infinite write buffer.
+        evbuffer_add(&self.write_eb, <void_constp>p, n)
+        return 0
+    if wlimit == 0 and self.write_eb.off == 0:
+        # Direct output without buffering. We check for the empty buffer
+        # above so we wouldn't take this shortcut if the buffer wasn't
+        # empty.
+        # TODO(pts): Use the socket timeout.
+        coio_c_writeall(&self.write_owi, p, n)
+        return 0
+    if wlimit == 1:  # Line buffering.
+        k = n
+        while k > 0 and (<char*>p)[k - 1] != c'\n':
+            k -= 1
+        if k == 0:  # No newline yet, so add the whole p to write_eb.
+            evbuffer_expand(&self.write_eb, self.c_min_read_buffer_size)
+            evbuffer_add(&self.write_eb, <void_constp>p, n)
+            return 0
+        keepc = n - k
+        n = k
+        # We can flush everything up to p[:n].
+
+        k = self.write_eb.totallen - (
+            self.write_eb.off + self.write_eb.misalign)
+        if k > n:  # Buffer not full yet.
+            evbuffer_add(&self.write_eb, <void_constp>p, n)
+            coio_c_writeall(&self.write_owi,
+                            <char_constp>self.write_eb.buf,
+                            self.write_eb.off)
+            self.write_eb.buf = self.write_eb.orig_buffer
+            self.write_eb.misalign = 0
+            self.write_eb.off = 0
+        else:
+            if self.write_eb.off > 0:
+                # Flush self.write_eb.
+                coio_c_writeall(&self.write_owi,
+                                <char_constp>self.write_eb.buf,
+                                self.write_eb.off)
+                self.write_eb.buf = self.write_eb.orig_buffer
+                self.write_eb.misalign = 0
+                self.write_eb.off = 0
+            # Flush lines directly from the argument.
+            coio_c_writeall(&self.write_owi, p, n)
+        if keepc > 0:
+            p += n
+            if self.write_eb.totallen == 0:
+                # Use the read buffer size as an approximation for the
+                # write buffer size.
+                evbuffer_expand(&self.write_eb,
+                                self.c_min_read_buffer_size)
+            evbuffer_add(&self.write_eb, <void_constp>p, keepc)
+    else:  # Non-line buffering.
+        if self.write_eb.off != 0:  # Expand and flush if not empty.
+            if self.write_eb.totallen == 0:
+                evbuffer_expand(&self.write_eb, wlimit)
+            k = self.write_eb.totallen - (
+                self.write_eb.off + self.write_eb.misalign)
+            if k > n:  # Buffer not full yet.
+                evbuffer_add(&self.write_eb, <void_constp>p, n)
+                return 0
+            evbuffer_add(&self.write_eb, <void_constp>p, k)
+            p += k
+            n -= k
+
+            # Flush self.write_eb.
+            # TODO(pts): Speed: return early even if coio_c_writeall
+            # couldn't write everything yet (EAGAIN). Do this everywhere.
+            coio_c_writeall(&self.write_owi,
+                            <char_constp>self.write_eb.buf,
+                            self.write_eb.off)
+            self.write_eb.buf = self.write_eb.orig_buffer
+            self.write_eb.misalign = 0
+            self.write_eb.off = 0
+
+        if n >= wlimit:
+            # Flush directly from the argument.
+            coio_c_writeall(&self.write_owi, p, n)
+        else:
+            if self.write_eb.totallen == 0:
+                evbuffer_expand(&self.write_eb, wlimit)
+            evbuffer_add(&self.write_eb, <void_constp>p, n)
+    return 0
+
+cdef int nbfile_flush(nbfile self) except -1:
+    # Please note that this function may raise an error even if parts of the
+    # buffer has been flushed.
+    if self.write_eb.off > 0:
+        coio_c_writeall(&self.write_owi,
+                        <char_constp>self.write_eb.buf, self.write_eb.off)
+        self.write_eb.buf = self.write_eb.orig_buffer
+        self.write_eb.misalign = 0
+        self.write_eb.off = 0
+    return 0
+
 cdef class nbfile:
     """A non-blocking file (I/O channel).
 
@@ -1163,8 +2100,8 @@ cdef class nbfile:
             # SUXX: Pyrex or Cython wouldn't catch the type error if we had
             # None instead of -1.0 here.
             self.read_owi.timeout_value = self.write_owi.timeout_value = -1.0
-            self.read_owi.ev.ev_callback = self.write_owi.ev.ev_callback = (
-                HandleCWakeup)
+            coio_c_edge_watch_set_callback(&self.read_owi.ev, HandleCWakeup)
+            coio_c_edge_watch_set_callback(&self.write_owi.ev, HandleCWakeup)
         else:
             timeout_double = timeout
             if timeout_double < 0.0:
@@ -1179,8 +2116,10 @@ cdef class nbfile:
                 self.read_owi.tv.tv_usec = <unsigned int>(
                     (timeout_double - <double>self.read_owi.tv.tv_sec) * 1000000.0)
             self.write_owi.tv = self.read_owi.tv
-            self.read_owi.ev.ev_callback = self.write_owi.ev.ev_callback = (
-                HandleCTimeoutWakeup)
+            coio_c_edge_watch_set_callback(&self.read_owi.ev,
+                                           HandleCTimeoutWakeup)
+            coio_c_edge_watch_set_callback(&self.write_owi.ev,
+                                           HandleCTimeoutWakeup)
 
     def fileno(nbfile self):
         if self.read_owi.fd >= 0:
@@ -1201,9 +2140,38 @@ cdef class nbfile:
        """Return and forget the write file descriptor."""
        cdef int retval
        retval = self.write_owi.fd
+       coio_c_edge_watch_stop(&self.write_owi.ev)
        self.write_owi.fd = -1
        return retval
 
+    def set_persistent_watch(nbfile self, char do_watch):
+        """With True, watch the fds with persistent, edge-triggered events.
+
+        By default, each read or write which would block registers a one-shot
+        event for the fd, and removes it after the wakeup, which is 2 system
+        calls per wait with epoll(7). With True, the fds are registered once
+        (until self.close()), and a blocked read or write without a timeout
+        just waits for the next readiness notification. Does nothing if the
+        event library doesn't support it (see has_feature_edge_triggered()).
+
+        This method is not present in standard file.
+
+        Returns:
+          self
+        """
+        if do_watch:
+            if not self.c_closed:
+                if self.read_owi.fd >= 0:
+                    coio_c_edge_watch_start(&self.read_owi.ev,
+                                            HandleCEdgeWakeup)
+                if self.write_owi.fd >= 0:
+                    coio_c_edge_watch_start(&self.write_owi.ev,
+                                            HandleCEdgeWakeup)
+        else:
+            coio_c_edge_watch_stop(&self.read_owi.ev)
+            coio_c_edge_watch_stop(&self.write_owi.ev)
+        return self
+
     def close(nbfile self):
         cdef int got
         self.sslobj = None
@@ -1214,6 +2182,8 @@ cdef class nbfile:
         finally:
             evbuffer_reset(&self.read_eb)  # Also free the allocated buffer.
             evbuffer_reset(&self.write_eb)
+            coio_c_edge_watch_stop(&self.read_owi.ev)
+            coio_c_edge_watch_stop(&self.write_owi.ev)
             if not self.c_closed:
                 self.c_closed = 1
                 if self.c_do_close:
@@ -1340,109 +2310,30 @@ cdef class nbfile:
             evbuffer_add(&self.read_eb, <void_constp>p, n)
 
     def write(nbfile self, object buf):
-        # TODO(pts): Flush the buffer eventually automatically.
         cdef char_constp p
-        cdef Py_ssize_t k
         cdef Py_ssize_t n
-        cdef int wlimit
-        cdef int keepc
         PyObject_AsCharBuffer(buf, &p, &n)
-        if n <= 0:
-            return
-        wlimit = self.c_write_buffer_limit
-        # Adding write_eb as a local variable here wouldn't make it any
-        # faster.
-        if wlimit == 2:  # Infinite write buffer.
-            evbuffer_add(&self.write_eb, <void_constp>p, n)
-            return
-        if wlimit == 0 and self.write_eb.off == 0:
-            # Direct output without buffering. We check for the empty buffer
-            # above so we wouldn't take this shortcut if the buffer wasn't
-            # empty.
-            # TODO(pts): Use the socket timeout.
-            coio_c_writeall(&self.write_owi, p, n)
-            return
-        if wlimit == 1:  # Line buffering.
-            k = n
-            while k > 0 and (<char*>p)[k - 1] != c'\n':
-                k -= 1
-            if k == 0:  # No newline yet, so add the whole p to write_eb.
-                evbuffer_expand(&self.write_eb, self.c_min_read_buffer_size)
-                evbuffer_add(&self.write_eb, <void_constp>p, n)
-                return
-            keepc = n - k
-            n = k
-            # We can flush everything up to p[:n].
+        nbfile_write(self, p, n)
 
-            k = self.write_eb.totallen - (
-                self.write_eb.off + self.write_eb.misalign)
-            if k > n:  # Buffer not full yet.
-                evbuffer_add(&self.write_eb, <void_constp>p, n)
-                coio_c_writeall(&self.write_owi,
-                                <char_constp>self.write_eb.buf,
-                                self.write_eb.off)
-                self.write_eb.buf = self.write_eb.orig_buffer
-                self.write_eb.misalign = 0
-                self.write_eb.off = 0
-            else:
-                if self.write_eb.off > 0:
-                    # Flush self.write_eb.
-                    coio_c_writeall(&self.write_owi,
-                                    <char_constp>self.write_eb.buf,
-                                    self.write_eb.off)
-                    self.write_eb.buf = self.write_eb.orig_buffer
-                    self.write_eb.misalign = 0
-                    self.write_eb.off = 0
-                # Flush lines directly from the argument.
-                coio_c_writeall(&self.write_owi, p, n)
-            if keepc > 0:
-                p += n
-                if self.write_eb.totallen == 0:
-                    # Use the read buffer size as an approximation for the
-                    # write buffer size.
-                    evbuffer_expand(&self.write_eb,
-                                    self.c_min_read_buffer_size)
-                evbuffer_add(&self.write_eb, <void_constp>p, keepc)
-        else:  # Non-line buffering.
-            if self.write_eb.off != 0:  # Expand and flush if not empty.
-                if self.write_eb.totallen == 0:
-                    evbuffer_expand(&self.write_eb, wlimit)
-                k = self.write_eb.totallen - (
-                    self.write_eb.off + self.write_eb.misalign)
-                if k > n:  # Buffer not full yet.
-                    evbuffer_add(&self.write_eb, <void_constp>p, n)
-                    return
-                evbuffer_add(&self.write_eb, <void_constp>p, k)
-                p += k
-                n -= k
+    def flush(nbfile self):
+        nbfile_flush(self)
 
-                # Flush self.write_eb.
-                # TODO(pts): Speed: return early even if coio_c_writeall
-                # couldn't write everything yet (EAGAIN). Do this everywhere.
-                coio_c_writeall(&self.write_owi,
-                                <char_constp>self.write_eb.buf,
-                                self.write_eb.off)
-                self.write_eb.buf = self.write_eb.orig_buffer
-                self.write_eb.misalign = 0
-                self.write_eb.off = 0
+    def sendfile(nbfile self, int in_fd, offset, size):
+        """Flush the write buffer, and send a region of a regular file.
 
-            if n >= wlimit:
-                # Flush directly from the argument.
-                coio_c_writeall(&self.write_owi, p, n)
-            else:
-                if self.write_eb.totallen == 0:
-                    evbuffer_expand(&self.write_eb, wlimit)
-                evbuffer_add(&self.write_eb, <void_constp>p, n)
+        The data is sent with sendfile(2) if possible (not for SSL), without
+        copying it to the Python heap.
 
-    def flush(nbfile self):
-        # Please note that this method may raise an error even if parts of the
-        # buffer has been flushed.
-        if self.write_eb.off > 0:
-            coio_c_writeall(&self.write_owi,
-                            <char_constp>self.write_eb.buf, self.write_eb.off)
-            self.write_eb.buf = self.write_eb.orig_buffer
-            self.write_eb.misalign = 0
-            self.write_eb.off = 0
+        Args:
+          in_fd: File descriptor of the regular file to send from. Its file
+            position is not changed.
+          offset: Offset of the first byte to send in the file.
+          size: Number of bytes to send.
+        Returns:
+          The number of bytes sent, which is less than size on EOF.
+        """
+        nbfile_flush(self)
+        return coio_c_sendfile(&self.write_owi, in_fd, offset, size)
 
     property read_buffer_len:
         def __get__(nbfile self):
@@ -1493,7 +2384,9 @@ cdef class nbfile:
         cdef event_t *wakeup_ev_ptr
         cdef timeval tv
         cdef double timeout_double
-        # !! TODO(pts): Speed: return early if already readable.
+        # Return early if already readable, without a main loop iteration.
+        if self.read_eb.off or coio_c_is_readable(self.read_owi.fd):
+            return True
         if timeout is None:
             return (coio_c_wait(&self.read_owi.ev, NULL)
                     is coio_event_happened_token)
@@ -1548,6 +2441,41 @@ cdef class nbfile:
         """
         return nbfile_read_http_reqhead(self, limit)
 
+    def read_http_request_env(nbfile self, limit, default_env):
+        """Read a HTTP request head, and return a new WSGI environment.
+
+        This is a faster alternative of read_http_reqhead for WSGI servers:
+        it populates a copy of default_env in a single pass, without
+        creating intermediate lists and tuples. Only HTTP/1.0 and HTTP/1.1
+        requests with a valid suburl are accepted, special requests
+        (policy-file, SSL) are not recognized.
+
+        The following keys are set in the returned env: REQUEST_METHOD,
+        SERVER_PROTOCOL, SCRIPT_NAME, PATH_INFO, QUERY_STRING,
+        CONTENT_LENGTH, CONTENT_TYPE and HTTP_*, except for the headers
+        Connection:, Keep-Alive: and Proxy-*:. Multiple values of
+        comma-separated headers (see wsgi.COMMA_SEPARATED_REQHEAD) are
+        joined with ', '. The keys of well-known headers are interned.
+
+        Returns:
+          (env, content_length, do_keep_alive), where content_length is
+          the value of the Content-Length: header (or None if missing), and
+          do_keep_alive is a bool indicating if the client has requested
+          keep-alive (based on the HTTP version and the Connection: header).
+        Raises:
+          EOFError: If an EOF was found before the end of the request.
+          IndexError: If the request was too long.
+          ValueError: On a request parse error.
+          IOError: On any other I/O error.
+        """
+        cdef Py_ssize_t content_length
+        cdef char do_keep_alive
+        env = nbfile_read_http_request_env(
+            self, limit, default_env, &content_length, &do_keep_alive)
+        if content_length < 0:
+            return env, None, bool(do_keep_alive)
+        return env, content_length, bool(do_keep_alive)
+
     def read_at_most(nbfile self, int n):
         """Read at most n bytes and return the string.
 
@@ -1957,6 +2885,15 @@ cdef class nbfile:
 
 # --- nblimitreader
 
+cdef class nblimitreader
+
+cdef Py_ssize_t nblimitreader_discard_to_read_limit(nblimitreader self) except -1:
+    if self.limit != 0:
+        self.limit = nbfile_discard(self.f, self.limit)
+        if self.limit == 0:
+            self.f = None
+    return self.limit
+
 cdef class nblimitreader:
     """Class reading from an nbfile, limiting it at the specified position."""
 
@@ -2086,12 +3023,980 @@ cdef class nblimitreader:
         return self
 
     def discard_to_read_limit(nblimitreader self):
+        return nblimitreader_discard_to_read_limit(self)
+
+# --- nbchunkedreader
+
+cdef class nbchunkedreader
+
+cdef enum:
+    # Maximum size of a chunk head or trailer line in a chunked HTTP request
+    # body, including the line terminator.
+    NBCHUNKEDREADER_MAX_LINE_SIZE = 8192
+
+# Return the size of the first line (including the '\n') in the read buffer
+# of self.f, reading more if needed. Returns 0 on EOF.
+cdef Py_ssize_t nbchunkedreader_find_line(nbchunkedreader self) except -1:
+    cdef nbfile f
+    cdef char_constp q
+    cdef Py_ssize_t min_off
+    f = self.f
+    min_off = 0
+    while 1:
+        q = <char_constp>memchr(<void_constp>(f.read_eb.buf + min_off), c'\n',
+                                f.read_eb.off - min_off)
+        if q != NULL:
+            return q - <char_constp>f.read_eb.buf + 1
+        min_off = f.read_eb.off
+        try:
+            nbfile_read_more1(f, NBCHUNKEDREADER_MAX_LINE_SIZE)
+        except EOFError:
+            return 0
+        except IndexError:
+            raise (<object>f.read_owi.exc_class)(
+                EINVAL, 'HTTP chunk head too long')
+
+# Read the next chunk head (and the trailer after the last chunk) unless
+# self.chunk_left > 0. Returns self.chunk_left, which is 0 at the end of the
+# chunked body (and then self.f is None).
+cdef Py_ssize_t nbchunkedreader_next_chunk(nbchunkedreader self) except -1:
+    cdef Py_ssize_t n
+    cdef char *p
+    if self.chunk_left > 0 or self.f is None:
+        return self.chunk_left
+    if self.is_after_chunk:  # Consume the CRLF after the chunk data.
+        n = nbchunkedreader_find_line(self)
+        p = <char*>self.f.read_eb.buf
+        if n == 0:
+            self.is_truncated = 1
+            self.f = None
+            return 0
+        if n > 2 or (n == 2 and p[0] != c'\r'):
+            raise (<object>self.f.read_owi.exc_class)(
+                EINVAL, 'bad HTTP chunk end')
+        evbuffer_drain(&self.f.read_eb, n)
+        self.is_after_chunk = 0
+    n = nbchunkedreader_find_line(self)
+    if n == 0:
+        self.is_truncated = 1
+        self.f = None
+        return 0
+    self.chunk_left = coio_c_http_parse_chunk_size(
+        <char_constp>self.f.read_eb.buf, n - 1)
+    if self.chunk_left < 0:
+        self.chunk_left = 0
+        raise (<object>self.f.read_owi.exc_class)(
+            EINVAL, 'bad HTTP chunk head')
+    evbuffer_drain(&self.f.read_eb, n)
+    if self.chunk_left > 0:
+        self.is_after_chunk = 1
+        return self.chunk_left
+    # Discard the trailer (header lines after the last chunk).
+    while 1:
+        n = nbchunkedreader_find_line(self)
+        if n == 0:
+            self.is_truncated = 1
+            break
+        p = <char*>self.f.read_eb.buf
+        evbuffer_drain(&self.f.read_eb, n)
+        if n == 1 or (n == 2 and p[0] == c'\r'):
+            break
+    self.f = None
+    return 0
+
+# Account for got bytes read from the current chunk. is_eof indicates that
+# EOF was reached before the end of the chunk.
+cdef void nbchunkedreader_consumed(nbchunkedreader self, Py_ssize_t got,
+                                   char is_eof):
+    if is_eof:
+        self.chunk_left = 0
+        self.is_truncated = 1
+        self.f = None
+    else:
+        self.chunk_left -= got
+
+cdef Py_ssize_t nbchunkedreader_discard_to_read_limit(
+    nbchunkedreader self) except -1:
+    while nbchunkedreader_next_chunk(self):
+        if nbfile_discard(self.f, self.chunk_left):
+            self.is_truncated = 1
+            self.f = None
+        self.chunk_left = 0
+    return self.is_truncated
+
+# Read a line of at most limit bytes (unlimited if negative), possibly
+# spanning multiple chunks.
+cdef object nbchunkedreader_readline(nbchunkedreader self, Py_ssize_t limit,
+                                     char c_delim):
+    cdef object buf
+    cdef object piece
+    cdef list bufs
+    cdef char *p
+    cdef Py_ssize_t n
+    cdef Py_ssize_t got
+    bufs = None
+    buf = ''
+    while limit != 0 and nbchunkedreader_next_chunk(self):
+        n = self.chunk_left
+        if limit > 0 and limit < n:
+            n = limit
+        piece = nbfile_readline_with_limit(self.f, n, c_delim)
+        if bufs is not None:
+            bufs.append(piece)
+        elif len(buf):
+            bufs = [buf, piece]
+        else:
+            buf = piece
+        got = len(piece)
+        p = piece
+        if got > 0 and p[got - 1] == c_delim:
+            nbchunkedreader_consumed(self, got, 0)
+            break
+        nbchunkedreader_consumed(self, got, got < n)
+        if limit > 0:
+            limit -= got
+    if bufs is None:
+        return buf
+    return ''.join(bufs)
+
+cdef class nbchunkedreader:
+    """Class reading a HTTP/1.1 chunked body from an nbfile, decoding it.
+
+    It has the same reading API as nblimitreader. The chunk heads are parsed
+    in the read buffer of the nbfile. The chunk trailer is discarded. Syntax
+    errors in the chunked encoding raise the read exception class of the
+    nbfile (IOError by default) with errno EINVAL.
+    """
+
+    cdef nbfile f
+    # Number of bytes not read yet from the current chunk.
+    cdef Py_ssize_t chunk_left
+    # Is the CRLF after the data of the current chunk not read yet?
+    cdef char is_after_chunk
+    # Has EOF been reached before the end of the chunked body?
+    cdef char is_truncated
+
+    def __init__(nbchunkedreader self, nbfile f):
+        self.f = f
+
+    def read(nbchunkedreader self, size=-1):
+        cdef object buf
+        cdef object piece
+        cdef list bufs
+        cdef Py_ssize_t c_size
+        cdef Py_ssize_t n
+        cdef Py_ssize_t got
+        c_size = size
+        bufs = None
+        buf = ''
+        while c_size != 0 and nbchunkedreader_next_chunk(self):
+            n = self.chunk_left
+            if c_size > 0 and c_size < n:
+                n = c_size
+            piece = nbfile_read(self.f, n)
+            if bufs is not None:
+                bufs.append(piece)
+            elif len(buf):
+                bufs = [buf, piece]
+            else:
+                buf = piece
+            got = len(piece)
+            nbchunkedreader_consumed(self, got, got < n)
+            if c_size > 0:
+                c_size -= got
+        if bufs is None:
+            return buf
+        return ''.join(bufs)
+
+    def readline(nbchunkedreader self, int limit=-1, delim=None):
+        cdef char c_delim
+        if delim is None:
+            c_delim = c'\n'
+        else:
+            c_delim = ord(delim)
+        return nbchunkedreader_readline(self, limit, c_delim)
+
+    def readline_stripend(nbchunkedreader self, int limit=-1, delim=None):
+        """Read a line, return it with delim stripped from the end.
+
+        Args:
+          limit: Number of bytes to read at most. Specify -1 for unlimited.
+          delim: Character to be used as a line delimiter, or None to use
+            either '\\r\\n' or '\\n'.
+        Returns:
+          The line read, with delim stripped from the end, or None on EOF or
+          on an incomplete line before EOF.
+        """
+        cdef object buf
         cdef Py_ssize_t size
-        if self.limit != 0:
-            self.limit = nbfile_discard(self.f, self.limit)
-            if self.limit == 0:
-                self.f = None
-        return self.limit
+        cdef char c_delim
+        cdef char *p
+        if delim is None:
+            c_delim = c'\n'
+        else:
+            c_delim = ord(delim)
+        buf = nbchunkedreader_readline(self, limit, c_delim)
+        size = len(buf)
+        p = buf
+        if size == 0 or p[size - 1] != c_delim:
+            return None
+        size = size - 1
+        if delim is None and size > 0 and p[size - 1] == c'\r':
+            size = size - 1
+        return PyString_FromStringAndSize(<char_constp>p, size)
+
+    def readlines(nbchunkedreader self, hint=None):
+        cdef list retval
+        cdef object buf
+        retval = []
+        while 1:
+            buf = nbchunkedreader_readline(self, -1, c'\n')
+            if not len(buf):
+                return retval
+            retval.append(buf)
+
+    def __next__(nbchunkedreader self):
+        cdef object buf
+        buf = nbchunkedreader_readline(self, -1, c'\n')
+        if not len(buf):
+            raise StopIteration
+        return buf
+
+    def __iter__(nbchunkedreader self):
+        return self
+
+    def discard_to_read_limit(nbchunkedreader self):
+        """Discard the rest of the chunked body.
+
+        Returns:
+          0 on success, nonzero on EOF before the end of the chunked body.
+        """
+        return nbchunkedreader_discard_to_read_limit(self)
+
+# --- WSGI fast path
+
+# The syncless.wsgi module and some of its attributes, imported lazily by
+# wsgi_fast_request, because syncless.wsgi imports coio.
+cdef object wsgi_module
+wsgi_module = None
+cdef object wsgi_read_error
+cdef object wsgi_write_error
+cdef object wsgi_response_syntax_error
+cdef object wsgi_response_body_too_long_error
+cdef object wsgi_get_http_date
+cdef object wsgi_respond_with_bad
+cdef object wsgi_report_app_exception
+cdef object wsgi_prepend_iterator
+cdef object wsgi_consumer_worker
+cdef object wsgi_file_wrapper
+cdef object wsgi_log_error
+cdef dict wsgi_header_line_cache
+# Maps (http_version, status) to the first 3 lines of the HTTP response head
+# (status line, Server: and Date:), for wsgi_fast_head_date and
+# wsgi_fast_head_server_software.
+cdef dict wsgi_fast_head_cache
+wsgi_fast_head_cache = {}
+cdef object wsgi_fast_head_date
+cdef object wsgi_fast_head_server_software
+
+cdef int wsgi_fast_import() except -1:
+    global wsgi_module, wsgi_read_error, wsgi_write_error
+    global wsgi_response_syntax_error, wsgi_response_body_too_long_error
+    global wsgi_get_http_date
+    global wsgi_respond_with_bad, wsgi_report_app_exception
+    global wsgi_prepend_iterator, wsgi_consumer_worker, wsgi_log_error
+    global wsgi_file_wrapper
+    global wsgi_header_line_cache
+    from syncless import wsgi
+    wsgi_read_error = wsgi.WsgiReadError
+    wsgi_write_error = wsgi.WsgiWriteError
+    wsgi_response_syntax_error = wsgi.WsgiResponseSyntaxError
+    wsgi_response_body_too_long_error = wsgi.WsgiResponseBodyTooLongError
+    wsgi_get_http_date = wsgi.GetCurrentHttpDate
+    wsgi_respond_with_bad = wsgi.RespondWithBad
+    wsgi_report_app_exception = wsgi.ReportAppException
+    wsgi_prepend_iterator = wsgi.PrependIterator
+    wsgi_consumer_worker = wsgi.ConsumerWorker
+    wsgi_file_wrapper = wsgi.WsgiFileWrapper
+    wsgi_log_error = wsgi.logging.error
+    wsgi_header_line_cache = wsgi.RESPONSE_HEADER_LINE_CACHE
+    wsgi_module = wsgi
+
+cdef class wsgi_fast_response
+
+cdef enum:
+    # Maximum number of bytes in responses to pipelined requests kept in the
+    # write buffer before flushing.
+    WSGI_FAST_MAX_PIPELINED_RESPONSE_SIZE = 65536
+
+# Discard the buffered (not flushed) part of the HTTP response, but keep the
+# buffered responses to previous pipelined requests.
+cdef void wsgi_fast_discard_response(wsgi_fast_response self):
+    if self.headers_sent:
+        evbuffer_drain(&self.sockfile.write_eb, self.sockfile.write_eb.off)
+    elif self.sockfile.write_eb.off > self.head_off:
+        self.sockfile.write_eb.off = self.head_off
+
+# Flush the write buffer at the end of the HTTP response, unless the
+# connection is kept alive and the next pipelined request is already in the
+# read buffer. This way the responses to pipelined requests are sent with a
+# single write(2).
+cdef int wsgi_fast_flush_response(wsgi_fast_response self) except -1:
+    cdef nbfile sockfile
+    sockfile = self.sockfile
+    if not (self.do_keep_alive and
+            sockfile.write_eb.off <= WSGI_FAST_MAX_PIPELINED_RESPONSE_SIZE and
+            coio_c_wsgi_is_request_buffered(
+                <char_constp>sockfile.read_eb.buf, sockfile.read_eb.off)):
+        nbfile_flush(sockfile)
+
+# Finish the HTTP response headers (not flushed).
+cdef int wsgi_fast_end_head(wsgi_fast_response self,
+                            char do_keep_alive) except -1:
+    self.do_keep_alive = do_keep_alive
+    if do_keep_alive:
+        nbfile_write(self.sockfile, <char_constp><char*>
+                     'Connection: Keep-Alive\r\n\r\n', 26)
+    else:
+        nbfile_write(self.sockfile, <char_constp><char*>
+                     'Connection: close\r\n\r\n', 21)
+
+# Finish the HTTP response headers (not flushed) of a non-HEAD response
+# without Content-Length. Uses Transfer-Encoding: chunked for HTTP/1.1
+# keep-alive requests, so the connection can be kept alive.
+cdef int wsgi_fast_end_head_without_length(
+    wsgi_fast_response self) except -1:
+    if self.do_req_keep_alive and self.http_version is http_version_1_1:
+        nbfile_write(self.sockfile, <char_constp><char*>
+                     'Transfer-Encoding: chunked\r\n', 28)
+        self.is_chunked = 1
+        self.chunk_off = -1
+        wsgi_fast_end_head(self, 1)
+    else:
+        wsgi_fast_end_head(self, 0)
+
+# Discard the unread part of the HTTP request body.
+cdef int wsgi_fast_discard_input(wsgi_fast_response self) except -1:
+    if nblimitreader_discard_to_read_limit(self.input):
+        raise wsgi_read_error(EISDIR, 'could not discard HTTP request body')
+
+# Write the first nonempty piece of the HTTP response body (p[:n]), and
+# switch sockfile to unbuffered mode.
+cdef int wsgi_fast_write_first(wsgi_fast_response self, char_constp p,
+                               Py_ssize_t n) except -1:
+    cdef nbfile sockfile
+    sockfile = self.sockfile
+    if 0 < n and n <= 65536:
+        nbfile_write(sockfile, p, n)  # Still buffering it.
+        nbfile_flush(sockfile)
+        sockfile.c_write_buffer_limit = 0  # Unbuffered.
+    else:
+        nbfile_flush(sockfile)
+        sockfile.c_write_buffer_limit = 0  # Unbuffered.
+        nbfile_write(sockfile, p, n)
+    self.headers_sent = 1
+
+cdef class wsgi_fast_response:
+    """start_response callable used by wsgi_fast_request.
+
+    This is the counterpart of StartResponse, WriteHead and WriteNotHead in
+    WsgiWorker in syncless/wsgi.py.
+    """
+    cdef nbfile sockfile
+    cdef nblimitreader input
+    cdef object http_version
+    cdef object server_software
+    cdef object date
+    cdef char is_not_head
+    cdef char do_req_keep_alive
+    cdef char do_keep_alive
+    cdef char headers_sent
+    # Use Transfer-Encoding: chunked for the response body.
+    cdef char is_chunked
+    # Offset of the current batch chunk in sockfile.write_eb, or -1.
+    cdef Py_ssize_t chunk_off
+    # Offset of the response head in sockfile.write_eb. Responses to
+    # previous pipelined requests may precede it.
+    cdef Py_ssize_t head_off
+    cdef char has_content_length
+    cdef Py_ssize_t content_length
+    # Number of bytes remaining. Checked and updated only for non-HEAD
+    # responses.
+    cdef Py_ssize_t content_length_remaining
+
+    def __call__(wsgi_fast_response self, status, response_headers,
+                 exc_info=None):
+        cdef nbfile sockfile
+        cdef char_constp p
+        cdef Py_ssize_t n
+        cdef char_constp q
+        cdef Py_ssize_t k
+        # Just ignore exc_info, because we don't have to re-raise it since
+        # we haven't sent any headers yet.
+        sockfile = self.sockfile
+
+        # Called again by an error handler: ignore the headers previously
+        # buffered, so we can start generating the error header.
+        if sockfile.write_eb.off > self.head_off:
+            wsgi_fast_discard_response(self)
+            self.has_content_length = 0
+
+        global wsgi_fast_head_date, wsgi_fast_head_server_software
+        if (self.date != wsgi_fast_head_date or
+            self.server_software != wsgi_fast_head_server_software):
+            wsgi_fast_head_cache.clear()
+            wsgi_fast_head_date = self.date
+            wsgi_fast_head_server_software = self.server_software
+        status = str(status)
+        head_key = (self.http_version, status)
+        head = wsgi_fast_head_cache.get(head_key)
+        if head is None:
+            PyObject_AsCharBuffer(status, &p, &n)
+            if not coio_c_is_http_response_status(p, n):
+                raise wsgi_response_syntax_error(
+                    'bad HTTP response status: %r' % (status,))
+            head = '%s %s\r\nServer: %s\r\nDate: %s\r\n' % (
+                self.http_version, status, self.server_software, self.date)
+            if len(wsgi_fast_head_cache) >= 64:
+                wsgi_fast_head_cache.clear()
+            wsgi_fast_head_cache[head_key] = head
+        PyObject_AsCharBuffer(head, &p, &n)
+        nbfile_write(sockfile, p, n)
+        for key_value in response_headers:
+            key, value = key_value
+            is_cacheable = (type(key_value) is tuple and type(key) is str and
+                            type(value) is str)
+            key = str(key).lower()
+            # We send Transfer-Encoding ourselves (if needed). The filtered
+            # keys must not be looked up in wsgi_header_line_cache.
+            if (key == 'status' or key == 'server' or key == 'date' or
+                key == 'connection' or key == 'transfer-encoding' or
+                key.startswith('proxy-')):
+                continue
+            if is_cacheable:
+                line = wsgi_header_line_cache.get(key_value)
+                if line is not None:
+                    PyObject_AsCharBuffer(line, &p, &n)
+                    nbfile_write(sockfile, p, n)
+                    continue
+            if key == 'content-length':
+                # Apache responds with content-type for HEAD requests.
+                if not self.is_not_head:
+                    continue
+                try:
+                    self.content_length = int(str(value))
+                except (ValueError, OverflowError):
+                    raise wsgi_response_syntax_error(
+                        'bad content-length: %r' % (value,))
+                self.content_length_remaining = self.content_length
+                self.has_content_length = 1
+                is_cacheable = 0
+            elif key == 'content-transfer-encoding':
+                if not self.is_not_head:
+                    continue
+                is_cacheable = 0
+            else:
+                PyObject_AsCharBuffer(key, &p, &n)
+                if not coio_c_is_http_header_key(p, n):
+                    raise wsgi_response_syntax_error('invalid key: %r' % key)
+            value = str(value).strip()
+            PyObject_AsCharBuffer(key, &p, &n)
+            PyObject_AsCharBuffer(value, &q, &k)
+            if not coio_c_is_http_header_value(q, k):
+                raise wsgi_response_syntax_error(
+                    'invalid value for key %r: %r' % (key, value))
+            # TODO(pts): Eliminate duplicate keys (except for set-cookie).
+            if coio_c_evbuffer_add_http_header(
+                &sockfile.write_eb, p, n, q, k) < 0:
+                raise MemoryError
+            if is_cacheable:
+                n = n + k + 4  # Size of the line just added.
+                line = PyString_FromStringAndSize(<char_constp>(
+                    <char*>sockfile.write_eb.buf +
+                    sockfile.write_eb.off - n), n)
+                if (len(wsgi_header_line_cache) >=
+                    wsgi_module.RESPONSE_HEADER_LINE_CACHE_MAX_SIZE):
+                    wsgi_header_line_cache.clear()
+                wsgi_header_line_cache[key_value] = line
+        # Don't flush yet.
+        return self.write
+
+    def write(wsgi_fast_response self, data):
+        """WSGI write() callable returned by start_response to the app."""
+        cdef nbfile sockfile
+        cdef char_constp p
+        cdef Py_ssize_t n
+        data = str(data)
+        PyObject_AsCharBuffer(data, &p, &n)
+        if n == 0:
+            return
+        sockfile = self.sockfile
+        if not self.is_not_head:
+            if not self.headers_sent:
+                wsgi_fast_end_head(self, self.do_req_keep_alive)
+                wsgi_fast_discard_input(self)
+                nbfile_flush(sockfile)
+                self.headers_sent = 1
+        elif self.headers_sent:
+            if self.is_chunked:
+                wsgi_fast_add_chunk(self, p, n)
+                nbfile_flush(sockfile)
+                return
+            if self.has_content_length:
+                self.content_length_remaining = (
+                    self.content_length_remaining - n)
+                if self.content_length_remaining < 0:
+                    nbfile_write(sockfile, p, n + self.content_length_remaining)
+                    raise wsgi_response_body_too_long_error
+            # Autoflush because we've set up c_write_buffer_limit = 0
+            # previously.
+            nbfile_write(sockfile, p, n)
+        elif self.has_content_length:
+            wsgi_fast_end_head(self, self.do_req_keep_alive)
+            self.content_length_remaining = (
+                self.content_length_remaining - n)
+            if self.content_length_remaining < 0:
+                nbfile_flush(sockfile)
+                sockfile.c_write_buffer_limit = 0
+                nbfile_write(sockfile, p, n + self.content_length_remaining)
+                raise wsgi_response_body_too_long_error
+            wsgi_fast_write_first(self, p, n)
+            wsgi_fast_discard_input(self)
+        else:
+            wsgi_fast_end_head_without_length(self)
+            if self.is_chunked:
+                wsgi_fast_add_chunk(self, p, n)
+                nbfile_flush(sockfile)
+                self.headers_sent = 1
+            else:
+                wsgi_fast_write_first(self, p, n)
+            wsgi_fast_discard_input(self)
+
+# Finish the current batch chunk (if any) of a chunked response.
+cdef int wsgi_fast_end_chunk(wsgi_fast_response self) except -1:
+    if self.chunk_off >= 0:
+        if coio_c_evbuffer_end_http_chunk(
+            &self.sockfile.write_eb, self.chunk_off) < 0:
+            raise MemoryError
+        self.chunk_off = -1
+
+# Add p[:n] as a separate chunk of a chunked response to the write buffer,
+# finishing the current batch first.
+cdef int wsgi_fast_add_chunk(wsgi_fast_response self, char_constp p,
+                             Py_ssize_t n) except -1:
+    wsgi_fast_end_chunk(self)
+    if coio_c_evbuffer_add_http_chunk_head(&self.sockfile.write_eb, n) < 0:
+        raise MemoryError
+    nbfile_write(self.sockfile, p, n)
+    nbfile_write(self.sockfile, <char_constp><char*>'\r\n', 2)
+
+# Send the HTTP response body in items with Transfer-Encoding: chunked,
+# starting with p[:n], which is sent (and flushed) with the headers.
+#
+# Subsequent small strings yielded by items are batched into chunks of
+# (approximately) wsgi.CHUNKED_RESPONSE_BATCH_SIZE bytes in the write buffer
+# of sockfile. An empty string yielded flushes the current batch. Returns
+# the same bitmask as wsgi_fast_respond.
+#
+# Keep the output byte-for-byte identical to the chunked branch of
+# WsgiWorker in syncless/wsgi.py.
+cdef int wsgi_fast_respond_chunked(wsgi_fast_response self, object items,
+                                   char_constp p, Py_ssize_t n) except -1:
+    cdef nbfile sockfile
+    cdef evbuffer_s *write_eb
+    cdef Py_ssize_t batch_size
+    sockfile = self.sockfile
+    write_eb = &sockfile.write_eb
+    batch_size = wsgi_module.CHUNKED_RESPONSE_BATCH_SIZE
+    if n:
+        wsgi_fast_add_chunk(self, p, n)
+    nbfile_flush(sockfile)  # Implement flush-after-first-body-byte.
+    self.headers_sent = 1
+    wsgi_fast_discard_input(self)
+    # sockfile.c_write_buffer_limit is still 2 (infinite), so nbfile_write
+    # just appends to write_eb.
+    for data in items:
+        data = str(data)
+        PyObject_AsCharBuffer(data, &p, &n)
+        if n == 0:  # Flush the current batch.
+            wsgi_fast_end_chunk(self)
+            if write_eb.off:
+                nbfile_flush(sockfile)
+        elif n >= batch_size:  # Send large strings without copying.
+            wsgi_fast_end_chunk(self)
+            if coio_c_evbuffer_add_http_chunk_head(write_eb, n) < 0:
+                raise MemoryError
+            nbfile_flush(sockfile)
+            sockfile.c_write_buffer_limit = 0  # Unbuffered.
+            nbfile_write(sockfile, p, n)
+            sockfile.c_write_buffer_limit = 2
+            nbfile_write(sockfile, <char_constp><char*>'\r\n', 2)
+        else:
+            if self.chunk_off < 0:
+                self.chunk_off = coio_c_evbuffer_begin_http_chunk(write_eb)
+                if self.chunk_off < 0:
+                    raise MemoryError
+            nbfile_write(sockfile, p, n)
+            if (write_eb.off - self.chunk_off -
+                COIO_C_HTTP_CHUNK_PLACEHOLDER_SIZE >= batch_size):
+                wsgi_fast_end_chunk(self)
+                nbfile_flush(sockfile)
+    wsgi_fast_end_chunk(self)
+    nbfile_write(sockfile, <char_constp><char*>'0\r\n\r\n', 5)
+    wsgi_fast_flush_response(self)
+    return self.do_keep_alive
+
+# Send the rest of a regular file wrapped by wsgi.WsgiFileWrapper with
+# sendfile(2). sendfile_range is the (fd, offset, size) tuple returned by
+# its GetSendfileRange method.
+cdef int wsgi_fast_respond_file(wsgi_fast_response self,
+                                object sendfile_range) except -1:
+    cdef nbfile sockfile
+    cdef int fd
+    cdef long long offset
+    cdef Py_ssize_t size
+    cdef char_constp q
+    cdef Py_ssize_t k
+    sockfile = self.sockfile
+    fd = sendfile_range[0]
+    offset = sendfile_range[1]
+    size = sendfile_range[2]
+    if self.headers_sent:
+        if (self.has_content_length and
+            size != self.content_length_remaining):
+            if size > self.content_length_remaining:
+                wsgi_log_error(
+                    'truncated file content: header=%d remaining=%d file=%d'
+                    % (self.content_length, self.content_length_remaining,
+                       size))
+                size = self.content_length_remaining
+            else:
+                wsgi_log_error(
+                    'content length too large: header=%d remaining=%d '
+                    'file=%d' %
+                    (self.content_length, self.content_length_remaining,
+                     size))
+                self.do_keep_alive = 0
+    else:
+        wsgi_fast_discard_input(self)
+        if self.has_content_length:
+            if size != self.content_length_remaining:
+                wsgi_log_error(
+                    'invalid content length: header=%d remaining=%d file=%d' %
+                    (self.content_length, self.content_length_remaining,
+                     size))
+                wsgi_fast_discard_response(self)
+                wsgi_respond_with_bad(500, self.date, self.server_software,
+                                      sockfile, '')
+                return self.do_req_keep_alive
+        else:
+            buf = 'Content-Length: %d\r\n' % size
+            PyObject_AsCharBuffer(buf, &q, &k)
+            nbfile_write(sockfile, q, k)
+        wsgi_fast_end_head(self, self.do_req_keep_alive)
+        self.headers_sent = 1
+    nbfile_flush(sockfile)
+    if coio_c_sendfile(&sockfile.write_owi, fd, offset, size) != size:
+        wsgi_log_error('file truncated while sending')
+        self.do_keep_alive = 0
+    return self.do_keep_alive
+
+# Send the HTTP response body in items.
+#
+# Returns a bitmask: bit 0 is set iff the connection can be kept alive, bit 1
+# is set iff the caller shouldn't call items.close().
+cdef int wsgi_fast_respond(wsgi_fast_response self, object items) except -1:
+    cdef nbfile sockfile
+    cdef char_constp p
+    cdef Py_ssize_t n
+    cdef char_constp q
+    cdef Py_ssize_t k
+    sockfile = self.sockfile
+    if not (sockfile.write_eb.off > self.head_off or self.headers_sent):
+        wsgi_log_error('app has not called start_response')
+        wsgi_respond_with_bad(500, self.date, self.server_software, sockfile,
+                              '')
+        return 0
+    sendfile_range = None
+    if (self.is_not_head and not self.is_chunked and
+        isinstance(items, wsgi_file_wrapper)):
+        sendfile_range = items.GetSendfileRange()
+    if (isinstance(items, list) or isinstance(items, tuple) or
+        isinstance(items, str)):
+        if not self.is_not_head:
+            data = ''
+        elif isinstance(items, str):
+            data = items
+        elif len(items) == 1 and isinstance(items[0], str):
+            data = items[0]
+        else:
+            data = ''.join(map(str, items))
+        PyObject_AsCharBuffer(data, &p, &n)
+        if self.is_chunked:  # The app has called write().
+            if n:
+                wsgi_fast_add_chunk(self, p, n)
+            nbfile_write(sockfile, <char_constp><char*>'0\r\n\r\n', 5)
+            wsgi_fast_flush_response(self)
+            return self.do_keep_alive | 2
+        if self.headers_sent:
+            if (self.has_content_length and
+                n != self.content_length_remaining):
+                if n > self.content_length_remaining:
+                    # SUXX: wget(1) will keep retrying here.
+                    wsgi_log_error(
+                        'truncated content: header=%d remaining=%d body=%d' %
+                        (self.content_length, self.content_length_remaining,
+                         n))
+                    n = self.content_length_remaining
+                else:
+                    wsgi_log_error(
+                        'content length too large: header=%d remaining=%d '
+                        'body=%d' %
+                        (self.content_length, self.content_length_remaining,
+                         n))
+                    self.do_keep_alive = 0
+        else:
+            wsgi_fast_discard_input(self)
+            if self.has_content_length:
+                if n != self.content_length_remaining:
+                    wsgi_log_error(
+                        'invalid content length: header=%d remaining=%d '
+                        'body=%d' %
+                        (self.content_length, self.content_length_remaining,
+                         n))
+                    wsgi_fast_discard_response(self)
+                    wsgi_respond_with_bad(500, self.date, self.server_software,
+                                          sockfile, '')
+                    return self.do_req_keep_alive | 2
+            elif self.is_not_head:
+                buf = 'Content-Length: %d\r\n' % n
+                PyObject_AsCharBuffer(buf, &q, &k)
+                nbfile_write(sockfile, q, k)
+            wsgi_fast_end_head(self, self.do_req_keep_alive)
+        nbfile_write(sockfile, p, n)
+        wsgi_fast_flush_response(self)
+        return self.do_keep_alive | 2
+    elif sendfile_range is not None:
+        return wsgi_fast_respond_file(self, sendfile_range)
+    elif self.is_not_head:
+        if not self.headers_sent:
+            if self.has_content_length:
+                wsgi_fast_end_head(self, self.do_req_keep_alive)
+            else:
+                wsgi_fast_end_head_without_length(self)
+        # This loop just waits for the first nonempty data item in the HTTP
+        # response body.
+        data = ''
+        if self.has_content_length:
+            if self.content_length_remaining:
+                for data in items:
+                    if data:
+                        break
+                data = str(data)
+                PyObject_AsCharBuffer(data, &p, &n)
+                self.content_length_remaining = (
+                    self.content_length_remaining - n)
+                if self.content_length_remaining < 0:
+                    wsgi_log_error('truncated first yielded content')
+                    nbfile_flush(sockfile)
+                    sockfile.c_write_buffer_limit = 0
+                    nbfile_write(sockfile, p, n + self.content_length_remaining)
+                    return self.do_keep_alive
+        else:
+            for data in items:
+                if data:  # Implement flush-after-first-body-byte.
+                    break
+        data = str(data)
+        PyObject_AsCharBuffer(data, &p, &n)
+        if self.is_chunked:
+            return wsgi_fast_respond_chunked(self, items, p, n)
+        wsgi_fast_write_first(self, p, n)
+        wsgi_fast_discard_input(self)
+        if self.has_content_length:
+            for data in items:
+                data = str(data)
+                PyObject_AsCharBuffer(data, &p, &n)
+                self.content_length_remaining = (
+                    self.content_length_remaining - n)
+                if self.content_length_remaining < 0:
+                    wsgi_log_error('truncated yielded content')
+                    nbfile_write(sockfile, p, n + self.content_length_remaining)
+                    break
+                nbfile_write(sockfile, p, n)
+            if self.content_length_remaining > 0:
+                wsgi_log_error('content length too large for yield')
+                # Ignore the rest in another tasklet.
+                stackless.tasklet(wsgi_consumer_worker)(items, False)
+                return 2
+        else:
+            for data in items:
+                data = str(data)
+                PyObject_AsCharBuffer(data, &p, &n)
+                nbfile_write(sockfile, p, n)
+        return self.do_keep_alive
+    else:  # HTTP HEAD response.
+        if not self.headers_sent:
+            wsgi_fast_end_head(self, self.do_req_keep_alive)
+            wsgi_fast_discard_input(self)
+            wsgi_fast_flush_response(self)
+        # Iterate over `items' in another tasklet, so we can read the next
+        # request asynchronously from the HTTP client while the other
+        # tasklet is working. Don't run it yet, and let the request-serving
+        # tasklets run first.
+        consumer_tasklet = stackless.tasklet(wsgi_consumer_worker)(
+            items, False)
+        set_priority(consumer_tasklet, PRIORITY_BACKGROUND)
+        insert_background(consumer_tasklet)
+        return self.do_keep_alive | 2
+
+def wsgi_fast_request(nbfile sockfile, limit, default_env, wsgi_application,
+                      date):
+    """Serve a common HTTP request on sockfile, on behalf of wsgi.WsgiWorker.
+
+    This is the compiled fast path of WsgiWorker in syncless/wsgi.py: it
+    reads the HTTP request head, populates a copy of default_env, calls
+    wsgi_application, and writes the HTTP response. It serves only GET, HEAD
+    and POST requests without WebSocket and other special headers (see
+    coio_c_wsgi_prescan for the exact conditions). For any other request
+    (including SSL and policy-file requests) it returns None without
+    consuming anything from sockfile, so the caller can serve the request
+    with the pure Python code.
+
+    Args:
+      sockfile: nbfile of the HTTP connection, with write_buffer_limit=2
+        and an empty write buffer.
+      limit: Maximum number of bytes in the HTTP request head.
+      default_env: Dict containing the initial WSGI environment for the
+        connection (including REMOTE_ADDR etc.). Won't be modified.
+      wsgi_application: The WSGI application callable.
+      date: Value of the Date: response header (str), or None to get the
+        current date.
+    Returns:
+      None if the request has to be served by the caller, otherwise a bool
+      indicating whether the connection can be kept alive.
+    Raises:
+      EOFError, IndexError, ValueError: Just like read_http_reqhead.
+      IOError: On any I/O error (usually wsgi.WsgiReadError or
+        wsgi.WsgiWriteError).
+    """
+    cdef evbuffer_s *read_eb
+    cdef int got
+    cdef char c
+    cdef Py_ssize_t c_limit
+    cdef Py_ssize_t content_length
+    cdef char do_req_keep_alive
+    cdef dict env
+    cdef wsgi_fast_response response
+
+    if wsgi_module is None:
+        wsgi_fast_import()
+    c_limit = limit
+    read_eb = &sockfile.read_eb
+    # The write buffer may contain responses to previous pipelined requests
+    # (see wsgi_fast_flush_response). They are flushed before blocking and
+    # before returning to the caller.
+    if read_eb.off == 0:
+        if sockfile.write_eb.off:
+            nbfile_flush(sockfile)
+        nbfile_read_more1(sockfile, c_limit)
+    c = (<char*>read_eb.buf)[0]
+    if c < c'A' or c > c'Z':  # SSL, policy-file or junk.
+        if sockfile.write_eb.off:
+            nbfile_flush(sockfile)
+        return None
+    while 1:
+        got = coio_c_wsgi_prescan(<char_constp>read_eb.buf, read_eb.off)
+        if got > 0:
+            break
+        if sockfile.write_eb.off:
+            nbfile_flush(sockfile)
+        if got == 0:
+            return None
+        nbfile_read_more1(sockfile, c_limit)
+
+    try:
+        env = nbfile_read_http_request_env(
+            sockfile, c_limit, default_env, &content_length,
+            &do_req_keep_alive)
+    except ValueError:
+        if sockfile.write_eb.off:
+            nbfile_flush(sockfile)
+        raise
+    if date is None:
+        date = wsgi_get_http_date()
+    method = env['REQUEST_METHOD']
+    if content_length >= 0 and method is not http_method_post:
+        # coio_c_wsgi_prescan has checked that content_length == 0.
+        del env['CONTENT_LENGTH']
+    response = wsgi_fast_response()
+    response.sockfile = sockfile
+    response.head_off = sockfile.write_eb.off
+    if content_length > 0 and method is http_method_post:
+        response.input = nblimitreader(sockfile, content_length)
+    else:
+        response.input = nblimitreader(None, 0)
+    env['wsgi.input'] = response.input
+    response.http_version = env['SERVER_PROTOCOL']
+    response.server_software = env['SERVER_SOFTWARE']
+    response.date = date
+    response.is_not_head = method is not http_method_head
+    response.do_req_keep_alive = do_req_keep_alive
+
+    try:
+        items = wsgi_application(env, response)
+        if not items:
+            items = ''
+        if isinstance(items, types.GeneratorType) and not (
+            sockfile.write_eb.off > response.head_off or
+            response.headers_sent):
+            # Make sure start_response gets called now, by forcing the first
+            # iteration (yield).
+            try:
+                item = items.next()  # Only this might raise StopIteration.
+                if item:
+                    items = wsgi_prepend_iterator(item, items)
+                item = None
+            except StopIteration:
+                item = None
+    except Exception, e:
+        if (isinstance(e, wsgi_read_error) or
+            isinstance(e, wsgi_write_error)):
+            raise
+        wsgi_report_app_exception((e.__class__, e, None), 'start')
+        if not response.headers_sent:
+            wsgi_fast_discard_response(response)
+            wsgi_respond_with_bad(500, date, response.server_software,
+                                  sockfile, '')
+            return bool(do_req_keep_alive)
+        return bool(do_req_keep_alive and response.has_content_length and
+                    not (response.is_not_head and
+                         response.content_length_remaining))
+
+    try:
+        got = wsgi_fast_respond(response, items)
+    except Exception, e:
+        wsgi_fast_discard_response(response)
+        if not (isinstance(e, wsgi_read_error) or
+                isinstance(e, wsgi_write_error)):
+            wsgi_report_app_exception((e.__class__, e, None), 'yield')
+        got = 0
+    if not (got & 1) and sockfile.write_eb.off:
+        # Send the responses to previous pipelined requests.
+        nbfile_flush(sockfile)
+    if not (got & 2):
+        if hasattr(items, 'close'):  # According to the WSGI spec.
+            # The close() method defined in the app will be able to detect if
+            # `for data in items' has iterated all the way through.
+            try:
+                items.close()
+            except Exception, e:
+                if not (isinstance(e, wsgi_read_error) or
+                        isinstance(e, wsgi_write_error)):
+                    wsgi_report_app_exception((e.__class__, e, None), 'close')
+                if sockfile.write_eb.off:
+                    nbfile_flush(sockfile)
+                return False
+    return bool(got & 1)
 
 # ---
 
@@ -2161,6 +4066,10 @@ socket_realsocketpair = socket._socket.socketpair
 
 socket_fromfd = socket.fromfd
 
+# Nonzero iff coio_c_accept_nonblocking can create socket_realsocket objects.
+is_realsocket_layout_known = coio_c_is_realsocket_layout_known(
+    socket_realsocket)
+
 # We're not inheriting from socket._socket.socket, because with the current
 # socketmodule.c implementation it would be impossible to wrap the return
 # value of accept() this way.
@@ -2190,15 +4099,10 @@ cdef class nbsocket:
         else:
             self.realsock = my_socket_impl(*args, **kwargs)
         self.c_family = self.realsock.family
-        self.swi.fd = self.realsock.fileno()
         # TODO(pts): self.realsock.setblocking(False) on non-Unix operating
         # systems.
-        set_fd_nonblocking(self.swi.fd)
-        self.swi.timeout_value = -1.0
-        event_set(&self.swi.read_ev,  self.swi.fd, c_EV_READ,
-                  HandleCTimeoutWakeup, NULL)
-        event_set(&self.swi.write_ev, self.swi.fd, c_EV_WRITE,
-                  HandleCTimeoutWakeup, NULL)
+        set_fd_nonblocking(self.realsock.fileno())
+        nbsocket_init_nonblocking(self)
 
     def fileno(nbsocket self):
         return self.swi.fd
@@ -2216,6 +4120,8 @@ cdef class nbsocket:
         self.close()
 
     def close(nbsocket self):
+        coio_c_edge_watch_stop(&self.swi.read_ev)
+        coio_c_edge_watch_stop(&self.swi.write_ev)
         if self.c_do_close:
             # self.realsock.close() calls socket(2) + close(2) if the filehandle
             # was already closed.
@@ -2238,6 +4144,42 @@ cdef class nbsocket:
         self.c_do_close = do_close
         return self
 
+    def set_persistent_watch(nbsocket self, char do_watch):
+        """With True, watch the fd with persistent, edge-triggered events.
+
+        See nbfile.set_persistent_watch for details. This method is not
+        present in socket.socket.
+
+        Returns:
+          self
+        """
+        if do_watch:
+            if self.swi.fd >= 0:
+                coio_c_edge_watch_start(&self.swi.read_ev, HandleCEdgeWakeup)
+                coio_c_edge_watch_start(&self.swi.write_ev, HandleCEdgeWakeup)
+        else:
+            coio_c_edge_watch_stop(&self.swi.read_ev)
+            coio_c_edge_watch_stop(&self.swi.write_ev)
+        return self
+
+    def set_busy_poll(nbsocket self, int usec):
+        """Set SO_BUSY_POLL: busy poll the device queue on blocking receives.
+
+        Combine it with set_schedule_policy(busy_poll_usec=...). This method
+        is not present in socket.socket.
+
+        Args:
+          usec: Number of microseconds to busy poll, 0 to disable.
+        Raises:
+          socket.error: With errno ENOPROTOOPT if not supported.
+        Returns:
+          self
+        """
+        if COIO_SO_BUSY_POLL < 0:
+            raise socket_error(ENOPROTOOPT, strerror(ENOPROTOOPT))
+        self.realsock.setsockopt(socket.SOL_SOCKET, COIO_SO_BUSY_POLL, usec)
+        return self
+
     # This is not a standard property of `socket.socket'.
     property do_close:
         def __get__(self):
@@ -2333,6 +4275,53 @@ cdef class nbsocket:
         esock = type(self)(asock)  # Create new nbsocket.
         return esock, addr
 
+    def accept_many(nbsocket self, int max_count):
+        """Accept up to max_count pending connections at once.
+
+        Waits (with the socket timeout) until there is a pending connection,
+        and then accepts the pending connections without waiting any more.
+        On Linux it uses accept4(2) with SOCK_NONBLOCK, so there are no
+        fcntl(2) calls per accepted connection.
+
+        Returns:
+          A nonempty list of (nbsocket, address) pairs, of at most max_count
+          items.
+        """
+        cdef object item
+        cdef object accepted
+        cdef nbsocket esock
+        if max_count <= 0:
+            raise ValueError('max_count must be positive')
+        if (not is_realsocket_layout_known or
+            type(self.realsock) is not socket_realsocket):
+            # Fall back to socket._realsocket.accept.
+            return [self.accept()]
+        accepted = []
+        while 1:
+            try:
+                item = coio_c_accept_nonblocking(self.realsock)
+            except socket_error:
+                if accepted:
+                    break  # The next call will report the error.
+                raise
+            if item is None:
+                if accepted:
+                    break
+                coio_c_handle_eagain(&self.swi, c_EV_READ)
+                continue
+            if type(self) is nbsocket:
+                # Skip the fcntl(2) calls in nbsocket.__init__.
+                esock = nbsocket.__new__(nbsocket)
+                esock.realsock = item[0]
+                esock.c_family = self.c_family
+                nbsocket_init_nonblocking(esock)
+            else:
+                esock = type(self)(item[0])
+            accepted.append((esock, item[1]))
+            if len(accepted) >= max_count:
+                break
+        return accepted
+
     def connect(nbsocket self, object address):
         cdef timeval tv
         cdef int c_err
@@ -2469,6 +4458,16 @@ cdef class nbsocket:
                       timeout_double=self.swi.timeout_value)
 
 
+cdef int nbsocket_init_nonblocking(nbsocket self) except -1:
+    """Set up the events of an nbsocket with a non-blocking self.realsock."""
+    self.swi.fd = self.realsock.fileno()
+    self.swi.timeout_value = -1.0
+    event_set(&self.swi.read_ev,  self.swi.fd, c_EV_READ,
+              HandleCTimeoutWakeup, NULL)
+    event_set(&self.swi.write_ev, self.swi.fd, c_EV_WRITE,
+              HandleCTimeoutWakeup, NULL)
+    return 0
+
 def new_realsocket(*args):
     """Non-blocking drop-in replacement for socket._realsocket.
 
@@ -3150,7 +5149,7 @@ cdef void HandleCSleepWakeup(int fd, short evtype, void *arg) with gil:
     # Set tempval so coio_c_wait doesn't have to call event_del(...).
     if (<tasklet>arg).tempval is waiting_token:
         (<tasklet>arg).tempval = coio_event_happened_token
-    PyTasklet_Insert(<tasklet>arg)
+    insert_woken(<tasklet>arg)
 
 
 def sleep(double duration):
@@ -3553,7 +5552,7 @@ cdef class signal_handler_event:
             signal_handler_events.pop(self, None)
             if signum == SIGINT and sigint_ev.ev_flags == 0:
                 _setup_sigint()
-            # By design, don't take action on SIGUSR1 or SIGUSR2 here.
+            # By design, don't take action on SIGUSR1 here.
 
 def signal(int signum, object handler):
     """Register or unregister a signal handler.
@@ -3582,9 +5581,6 @@ def signal(int signum, object handler):
     if signum == SIGUSR1:
         event_del(&sigusr1_ev)
         sigusr1_ev.ev_flags = 0
-    elif signum == SIGUSR2:
-        event_del(&sigusr2_ev)
-        sigusr2_ev.ev_flags = 0
 
     # TODO(pts): Make Pyrex call `get' as a PyDictObject.
     signal_handler_event_obj = signal_handler_events.get(signum_obj)
@@ -3713,13 +5709,18 @@ def _thread_worker_function(result_channel, start_lock, list call_info):
         start_lock.acquire()
         function, args, kwargs = call_info
         del call_info[:]
+        if function is None:  # Reaped by the thread_pool.
+            return
         # We need a wrapper, because sys.exc_info() doesn't work in Pyrex
         # (returns None in Pyrex 0.9.9) and `except BaseException, e, tb'
         # doesn't work in Cython.
         retval = coio_c_call_wrap_bomb(function, args, kwargs, bomb)
-        if result_channel.balance < 0:
-            result_channel.send(retval)  # Prefer the sender.
-            cancel_main_loop_wait()
+        # _main_loop will send retval to result_channel. We don't send it from
+        # this thread, because channel operations from another thread are not
+        # safe with greenstackless. We wrap it in a tuple so a bomb in retval
+        # is not raised by the receive, and the caller can tell it apart from
+        # being interrupted while receiving.
+        send_from_thread(result_channel, (retval,))
 
 
 # Field indices of a ThreadWorkerInfo.
@@ -3727,7 +5728,23 @@ cdef enum:
     TWI_RESULT_CHANNEL = 0
     TWI_START_LOCK = 1
     TWI_CALL_INFO = 2
+    # Monotonic timestamp (in seconds) since when the worker is idle.
+    TWI_IDLE_SINCE = 3
+    # Monotonic timestamp (in microseconds) when the current call was
+    # started, or 0.
+    TWI_STARTED_AT = 4
+
 
+cdef class thread_pool_future
+cdef class thread_pool_imap_unordered
+
+cdef void HandleCThreadPoolReap(int fd, short evtype, void *arg) with gil:
+    cdef thread_pool pool
+    pool = <thread_pool>arg
+    pool.is_reap_pending = 0
+    Py_DECREF(pool)  # Corresponding to thread_pool.schedule_reap.
+    # Should an exception occur, Pyrex will print it to stderr, and ignore it.
+    pool.reap_idle_workers()
 
 cdef class thread_pool:
     """A bounded thread pool of workers to run arbitrary functions.
@@ -3757,64 +5774,781 @@ cdef class thread_pool:
 
     See examples/demo_thread_pool*.py for example uses.
 
+    The pool starts its worker threads lazily (except for the first
+    min_thread_count threads, which are started by the constructor), up to
+    max_thread_count. If idle_timeout is nonnegative, threads idle for that
+    many seconds exit, but the pool keeps at least min_thread_count threads.
+    Use the stats() method to find out how busy the pool is.
+
     Please note that TaskletExit or SystemExit is not raised in the worker
     threads active when the process is exiting. Those will just get aborted
     abrouptly.
     """
 
     cdef int startable_count
+    cdef int max_thread_count
+    cdef int min_thread_count
+    cdef int active_count
+    cdef int started_count
+    cdef int reaped_count
+    cdef int is_reap_pending
+    cdef double idle_timeout
+    cdef long stack_size
     cdef list available_thread_workers
     cdef object notify_channel
     cdef object allocate_lock
     cdef object start_new_thread
+    cdef object thread_stack_size
+    cdef event_t reap_ev
+    cdef timeval reap_tv
+    cdef duration_stats_s wait_stats
+    cdef duration_stats_s run_stats
+
+    def __cinit__(self, int max_thread_count, thread=None,
+                  int min_thread_count=0, double idle_timeout=-1.0,
+                  long stack_size=0):
+        """Create a thread pool.
 
-    def __cinit__(self, int max_thread_count, thread=None):
+        Args:
+          max_thread_count: Maximum number of worker threads.
+          thread: The module to start the threads with, or None for the
+            `thread' module.
+          min_thread_count: Number of worker threads to start now, and to
+            keep even when they are idle.
+          idle_timeout: Number of seconds after which an idle worker thread
+            exits, or negative to keep the threads forever.
+          stack_size: Stack size of the worker threads (in bytes, see
+            thread.stack_size), or 0 for the default.
+        """
+        if min_thread_count < 0 or min_thread_count > max_thread_count:
+            raise ValueError('min_thread_count out of range')
         if thread is None:
             thread = __import__('thread')
         self.allocate_lock = thread.allocate_lock
         self.start_new_thread = thread.start_new_thread
+        if stack_size:
+            self.thread_stack_size = thread.stack_size
         self.startable_count = int(max_thread_count)
+        self.max_thread_count = self.startable_count
+        self.min_thread_count = min_thread_count
+        self.idle_timeout = idle_timeout
+        self.stack_size = stack_size
         self.available_thread_workers = []
         # Channel to notify waiting callers that a thread_worker_info is available.
         self.notify_channel = stackless.channel()
         self.notify_channel.preference = 1    # Prefer the sender.
+        while self.startable_count > max_thread_count - min_thread_count:
+            self.available_thread_workers.append(self.new_worker())
 
-    def __call__(self, function, *args, **kwargs):
+    # Start a new worker thread, and return its thread worker (a list indexed
+    # by TWI_*).
+    cdef list new_worker(self):
+        cdef list thread_worker
+        #TWI_RESULT_CHANNEL = 0
+        #TWI_START_LOCK = 1
+        #TWI_CALL_INFO = 2
+        #TWI_IDLE_SINCE = 3
+        #TWI_STARTED_AT = 4
+        thread_worker = [stackless.channel(),   # TWI_RESULT_CHANNEL = 0
+                         self.allocate_lock(),  # TWI_START_LOCK = 1
+                         [],                    # TWI_CALL_INFO = 2
+                         coio_c_monotonic(),    # TWI_IDLE_SINCE = 3
+                         0]                     # TWI_STARTED_AT = 4
+        thread_worker[TWI_RESULT_CHANNEL].preference = 1    # Prefer the sender.
+        thread_worker[TWI_START_LOCK].acquire()
+        args = tuple(thread_worker[:TWI_IDLE_SINCE])
+        if self.stack_size:
+            # thread.stack_size affects all threads started afterwards.
+            old_stack_size = self.thread_stack_size(self.stack_size)
+            try:
+                self.start_new_thread(_thread_worker_function, args)
+            finally:
+                self.thread_stack_size(old_stack_size)
+        else:
+            self.start_new_thread(_thread_worker_function, args)
+        self.startable_count -= 1
+        self.started_count += 1
+        return thread_worker
+
+    # Return an idle thread worker (a list indexed by TWI_*), starting a new
+    # thread or waiting for a worker to become available if needed.
+    cdef list acquire_worker(self):
         cdef list thread_worker
+        cdef unsigned long long start
+        start = coio_c_monotonic_usec()
         if self.available_thread_workers:
             thread_worker = self.available_thread_workers.pop()
         elif self.startable_count:
-            #TWI_RESULT_CHANNEL = 0
-            #TWI_START_LOCK = 1
-            #TWI_CALL_INFO = 2
-            thread_worker = [stackless.channel(),   # TWI_RESULT_CHANNEL = 0
-                             self.allocate_lock(),  # TWI_START_LOCK = 1
-                             []]                    # TWI_CALL_INFO = 2
-            thread_worker[TWI_RESULT_CHANNEL].preference = 1    # Prefer the sender.
-            thread_worker[TWI_START_LOCK].acquire()
-            # TODO(pts): Let the user specify the thread stack size
-            # (thread.stack_size(...)).
-            self.start_new_thread(_thread_worker_function, tuple(thread_worker))
-            self.startable_count -= 1
-        else:
-            # This blocks until 
+            thread_worker = self.new_worker()
+        else:
+            # This blocks until release_worker sends a worker.
             thread_worker = self.notify_channel.receive()
+        self.active_count += 1
+        coio_c_duration_stats_add(&self.wait_stats,
+                                  coio_c_monotonic_usec() - start)
+        return thread_worker
+
+    # Make thread_worker call function in its thread, and return immediately.
+    # The caller should receive the result from
+    # thread_worker[TWI_RESULT_CHANNEL].
+    cdef start_worker(self, list thread_worker, function, args, kwargs):
+        global running_thread_call_count
+        assert thread_worker[TWI_START_LOCK].locked()
+        assert not thread_worker[TWI_CALL_INFO]
+        thread_worker[TWI_CALL_INFO][:] = (function, args, kwargs)
+        thread_worker[TWI_STARTED_AT] = coio_c_monotonic_usec()
+        running_thread_call_count += 1
+        thread_worker[TWI_START_LOCK].release()
+
+    # Give thread_worker (returned by acquire_worker) to a waiting caller, or
+    # make it available for future calls.
+    cdef release_worker(self, list thread_worker):
+        global running_thread_call_count
+        cdef unsigned long long started_at
+        started_at = thread_worker[TWI_STARTED_AT]
+        if started_at:
+            coio_c_duration_stats_add(&self.run_stats,
+                                      coio_c_monotonic_usec() - started_at)
+            thread_worker[TWI_STARTED_AT] = 0
+            running_thread_call_count -= 1
+        self.active_count -= 1
+        if self.available_thread_workers or self.notify_channel.balance >= 0:
+            thread_worker[TWI_IDLE_SINCE] = coio_c_monotonic()
+            self.available_thread_workers.append(thread_worker)
+            self.schedule_reap()
+        else:
+            self.notify_channel.send(thread_worker)
+
+    # Release thread_worker, whose call is still running because the caller
+    # has been interrupted, when the call finishes, dropping the result.
+    cdef abandon_worker(self, list thread_worker):
+        abandoned_thread_workers[thread_worker[TWI_RESULT_CHANNEL]] = (
+            self, thread_worker)
+
+    # Add self.reap_ev to call reap_idle_workers when the least recently
+    # used idle worker times out.
+    cdef schedule_reap(self):
+        cdef double delay
+        if (self.idle_timeout < 0 or not self.available_thread_workers or
+            self.max_thread_count - self.startable_count <=
+            self.min_thread_count or self.is_reap_pending):
+            return
+        delay = (self.available_thread_workers[0][TWI_IDLE_SINCE] +
+                 self.idle_timeout - coio_c_monotonic())
+        if delay < 0:
+            delay = 0
+        self.reap_tv.tv_sec = <long>delay
+        self.reap_tv.tv_usec = <unsigned int>(
+            (delay - <double>self.reap_tv.tv_sec) * 1000000.0)
+        event_set(&self.reap_ev, -1, 0, HandleCThreadPoolReap, <void*>self)
+        # A pending reap doesn't prevent the process from exiting.
+        coio_c_set_evlist_internal(&self.reap_ev)
+        event_add(&self.reap_ev, &self.reap_tv)
+        # Keep self alive while self.reap_ev is pending.
+        Py_INCREF(self)
+        self.is_reap_pending = 1
+
+    cdef reap_idle_workers(self):
+        cdef list thread_worker
+        cdef double deadline
+        deadline = coio_c_monotonic() - self.idle_timeout
+        while (self.available_thread_workers and
+               self.max_thread_count - self.startable_count >
+               self.min_thread_count and
+               self.available_thread_workers[0][TWI_IDLE_SINCE] <= deadline):
+            self.stop_worker(self.available_thread_workers.pop(0))
+        self.schedule_reap()
+
+    # Make the thread of the idle thread_worker exit.
+    cdef stop_worker(self, list thread_worker):
+        # Make _thread_worker_function return.
+        thread_worker[TWI_CALL_INFO][:] = (None, None, None)
+        thread_worker[TWI_START_LOCK].release()
+        self.startable_count += 1
+        self.reaped_count += 1
+
+    def close(self):
+        """Make the idle worker threads exit.
+
+        Busy worker threads are not affected. The pool can be used after
+        close(), it starts new worker threads as needed.
+        """
+        while self.available_thread_workers:
+            self.stop_worker(self.available_thread_workers.pop())
+
+    def stats(self, reset=False):
+        """Return a dict with a snapshot of the thread pool statistics.
+
+        The dict contains the current number of threads (thread_count),
+        busy threads (active_count), idle threads (idle_count), callers
+        waiting for a thread (queue_length), and the number of threads
+        started (started_count) and reaped (reaped_count) so far. For the
+        time callers have waited for a thread (wait_...) and the time the
+        calls took (run_...), it contains the count, the total and the
+        maximum in microseconds, and a histogram like in coio.loop_stats.
+
+        Args:
+          reset: If true, reset the wait and run time statistics after taking
+            the snapshot.
+        """
+        wait_count, wait_usec_total, wait_usec_max, wait_usec_histogram = (
+            coio_c_duration_stats_get(&self.wait_stats, bool(reset)))
+        run_count, run_usec_total, run_usec_max, run_usec_histogram = (
+            coio_c_duration_stats_get(&self.run_stats, bool(reset)))
+        return {
+            'max_thread_count': self.max_thread_count,
+            'min_thread_count': self.min_thread_count,
+            'thread_count': self.max_thread_count - self.startable_count,
+            'active_count': self.active_count,
+            'idle_count': len(self.available_thread_workers),
+            'queue_length': max(0, -self.notify_channel.balance),
+            'started_count': self.started_count,
+            'reaped_count': self.reaped_count,
+            'wait_count': wait_count,
+            'wait_usec_total': wait_usec_total,
+            'wait_usec_max': wait_usec_max,
+            'wait_usec_histogram': wait_usec_histogram,
+            'run_count': run_count,
+            'run_usec_total': run_usec_total,
+            'run_usec_max': run_usec_max,
+            'run_usec_histogram': run_usec_histogram,
+        }
+
+    def __call__(self, function, *args, **kwargs):
+        cdef list thread_worker
+        cdef int is_running
+        thread_worker = self.acquire_worker()
+        is_running = 0
         try:
-            assert thread_worker[TWI_START_LOCK].locked()
-            assert not thread_worker[TWI_CALL_INFO]
-            thread_worker[TWI_CALL_INFO][:] = (function, args, kwargs)
-            thread_worker[TWI_START_LOCK].release()
-            # At this point Work calls function, puts the result to thread_worker.call_info, and
-            # calls thread_worker.result_channel.release().
-            #
-            # This receive operation blocks.
+            self.start_worker(thread_worker, function, args, kwargs)
+            is_running = 1
+            # At this point _thread_worker_function calls function, and
+            # _main_loop sends the result in a 1-tuple to
+            # thread_worker[TWI_RESULT_CHANNEL].
             #
-            # This might raise a bomb.
+            # This receive operation blocks. It raises only if the current
+            # tasklet is interrupted (e.g. by util.Timeout or
+            # tasklet.kill()).
             #
             # This operation happens to work even with greenstackless.
-            return thread_worker[TWI_RESULT_CHANNEL].receive()
+            retval = thread_worker[TWI_RESULT_CHANNEL].receive()[0]
+            is_running = 0
         finally:
-            if self.available_thread_workers or self.notify_channel.balance >= 0:
-                self.available_thread_workers.append(thread_worker)
+            if is_running:
+                self.abandon_worker(thread_worker)
             else:
-                self.notify_channel.send(thread_worker)
+                self.release_worker(thread_worker)
+        if isinstance(retval, bomb):
+            raise retval.type, retval.value, retval.traceback
+        return retval
+
+    def submit(self, function, *args, **kwargs):
+        """Start calling function(*args, **kwargs) in a worker thread.
+
+        This method doesn't block: the call is started by a new tasklet,
+        which waits for an available worker thread if needed.
+
+        Returns:
+          A thread_pool_future holding the result of the call.
+        """
+        cdef thread_pool_future future
+        future = thread_pool_future()
+        stackless.tasklet(_thread_pool_future_runner)(
+            self, future, function, args, kwargs)
+        return future
+
+    def map(self, function, iterable, int max_in_flight=0):
+        """Call function on each item in worker threads, return the results.
+
+        Args:
+          function: Callable taking a single argument.
+          iterable: Iterable of the arguments.
+          max_in_flight: Maximum number of calls submitted, but whose result
+            hasn't been collected yet. 0 means the maximum number of threads.
+        Returns:
+          List of the return values, in the order of iterable.
+        Raises:
+          Whatever the first failing call has raised. The other calls
+          already submitted keep running.
+        """
+        cdef list futures
+        cdef list results
+        cdef thread_pool_future future
+        if max_in_flight <= 0:
+            max_in_flight = self.max_thread_count
+        futures = []
+        results = []
+        for item in iterable:
+            if len(futures) - len(results) >= max_in_flight:
+                future = futures[len(results)]
+                results.append(future.result())
+            futures.append(self.submit(function, item))
+        while len(results) < len(futures):
+            future = futures[len(results)]
+            results.append(future.result())
+        return results
+
+    def imap_unordered(self, function, iterable, int max_in_flight=0):
+        """Call function on each item in worker threads, yield the results.
+
+        Args:
+          function: Callable taking a single argument.
+          iterable: Iterable of the arguments, consumed lazily.
+          max_in_flight: Maximum number of calls submitted, but whose result
+            hasn't been yielded yet. 0 means the maximum number of threads.
+        Returns:
+          An iterator of the return values, in the order the calls finish.
+          Iterating raises whatever the corresponding call has raised.
+        """
+        if max_in_flight <= 0:
+            max_in_flight = self.max_thread_count
+        return thread_pool_imap_unordered(self, function, iterable,
+                                          max_in_flight)
+
+
+def _thread_pool_future_runner(thread_pool pool, thread_pool_future future,
+                               function, args, kwargs):
+    """Tasklet function to run function(*args, **kwargs) for future."""
+    cdef list thread_worker
+    cdef int is_running
+    if future.state != FUTURE_PENDING:  # Cancelled.
+        return
+    thread_worker = pool.acquire_worker()
+    is_running = 0
+    try:
+        if future.state != FUTURE_PENDING:  # Cancelled while waiting.
+            return
+        future.state = FUTURE_RUNNING
+        pool.start_worker(thread_worker, function, args, kwargs)
+        is_running = 1
+        # The exception (with the traceback) is kept in a bomb.
+        value = thread_worker[TWI_RESULT_CHANNEL].receive()[0]
+        is_running = 0
+    finally:
+        if is_running:  # Killed while receiving.
+            pool.abandon_worker(thread_worker)
+        else:
+            pool.release_worker(thread_worker)
+    future.set_state(FUTURE_DONE, value)
+
+
+class FutureCancelledError(Exception):
+    """Raised by thread_pool_future.result() if the call was cancelled."""
+
+class FutureTimeoutError(Exception):
+    """Raised by thread_pool_future.result() on timeout."""
+
+# States of a thread_pool_future.
+cdef enum:
+    FUTURE_PENDING = 0
+    FUTURE_RUNNING = 1
+    FUTURE_DONE = 2
+    FUTURE_CANCELLED = 3
+
+
+cdef class thread_pool_future:
+    """Result of a function call submitted by thread_pool.submit()."""
+
+    cdef int state
+    # Return value of the call, or a stackless.bomb if it has raised.
+    cdef object value
+    # Channel to wake up the tasklets waiting for the call to finish, or None.
+    cdef object done_channel
+    # List to append self to when done, or None.
+    cdef list done_list
+
+    cdef set_state(self, int state, value):
+        self.state = state
+        self.value = value
+        if self.done_list is not None:
+            self.done_list.append(self)
+        if self.done_channel is not None:
+            while self.done_channel.balance < 0:
+                self.done_channel.send(None)
+
+    def running(self):
+        """Return true iff the call is running in a worker thread now."""
+        return self.state == FUTURE_RUNNING
+
+    def done(self):
+        """Return true iff the call has finished or has been cancelled."""
+        return self.state >= FUTURE_DONE
+
+    def cancelled(self):
+        """Return true iff the call has been cancelled."""
+        return self.state == FUTURE_CANCELLED
+
+    def cancel(self):
+        """Cancel the call unless it has been started in a worker thread.
+
+        Returns:
+          Whether the call is cancelled.
+        """
+        if self.state == FUTURE_PENDING:
+            self.set_state(FUTURE_CANCELLED, None)
+        return self.state == FUTURE_CANCELLED
+
+    def wait(self, timeout=None):
+        """Wait for the call to finish or to be cancelled.
+
+        Other tasklets can run while waiting.
+
+        Args:
+          timeout: Number of seconds to wait at most, or None if infinite.
+        Returns:
+          self.done()
+        """
+        if self.state < FUTURE_DONE:
+            if self.done_channel is None:
+                self.done_channel = stackless.channel()
+                self.done_channel.preference = 1  # Prefer the sender.
+            receive_with_timeout(timeout, self.done_channel)
+        return self.state >= FUTURE_DONE
+
+    def result(self, timeout=None):
+        """Wait for the call to finish, and return its return value.
+
+        Args:
+          timeout: Number of seconds to wait at most, or None if infinite.
+        Raises:
+          FutureTimeoutError: On timeout.
+          FutureCancelledError: If the call has been cancelled.
+          Whatever the call has raised.
+        """
+        if not self.wait(timeout):
+            raise FutureTimeoutError
+        if self.state == FUTURE_CANCELLED:
+            raise FutureCancelledError
+        value = self.value
+        if isinstance(value, bomb):
+            raise value.type, value.value, value.traceback
+        return value
+
+
+cdef class thread_pool_imap_unordered:
+    """Iterator returned by thread_pool.imap_unordered()."""
+
+    cdef thread_pool pool
+    cdef object function
+    # Iterator of the remaining arguments, or None if exhausted.
+    cdef object iterator
+    cdef int max_in_flight
+    cdef int in_flight_count
+    # Futures done, but not returned yet.
+    cdef list done_futures
+    cdef object done_channel
+
+    def __cinit__(self, thread_pool pool, function, iterable,
+                  int max_in_flight):
+        self.pool = pool
+        self.function = function
+        self.iterator = iter(iterable)
+        self.max_in_flight = max_in_flight
+        self.in_flight_count = 0
+        self.done_futures = []
+        self.done_channel = stackless.channel()
+        self.done_channel.preference = 1  # Prefer the sender.
+
+    cdef fill(self):
+        cdef thread_pool_future future
+        while self.iterator is not None and (
+            self.in_flight_count < self.max_in_flight):
+            item = next(self.iterator, self)  # self as the sentinel.
+            if item is self:
+                self.iterator = None
+                break
+            future = self.pool.submit(self.function, item)
+            future.done_list = self.done_futures
+            future.done_channel = self.done_channel
+            self.in_flight_count += 1
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        cdef thread_pool_future future
+        self.fill()
+        if not self.in_flight_count:
+            raise StopIteration
+        while not self.done_futures:
+            self.done_channel.receive()
+        future = self.done_futures.pop(0)
+        self.in_flight_count -= 1
+        # Keep the worker threads busy while the caller is processing the
+        # result.
+        self.fill()
+        return future.result()
+
+
+# --- Process pool
+
+import cPickle
+import struct
+
+# Field indices of a ProcessWorkerInfo.
+cdef enum:
+    PWI_PID = 0
+    PWI_FILE = 1
+    PWI_TASK_COUNT = 2
+
+# Kinds of the responses sent by _process_worker_main.
+cdef enum:
+    PROCESS_RETURNED = 0
+    PROCESS_RAISED = 1
+
+class ProcessPoolError(Exception):
+    """Raised by process_pool if a worker process has died."""
+
+cdef object process_header_struct
+# Message length prefix in front of the pickled messages.
+process_header_struct = struct.Struct('>L')
+
+def _process_worker_recv(sock, int size):
+    """Read exactly size bytes from sock (blocking), or less on EOF."""
+    cdef list parts
+    cdef int got_size
+    parts = []
+    got_size = 0
+    while got_size < size:
+        part = sock.recv(size - got_size)
+        if not part:
+            break
+        parts.append(part)
+        got_size += len(part)
+    return ''.join(parts)
+
+# Close all fds inherited by a new worker process, except for stdin, stdout,
+# stderr and keep_fd. This includes the listening sockets, the event loop fd,
+# the wakeup fd, and the parent ends of the sockets to the other worker
+# processes (so they get EOF when the parent closes its end).
+cdef int close_inherited_fds(int keep_fd) except -1:
+    cdef int fd
+    cdef int max_fd
+    try:
+        fds = os.listdir('/proc/self/fd')
+    except OSError:
+        max_fd = os.sysconf('SC_OPEN_MAX')
+        for fd from 3 <= fd < max_fd:
+            if fd != keep_fd:
+                close(fd)  # Ignore EBADF.
+        return 0
+    for fd_str in fds:
+        fd = int(fd_str)
+        if fd > 2 and fd != keep_fd:
+            close(fd)  # Ignore EBADF for the fd of the listdir above.
+    return 0
+
+def _process_worker_main(sock):
+    """Function which runs in a worker process until EOF on sock."""
+    cdef int size
+    # Ctrl-C is handled by the parent, which closes the workers.
+    signal_module = __import__('signal')
+    signal_module.signal(SIGINT, signal_module.SIG_IGN)
+    while 1:
+        data = _process_worker_recv(sock, process_header_struct.size)
+        if len(data) < process_header_struct.size:
+            return
+        size = process_header_struct.unpack(data)[0]
+        data = _process_worker_recv(sock, size)
+        if len(data) < size:
+            return
+        function, args, kwargs = cPickle.loads(data)
+        # We need a wrapper, because sys.exc_info() doesn't work in Pyrex.
+        retval = coio_c_call_wrap_bomb(function, args, kwargs, bomb)
+        if isinstance(retval, bomb):
+            traceback_text = ''.join(__import__('traceback').format_exception(
+                retval.type, retval.value, retval.traceback))
+            exc = retval.value
+            if not isinstance(exc, retval.type):  # Normalize the exception.
+                if exc is None:
+                    exc = retval.type()
+                elif isinstance(exc, tuple):
+                    exc = retval.type(*exc)
+                else:
+                    exc = retval.type(exc)
+            response = (PROCESS_RAISED, exc, traceback_text)
+        else:
+            response = (PROCESS_RETURNED, retval)
+        try:
+            data = cPickle.dumps(response, cPickle.HIGHEST_PROTOCOL)
+        except Exception, e:
+            data = cPickle.dumps((PROCESS_RAISED, ProcessPoolError(
+                'cannot pickle the response %r: %s' % (response[1], e)),
+                ''), cPickle.HIGHEST_PROTOCOL)
+        sock.sendall(process_header_struct.pack(len(data)) + data)
+
+def _wait_process(int pid):
+    """Wait for process pid to exit, blocking only the current tasklet.
+
+    Returns:
+      A string describing how the process has exited.
+    """
+    cdef double delay
+    delay = 0.001
+    while 1:
+        got_pid, status = os.waitpid(pid, os.WNOHANG)
+        if got_pid:
+            break
+        sleep(delay)
+        if delay < 0.1:
+            delay *= 2
+    if os.WIFSIGNALED(status):
+        return 'killed by signal %d' % os.WTERMSIG(status)
+    return 'exited with status %d' % os.WEXITSTATUS(status)
+
+
+cdef class process_pool:
+    """A bounded pool of worker processes to run CPU-heavy functions.
+
+    Unlike thread_pool, a process pool can use multiple CPU cores, because
+    the worker processes have their own GIL. The __call__ method sends the
+    function and its arguments to an idle worker process (started with
+    os.fork, and retained for future use), and waits for the result. The
+    function, the arguments, the return value and the exception raised must
+    be picklable, so the function must be defined at the top level of a
+    module. Other tasklets can run while the caller is waiting.
+
+    The function runs in a blocking way in the worker process, so it must
+    not use coio (or the functions patched by syncless.patch) or switch
+    tasklets.
+
+    A worker process is replaced by a new one after max_tasks_per_child
+    calls (if positive), or when it dies. In the latter case the call raises
+    ProcessPoolError.
+    """
+
+    cdef int startable_count
+    cdef int max_process_count
+    cdef int max_tasks_per_child
+    cdef list available_process_workers
+    cdef object notify_channel
+
+    def __cinit__(self, int max_process_count, int max_tasks_per_child=0):
+        if max_process_count <= 0:
+            raise ValueError('max_process_count must be positive')
+        self.startable_count = max_process_count
+        self.max_process_count = max_process_count
+        self.max_tasks_per_child = max_tasks_per_child
+        self.available_process_workers = []
+        # Channel to notify waiting callers that a process worker is
+        # available.
+        self.notify_channel = stackless.channel()
+        self.notify_channel.preference = 1    # Prefer the sender.
+
+    # Start a new worker process, and return its process worker (a list
+    # indexed by PWI_*).
+    cdef list new_worker(self):
+        cdef int pid
+        sock, child_sock = socket_realsocketpair(socket.AF_UNIX,
+                                                 socket.SOCK_STREAM)
+        try:
+            pid = os.fork()
+            if not pid:  # Child.
+                exit_code = 1
+                try:
+                    close_inherited_fds(child_sock.fileno())
+                    _process_worker_main(child_sock)
+                    exit_code = 0
+                finally:
+                    os._exit(exit_code)
+        finally:
+            child_sock.close()
+        self.startable_count -= 1
+        # Don't leak it to programs started by the parent.
+        fcntl3(sock.fileno(), F_SETFD,
+               fcntl2(sock.fileno(), F_GETFD) | FD_CLOEXEC)
+        #PWI_PID = 0
+        #PWI_FILE = 1
+        #PWI_TASK_COUNT = 2
+        return [pid,
+                nbfile(sock.fileno(), sock.fileno(), write_buffer_limit=2,
+                       do_close=1, close_ref=sock),
+                0]
+
+    cdef list acquire_worker(self):
+        if self.available_process_workers:
+            return self.available_process_workers.pop()
+        elif self.startable_count:
+            return self.new_worker()
+        else:
+            # This blocks until release_worker sends a worker.
+            return self.notify_channel.receive()
+
+    cdef release_worker(self, list process_worker):
+        if (self.max_tasks_per_child > 0 and
+            process_worker[PWI_TASK_COUNT] >= self.max_tasks_per_child):
+            self.retire_worker(process_worker)
+            if self.notify_channel.balance < 0:
+                self.notify_channel.send(self.new_worker())
+        elif (self.available_process_workers or
+              self.notify_channel.balance >= 0):
+            self.available_process_workers.append(process_worker)
+        else:
+            self.notify_channel.send(process_worker)
+
+    # Make the worker process exit, and reap it in the background.
+    cdef retire_worker(self, list process_worker):
+        process_worker[PWI_FILE].close()  # The worker process exits on EOF.
+        stackless.tasklet(_wait_process)(process_worker[PWI_PID])
+        self.startable_count += 1
+
+    def __call__(self, function, *args, **kwargs):
+        cdef list process_worker
+        cdef int size
+        cdef int is_reusable
+        data = cPickle.dumps((function, args, kwargs),
+                             cPickle.HIGHEST_PROTOCOL)
+        process_worker = self.acquire_worker()
+        is_reusable = 0
+        try:
+            f = process_worker[PWI_FILE]
+            process_worker[PWI_TASK_COUNT] += 1
+            try:
+                f.write(process_header_struct.pack(len(data)))
+                f.write(data)
+                f.flush()
+                # This blocks the current tasklet only.
+                data = f.read(process_header_struct.size)
+                if len(data) == process_header_struct.size:
+                    size = process_header_struct.unpack(data)[0]
+                    data = f.read(size)
+                    if len(data) != size:
+                        data = None
+                else:
+                    data = None
+            except IOError, e:
+                data = None
+            if data is None:
+                f.close()
+                raise ProcessPoolError('worker process %d %s' % (
+                    process_worker[PWI_PID],
+                    _wait_process(process_worker[PWI_PID])))
+            response = cPickle.loads(data)
+            is_reusable = 1
+        finally:
+            if is_reusable:
+                self.release_worker(process_worker)
+            elif process_worker[PWI_FILE].closed:  # Has died.
+                self.startable_count += 1
+                if self.notify_channel.balance < 0:
+                    self.notify_channel.send(self.new_worker())
+            else:  # Interrupted, the response may arrive later.
+                self.retire_worker(process_worker)
+        if response[0] == PROCESS_RAISED:
+            exc = response[1]
+            if response[2]:
+                try:
+                    exc.remote_traceback = response[2]
+                except AttributeError:
+                    pass
+            raise exc
+        return response[1]
+
+    def close(self):
+        """Make the idle worker processes exit.
+
+        Busy worker processes are not affected. The pool can be used after
+        close(), it starts new worker processes as needed.
+        """
+        while self.available_process_workers:
+            self.retire_worker(self.available_process_workers.pop())
@@ -712,6 +712,10 @@ def AutoDetect(command_obj):
   if os.getenv('SYNCLESS_USE_MINIEVENT', ''):
     assert event_driver is None
     event_driver = 'minievent'
+  # minievent with io_uring(7) instead of epoll(7).
+  if os.getenv('SYNCLESS_USE_URING', ''):
+    assert event_driver is None
+    event_driver = 'uring'
   asked_for_libevhdns = bool(os.getenv('SYNCLESS_USE_LIBEVHDNS', ''))
   allowed_minievent = bool(os.getenv('SYNCLESS_ALLOW_MINIEVENT', '1'))
 
@@ -778,7 +782,9 @@ def AutoDetect(command_obj):
       retval['libraries'].append(lib_event)
       retval['define_macros'].append(('COIO_USE_LIBEVENT1', None))
 
-  if event_driver in ('minievent', None) and allowed_minievent:
+  if (event_driver == 'uring' or
+      event_driver in ('minievent', None) and allowed_minievent):
+    is_uring = event_driver == 'uring'
     event_driver = 'minievent'
     retval['is_found'] = True
     retval['define_macros'].append(('COIO_USE_MINIEVENT', None))
@@ -792,7 +798,23 @@ def AutoDetect(command_obj):
     else:
       retval['define_macros'].append(('COIO_USE_MINIHDNS', None))
       retval['sources'].append('coio_src/coio_minihdns.c')
-    retval['sources'].append('coio_src/coio_minievent.c')
+    # Use the epoll(7)-based variant of minievent on Linux, unless asked not
+    # to, or asked to use the io_uring(7)-based variant.
+    if is_uring:
+      if not HasSymbols(
+          compiler, includes=['sys/syscall.h'],
+          symbols=['__NR_io_uring_setup', '__NR_io_uring_enter']):
+        raise LinkError('io_uring system calls not found')
+      retval['sources'].append('coio_src/coio_minievent_uring.c')
+      retval['define_macros'].append(('COIO_USE_MINIEVENT_URING', None))
+    elif (sys.platform.startswith('linux') and
+        not os.getenv('SYNCLESS_USE_MINIEVENT_SELECT', '') and
+        HasSymbols(compiler, includes=['sys/epoll.h'],
+                   symbols=['epoll_create', 'epoll_wait'])):
+      retval['sources'].append('coio_src/coio_minievent_epoll.c')
+      retval['define_macros'].append(('COIO_USE_MINIEVENT_EPOLL', None))
+    else:
+      retval['sources'].append('coio_src/coio_minievent.c')
     retval['depends'].append('coio_src/coio_minievent.h')
 
   if not retval.pop('is_found'):
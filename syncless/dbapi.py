@@ -0,0 +1,191 @@
+#! /usr/local/bin/stackless2.6
+
+"""Non-blocking adaptor for blocking DB-API 2.0 connections (e.g. sqlite3).
+
+SQLite blocks the whole Syncless process while it is running a query (see
+examples/demo_sqlite_progress_handler.py). This module wraps a DB-API
+connection so that all its calls (including the ones of its cursors) run in
+a dedicated worker thread owned by the connection, and only the calling
+tasklet waits for them, other tasklets keep running.
+
+The dedicated thread is a coio.thread_pool of a single thread, which is
+never replaced, so modules which require all calls to come from the same
+thread (such as sqlite3) work.
+
+Rows are transferred from the worker thread in batches: iterating over a
+cursor and fetchone() fetch Cursor.batch_size rows at a time.
+
+Example:
+
+  from syncless import dbapi
+  db_conn = dbapi.connect_sqlite3(':memory:')
+  cursor = db_conn.cursor()
+  cursor.execute('SELECT ...')
+  for row in cursor:
+    ...
+
+Please note that only one call of a connection runs at a time, the calls
+of other tasklets using the same connection wait. If a call is interrupted
+(e.g. by util.Timeout), the next call waits for it to finish in the worker
+thread.
+"""
+
+__author__ = 'pts@fazekas.hu (Peter Szabo)'
+
+from collections import deque
+
+from syncless import coio
+
+# Default number of rows fetched from the worker thread at a time.
+DEFAULT_BATCH_SIZE = 256
+
+
+class Cursor(object):
+  """Non-blocking wrapper of a DB-API cursor, created by Connection.cursor."""
+
+  def __init__(self, connection, cursor):
+    self.connection = connection
+    self.batch_size = DEFAULT_BATCH_SIZE
+    self._pool = connection._pool
+    self._cursor = cursor
+    # Rows fetched from the worker thread, but not returned yet.
+    self._rows = deque()
+
+  @property
+  def description(self):
+    return self._cursor.description
+
+  @property
+  def rowcount(self):
+    return self._cursor.rowcount
+
+  @property
+  def lastrowid(self):
+    return self._cursor.lastrowid
+
+  def _get_arraysize(self):
+    return self._cursor.arraysize
+
+  def _set_arraysize(self, arraysize):
+    self._cursor.arraysize = arraysize
+
+  arraysize = property(_get_arraysize, _set_arraysize)
+
+  def execute(self, *args):
+    self._rows.clear()
+    self._pool(self._cursor.execute, *args)
+    return self
+
+  def executemany(self, *args):
+    self._rows.clear()
+    self._pool(self._cursor.executemany, *args)
+    return self
+
+  def executescript(self, *args):
+    """Non-standard, only for cursors which have it (e.g. sqlite3)."""
+    self._rows.clear()
+    self._pool(self._cursor.executescript, *args)
+    return self
+
+  def fetchone(self):
+    if not self._rows:
+      self._rows.extend(self._pool(self._cursor.fetchmany, self.batch_size))
+      if not self._rows:
+        return None
+    return self._rows.popleft()
+
+  def fetchmany(self, size=None):
+    if size is None:
+      size = self._cursor.arraysize
+    rows = []
+    while self._rows and len(rows) < size:
+      rows.append(self._rows.popleft())
+    if len(rows) < size:
+      rows.extend(self._pool(self._cursor.fetchmany, size - len(rows)))
+    return rows
+
+  def fetchall(self):
+    rows = list(self._rows)
+    self._rows.clear()
+    rows.extend(self._pool(self._cursor.fetchall))
+    return rows
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    row = self.fetchone()
+    if row is None:
+      raise StopIteration
+    return row
+
+  def setinputsizes(self, sizes):
+    pass
+
+  def setoutputsize(self, size, column=None):
+    pass
+
+  def close(self):
+    self._rows.clear()
+    self._pool(self._cursor.close)
+
+
+class Connection(object):
+  """Non-blocking wrapper of a DB-API connection.
+
+  All calls of the connection and its cursors run in a dedicated worker
+  thread, see the module docstring.
+  """
+
+  def __init__(self, connect_function, *args, **kwargs):
+    """Connect in the dedicated thread.
+
+    Args:
+      connect_function: The DB-API connect function, e.g. sqlite3.connect.
+      args, kwargs: Arguments for connect_function.
+    """
+    self._pool = coio.thread_pool(1, min_thread_count=1)
+    self._connection = self._pool(connect_function, *args, **kwargs)
+
+  def cursor(self, *args):
+    return Cursor(self, self._pool(self._connection.cursor, *args))
+
+  def execute(self, *args):
+    """Non-standard shortcut (like in sqlite3), returns a new Cursor."""
+    return self.cursor().execute(*args)
+
+  def commit(self):
+    self._pool(self._connection.commit)
+
+  def rollback(self):
+    self._pool(self._connection.rollback)
+
+  def close(self):
+    """Close the connection, and make the dedicated thread exit."""
+    try:
+      self._pool(self._connection.close)
+    finally:
+      self._pool.close()
+
+  def call(self, function, *args, **kwargs):
+    """Call function(connection, *args, **kwargs) in the dedicated thread.
+
+    This is useful for non-standard methods, e.g.
+    db_conn.call(sqlite3.Connection.create_function, 'f', 1, f).
+    """
+    return self._pool(function, self._connection, *args, **kwargs)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.commit()
+    else:
+      self.rollback()
+
+
+def connect_sqlite3(*args, **kwargs):
+  """Non-blocking drop-in replacement for sqlite3.connect."""
+  import sqlite3
+  return Connection(sqlite3.connect, *args, **kwargs)
@@ -56,6 +56,11 @@ The convenience function RunHttpServer can be used in __main__ to run a HTTP
 server forever, serving WSGI, BaseHTTPRequestHandler, CherrPy, web.py or
 webapp applications.
 
+A Syncless process uses a single CPU core. To use more cores, use
+PreforkWsgiListener (or RunHttpServer with process_count=None), which
+serves with WsgiListener in supervised worker processes, each listening on
+its own SO_REUSEPORT socket.
+
 WsgiListener and WsgiWorker take care of error detection and recovery. The
 details:
 
@@ -80,6 +85,25 @@ note that the total size of the pipelineable requests must not exceed a
 small limit (about 8192 bytes). If that's exceeded, then later requests will
 blocked until the response is returned for earlier requests.
 
+Common requests (GET, HEAD and POST without WebSocket and other special
+headers) are served by coio.wsgi_fast_request, which is a compiled
+implementation of the request--response cycle of WsgiWorker. See
+USE_WSGI_FAST_REQUEST for disabling it.
+
+Responses without a Content-Length are sent with Transfer-Encoding: chunked
+to HTTP/1.1 keep-alive clients, so the connection can be reused. Other
+clients get such responses with Connection: close. See
+CHUNKED_RESPONSE_BATCH_SIZE.
+
+POST and PUT requests with Transfer-Encoding: chunked (instead of
+Content-Length) are accepted from HTTP/1.1 clients: env['wsgi.input'] is a
+coio.nbchunkedreader then, which decodes the chunked request body on the fly,
+and env has no CONTENT_LENGTH.
+
+env['wsgi.file_wrapper'] is WsgiFileWrapper. Regular files returned wrapped
+by it are sent with sendfile(2) (see coio.nbfile.sendfile), without reading
+them to Python strings.
+
 FYI flush-after-first-body-byte is defined in the WSGI specification. An
 excerpt: The start_response callable must not actually transmit the response
 headers.  Instead, it must store them for the server or gateway to transmit
@@ -129,13 +153,17 @@ __author__ = 'pts@fazekas.hu (Peter Szabo)'
 
 import errno
 import logging
+import os
 import re
+import signal
 import sys
 import socket
+import stat
 import struct
 import time
 import traceback
 import types
+from collections import deque
 
 from syncless.best_stackless import stackless
 from syncless import coio
@@ -200,6 +228,38 @@ HTTP_STATUS_STRINGS = {
     500: 'Internal Server Error',
 }
 
+RESPONSE_HEADER_LINE_CACHE = {}
+"""Maps (key, value) response header tuples to 'Key: value\r\n' strings.
+
+Used by WsgiWorker (and coio.wsgi_fast_request) to avoid validating and
+capitalizing the same response headers (e.g. ('Content-Type', 'text/html'))
+again and again. Only tuples of two str objects are cached.
+"""
+
+RESPONSE_HEADER_LINE_CACHE_MAX_SIZE = 1024
+"""The RESPONSE_HEADER_LINE_CACHE is cleared when it reaches this size."""
+
+CHUNKED_RESPONSE_BATCH_SIZE = 8192
+"""Minimum size of a batched HTTP/1.1 response chunk.
+
+WsgiWorker uses Transfer-Encoding: chunked for HTTP/1.1 keep-alive responses
+without a Content-Length, collecting the small strings yielded by the
+application into chunks of about this size. An empty string yielded by the
+application flushes the collected strings.
+"""
+
+HTTP_DATE_CACHE = [None, None]
+"""The [int(time.time()), GetHttpDate(...)] pair of GetCurrentHttpDate."""
+
+USE_WSGI_FAST_REQUEST = True
+"""Serve common HTTP requests with coio.wsgi_fast_request (compiled).
+
+If False, WsgiWorker serves all requests with the pure Python code below.
+The pure Python code is also used when debug logging is enabled, and for
+special requests (e.g. WebSocket, policy-file, SSL) not handled by
+coio.wsgi_fast_request.
+"""
+
 if issubclass(socket.error, IOError):
   # Python2.6
   IOError_all = IOError
@@ -265,6 +325,15 @@ def GetHttpDate(at):
       WDAY[now[6]], now[2], MON[now[1]], now[0], now[3], now[4], now[5])
 
 
+def GetCurrentHttpDate():
+  """Return GetHttpDate(time.time()), rendering it at most once per second."""
+  at = int(time.time())
+  if HTTP_DATE_CACHE[0] != at:
+    HTTP_DATE_CACHE[1] = GetHttpDate(at)
+    HTTP_DATE_CACHE[0] = at
+  return HTTP_DATE_CACHE[1]
+
+
 def RespondWithBad(status, date, server_software, sockfile, reason):
   status_str = HTTP_STATUS_STRINGS[status]
   if reason:
@@ -289,7 +358,7 @@ def ReportAppException(exc_info, which='app'):
   if logging.root.level <= DEBUG:
     exc_line1 = exc
     exc = traceback.format_exception(
-        exc_info[0], exc_info[1], exc_info[2].tb_next)
+        exc_info[0], exc_info[1], exc_info[2] and exc_info[2].tb_next)
     exc[:1] = [exc_line1,
                '\nTraceback of WSGI %s call (most recent call last):\n'
                % which]
@@ -298,6 +367,22 @@ def ReportAppException(exc_info, which='app'):
   logging.error(exc)
 
 
+def PopChunkBatch(chunk_batch):
+  """Remove the batched strings from chunk_batch, and return them as a chunk.
+
+  Args:
+    chunk_batch: A nonempty list containing the total size and then the
+      strings of the batch.
+  Returns:
+    A HTTP/1.1 chunk (str) containing the strings, with the chunk size
+    formatted as 8 hex digits (just like coio.wsgi_fast_request).
+  """
+  data = '%08x\r\n%s\r\n' % (chunk_batch[0], ''.join(chunk_batch[1:]))
+  del chunk_batch[1:]
+  chunk_batch[0] = 0
+  return data
+
+
 def ConsumerWorker(items, is_debug):
   """Stackless tasklet to consume the rest of a wsgi_application output.
 
@@ -447,8 +532,176 @@ class WebSocket(object):
       raise TypeError('expected WebSocket message, got %s' % type(msg))
 
 
+class WsgiFileWrapper(object):
+  """The wsgi.file_wrapper in the WSGI environment (see PEP 333).
+
+  WsgiWorker sends the rest of a regular file wrapped by this with
+  nbfile.sendfile (i.e. sendfile(2) for non-SSL connections), without
+  reading it to Python strings. Other files (and responses which are already
+  chunked, because the application has called write()) are iterated over,
+  reading block_size bytes at a time.
+  """
+
+  def __init__(self, filelike, block_size=8192):
+    self.filelike = filelike
+    self.block_size = block_size
+    if hasattr(filelike, 'close'):
+      self.close = filelike.close
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    data = self.filelike.read(self.block_size)
+    if data:
+      return data
+    raise StopIteration
+
+  def GetSendfileRange(self):
+    """Return (fd, offset, size) of the rest of the file, or None.
+
+    Returns:
+      A tuple describing the unread part of the file for nbfile.sendfile,
+      or None if the file is not a regular file with a file descriptor.
+    """
+    filelike = self.filelike
+    if not (hasattr(filelike, 'fileno') and hasattr(filelike, 'tell')):
+      return None
+    try:
+      fd = filelike.fileno()
+      st = os.fstat(fd)
+      if not stat.S_ISREG(st.st_mode):
+        return None
+      offset = filelike.tell()
+    except (EnvironmentError, ValueError, TypeError):
+      return None
+    return fd, offset, max(0, st.st_size - offset)
+
+
+class WsgiConnectionLimiter(object):
+  """Keep-alive idle timeout and connection limit for WsgiListener.
+
+  A connection is idle while its WsgiWorker is waiting for the next HTTP
+  request on it (including the first one, right after accepting it). Idle
+  connections are closed after keep_alive_timeout seconds. If there are
+  max_connections connections open, WsgiListener closes the connection
+  which has been idle for the longest time before accepting a new one. If
+  none of the connections are idle, WsgiListener stops accepting new
+  connections until one of them is closed or becomes idle.
+
+  The counters evicted_count and timed_out_count can be used for
+  monitoring.
+  """
+
+  __slots__ = ['max_connections', 'keep_alive_timeout', 'evicted_count',
+               'timed_out_count', 'connections', 'idle_queue', 'idle_seq',
+               'channel']
+
+  def __init__(self, max_connections=None, keep_alive_timeout=None):
+    """Constructor.
+
+    Args:
+      max_connections: Maximum number of open connections (int), or None
+        for unlimited.
+      keep_alive_timeout: Number of seconds (float) to wait for the next
+        (or the first) HTTP request on a connection, or None to wait
+        indefinitely.
+    """
+    if max_connections is not None and max_connections < 1:
+      raise ValueError('max_connections must be positive')
+    self.max_connections = max_connections
+    self.keep_alive_timeout = keep_alive_timeout
+    self.evicted_count = 0
+    self.timed_out_count = 0
+    # Maps open sockets to None (busy) or to their idle sequence number.
+    self.connections = {}
+    # Deque of (idle_seq, sock) pairs, ordered by idle_seq. Contains stale
+    # items for connections which are not idle anymore.
+    self.idle_queue = deque()
+    self.idle_seq = 0
+    self.channel = stackless.channel()
+    self.channel.preference = 1  # Prefer the sender.
+
+  @property
+  def connection_count(self):
+    """The number of open connections."""
+    return len(self.connections)
+
+  def add(self, sock):
+    """Register a new (busy) connection."""
+    self.connections[sock] = None
+
+  def remove(self, sock):
+    """Unregister a closed connection. It's OK to call it multiple times."""
+    if self.connections.pop(sock, False) is not False:
+      self._wake_listener()
+
+  def _wake_listener(self):
+    if self.channel.balance < 0:
+      self.channel.send(None)
+
+  def wait_for_request(self, sock, sockfile):
+    """Wait for the next (or the first) HTTP request on a connection.
+
+    Returns:
+      True if there is data to read on sockfile, False if the connection
+      has timed out or has been evicted, so it has to be closed.
+    """
+    connections = self.connections
+    if sock not in connections:
+      return False
+    self.idle_seq += 1
+    connections[sock] = self.idle_seq
+    idle_queue = self.idle_queue
+    idle_queue.append((self.idle_seq, sock))
+    if len(idle_queue) > 2 * len(connections) + 16:  # Drop stale items.
+      self.idle_queue = deque(item for item in idle_queue
+                              if connections.get(item[1]) == item[0])
+    self._wake_listener()
+    is_readable = sockfile.wait_for_readable(self.keep_alive_timeout)
+    if sock not in connections:  # Evicted.
+      return False
+    if not is_readable:
+      self.timed_out_count += 1
+      self.remove(sock)
+      return False
+    connections[sock] = None
+    return True
+
+  def evict_oldest_idle(self):
+    """Close the connection which has been idle for the longest time.
+
+    Returns:
+      True if a connection has been closed, False if there are no idle
+      connections.
+    """
+    connections = self.connections
+    idle_queue = self.idle_queue
+    while idle_queue:
+      idle_seq, sock = idle_queue.popleft()
+      if connections.get(sock) == idle_seq:
+        del connections[sock]
+        self.evicted_count += 1
+        try:
+          # This wakes up wait_for_request with an EOF.
+          sock.shutdown(socket.SHUT_RDWR)
+        except IOError_all:
+          pass
+        return True
+    return False
+
+  def wait_for_slot(self):
+    """Wait until a new connection can be accepted, evicting if needed."""
+    max_connections = self.max_connections
+    if max_connections is not None:
+      while (len(self.connections) >= max_connections and
+             not self.evict_oldest_idle()):
+        self.channel.receive()
+
+
 def WsgiWorker(sock, peer_name, wsgi_application, default_env, date,
-               do_multirequest, upgrade_ssl_callback):
+               do_multirequest, upgrade_ssl_callback,
+               connection_limiter=None):
   # TODO(pts): Implement the full WSGI spec
   # http://www.python.org/dev/peps/pep-0333/
   #
@@ -468,17 +721,31 @@ def WsgiWorker(sock, peer_name, wsgi_application, default_env, date,
   do_keep_alive_ary = [True]
   headers_sent_ary = [False]
   server_software = default_env['SERVER_SOFTWARE']
+  header_line_cache = RESPONSE_HEADER_LINE_CACHE
 
+  # Connections are identified by the accepted socket in
+  # connection_limiter.
+  accepted_sock = sock
   if upgrade_ssl_callback is not None:
     # Make shallow copy because upgrade_ssl_callback may modify it in place.
     default_env = dict(default_env)
     sock = upgrade_ssl_callback(sock, default_env, is_debug)
     if sock is None:
+      if connection_limiter is not None:
+        connection_limiter.remove(accepted_sock)
       return
 
   sockfile = sock.makefile_samefd()
   sockfile.read_exc_class = WsgiReadError
   sockfile.write_exc_class = WsgiWriteError
+  if USE_WSGI_FAST_REQUEST and not is_debug:
+    wsgi_fast_request = coio.wsgi_fast_request
+  else:
+    wsgi_fast_request = None
+  connection_env = dict(default_env)
+  connection_env['REMOTE_HOST'] = connection_env['REMOTE_ADDR'] = peer_name[0]
+  connection_env['REMOTE_PORT'] = str(peer_name[1])
+  connection_env['wsgi.errors'] = WsgiErrorsStream
 
   reqhead_continuation_re = REQHEAD_CONTINUATION_RE
   try:
@@ -493,13 +760,7 @@ def WsgiWorker(sock, peer_name, wsgi_application, default_env, date,
       # output would be silly anyway since we send the HTTP response headers
       # line-by-line.
       sockfile.write_buffer_limit = 2
-      # Ensure there is no leftover from the previous request.
-      assert not sockfile.write_buffer_len, sockfile.write_buffer_len
 
-      env = dict(default_env)
-      env['REMOTE_HOST'] = env['REMOTE_ADDR'] = peer_name[0]
-      env['REMOTE_PORT'] = str(peer_name[1])
-      env['wsgi.errors'] = WsgiErrorsStream
       if date is None:  # Reusing a keep-alive socket.
         items = data = input = None
         # For efficiency reasons, we don't check now whether the child has
@@ -508,7 +769,37 @@ def WsgiWorker(sock, peer_name, wsgi_application, default_env, date,
         # Let other tasklets make some progress before we serve our next
         # request.
         stackless.schedule(None)
+      # Also for the first request, so a silent new connection can't hold a
+      # slot forever.
+      if (connection_limiter is not None and
+          not sockfile.read_buffer_len and
+          not connection_limiter.wait_for_request(accepted_sock, sockfile)):
+        if is_debug:
+          logging.debug('idle connection closed sock=%x' % id(sock))
+        return
+
+      if wsgi_fast_request:
+        try:
+          do_keep_alive = wsgi_fast_request(
+              sockfile, 32768, connection_env, wsgi_application, date)
+        except (IndexError, EOFError, ValueError):
+          return
+        except IOError_all:  # Including WsgiReadError and WsgiWriteError.
+          return
+        if do_keep_alive is not None:  # Served by the fast path.
+          date = None
+          do_keep_alive_ary[0] = do_keep_alive
+          if not do_multirequest:  # do_multirequest=False for testing.
+            if sockfile.write_buffer_len:
+              sockfile.flush()
+            break
+          continue
 
+      # Ensure there is no leftover from the previous request.
+      # (wsgi_fast_request flushes the responses to pipelined requests
+      # before returning None.)
+      assert not sockfile.write_buffer_len, sockfile.write_buffer_len
+      env = dict(connection_env)
       # Read HTTP/1.0 or HTTP/1.1 request. (HTTP/0.9 is not supported.)
       if is_debug:
         logging.debug('reading HTTP request on sock=%x' % id(sock))
@@ -536,7 +827,7 @@ def WsgiWorker(sock, peer_name, wsgi_application, default_env, date,
           logging.debug('found an uexpected SSL (http) request')
         return  # TODO(pts): Process the SSL request. Needs buffering changes.
       if date is None:
-        date = GetHttpDate(time.time())
+        date = GetCurrentHttpDate()
       if http_version not in HTTP_VERSIONS:
         RespondWithBad(400, date,
             server_software, sockfile, 'bad HTTP version: %r' % http_version)
@@ -598,33 +889,57 @@ def WsgiWorker(sock, peer_name, wsgi_application, default_env, date,
           # TODO(pts): Maybe override SERVER_NAME and SERVER_PORT from HTTP_HOST?
           # Does Apache do this?
 
-      if content_length is None:
-        if method in ('POST', 'PUT'):
+      if 'HTTP_TRANSFER_ENCODING' in env:
+        # Only a chunked POST or PUT request body is supported, and it must
+        # not have a Content-Length (to avoid request smuggling).
+        if (http_version != 'HTTP/1.1' or content_length is not None or
+            method not in ('POST', 'PUT') or
+            env['HTTP_TRANSFER_ENCODING'].lower() != 'chunked'):
           RespondWithBad(400,
-              date, server_software, sockfile, 'missing content')
+              date, server_software, sockfile, 'bad transfer-encoding')
           return
-        env['wsgi.input'] = input = coio.nblimitreader(None, 0)
-        if ('HTTP_SEC_WEBSOCKET_KEY1' in env and
-            'HTTP_SEC_WEBSOCKET_KEY2' in env):
-          content_length = 8
-      elif method not in ('POST', 'PUT'):
-        if content_length:
-          RespondWithBad(400,
-              date, server_software, sockfile, 'unexpected content')
-          return
-        content_length = None
-        del env['CONTENT_LENGTH']
-
-      if content_length:  # TODO(pts): Test this branch.
-        # TODO(pts): Avoid the memcpy() in unread.
-        env['wsgi.input'] = input = coio.nblimitreader(sockfile, content_length)
+        env['wsgi.input'] = input = coio.nbchunkedreader(sockfile)
       else:
-        env['wsgi.input'] = input = coio.nblimitreader(None, 0)
+        if content_length is None:
+          if method in ('POST', 'PUT'):
+            RespondWithBad(400,
+                date, server_software, sockfile, 'missing content')
+            return
+          if ('HTTP_SEC_WEBSOCKET_KEY1' in env and
+              'HTTP_SEC_WEBSOCKET_KEY2' in env):
+            content_length = 8
+        elif method not in ('POST', 'PUT'):
+          if content_length:
+            RespondWithBad(400,
+                date, server_software, sockfile, 'unexpected content')
+            return
+          content_length = None
+          del env['CONTENT_LENGTH']
+
+        if content_length:  # TODO(pts): Test this branch.
+          # TODO(pts): Avoid the memcpy() in unread.
+          env['wsgi.input'] = input = coio.nblimitreader(
+              sockfile, content_length)
+        else:
+          env['wsgi.input'] = input = coio.nblimitreader(None, 0)
 
       is_not_head = method != 'HEAD'
       res_content_length_ary = []
+      # Nonempty iff the response uses Transfer-Encoding: chunked. Contains
+      # the total size and then the strings (not sent yet) of the current
+      # batch.
+      res_chunk_batch = []
       headers_sent_ary[0] = False
 
+      def WriteTransferEncodingHead():
+        """Finish the response head without a Content-Length."""
+        if do_req_keep_alive and http_version == 'HTTP/1.1':
+          sockfile.write('Transfer-Encoding: chunked\r\n')
+          res_chunk_batch.append(0)
+          do_keep_alive_ary[0] = True
+        else:
+          do_keep_alive_ary[0] = False
+
       def WriteHead(data):
         """HEAD write() callback returned by StartResponse to the app."""
         data = str(data)
@@ -651,6 +966,11 @@ def WsgiWorker(sock, peer_name, wsgi_application, default_env, date,
         if not data:
           return
         if headers_sent_ary[0]:
+          if res_chunk_batch:
+            if res_chunk_batch[0]:
+              sockfile.write(PopChunkBatch(res_chunk_batch))
+            sockfile.write('%x\r\n%s\r\n' % (len(data), data))
+            return
           if res_content_length_ary:
             res_content_length_ary[1] -= len(data)
             if res_content_length_ary[1] < 0:
@@ -660,10 +980,14 @@ def WsgiWorker(sock, peer_name, wsgi_application, default_env, date,
           # previously.
           sockfile.write(data)
         else:
-          do_keep_alive_ary[0] = bool(
-              do_req_keep_alive and res_content_length_ary)
+          if res_content_length_ary:
+            do_keep_alive_ary[0] = do_req_keep_alive
+          else:
+            WriteTransferEncodingHead()
           sockfile.write(KEEP_ALIVE_RESPONSES[do_keep_alive_ary[0]])
           sockfile.write('\r\n')
+          if res_chunk_batch:
+            data = '%x\r\n%s\r\n' % (len(data), data)
           if res_content_length_ary:
             res_content_length_ary[1] -= len(data)
             if res_content_length_ary[1] < 0:
@@ -756,16 +1080,25 @@ def WsgiWorker(sock, peer_name, wsgi_application, default_env, date,
         if special_request_type:  # e.g. 'policy-file'
           headers_sent_ary[0] = True
         else:
-          sockfile.write('%s %s\r\n' % (http_version, status))  # HTTP/1.0
-          sockfile.write('Server: %s\r\n' % server_software)
-          sockfile.write('Date: %s\r\n' % date)
-          for key, value in response_headers:
+          head = ['%s %s\r\nServer: %s\r\nDate: %s\r\n' %
+                  (http_version, status, server_software, date)]
+          for key_value in response_headers:
+            key, value = key_value
+            is_cacheable = (type(key_value) is tuple and type(key) is str and
+                            type(value) is str)
             key = key.lower()
-            if (key not in ('status', 'server', 'date', 'connection') and
+            # The filtered keys must not be looked up in header_line_cache.
+            if (key not in ('status', 'server', 'date', 'connection',
+                            'transfer-encoding') and
                 not key.startswith('proxy-') and
                 # Apache responds with content-type for HEAD requests.
                 (is_not_head or key not in ('content-length',
                                             'content-transfer-encoding'))):
+              if is_cacheable:
+                line = header_line_cache.get(key_value)
+                if line is not None:
+                  head.append(line)
+                  continue
               if key == 'content-length':
                 del res_content_length_ary[:]
                 try:
@@ -784,7 +1117,15 @@ def WsgiWorker(sock, peer_name, wsgi_application, default_env, date,
                 raise WsgiResponseSyntaxError('invalid value for key %r: %r' %
                                               (key_capitalized, value))
               # TODO(pts): Eliminate duplicate keys (except for set-cookie).
-              sockfile.write('%s: %s\r\n' % (key_capitalized, value))
+              line = '%s: %s\r\n' % (key_capitalized, value)
+              head.append(line)
+              if (is_cacheable and key != 'content-length' and
+                  key != 'content-transfer-encoding'):
+                if (len(header_line_cache) >=
+                    RESPONSE_HEADER_LINE_CACHE_MAX_SIZE):
+                  header_line_cache.clear()
+                header_line_cache[key_value] = line
+          sockfile.write(''.join(head))
 
         # Don't flush yet.
         if is_not_head:
@@ -839,7 +1180,12 @@ def WsgiWorker(sock, peer_name, wsgi_application, default_env, date,
           logging.error('app has not called start_response')
           RespondWithBad(500, date, server_software, sockfile, '')
           return
-        date = None
+        # The Date: of the error response below.
+        res_date, date = date, None
+        sendfile_range = None
+        if (is_not_head and not res_chunk_batch and
+            isinstance(items, WsgiFileWrapper)):
+          sendfile_range = items.GetSendfileRange()
         if (isinstance(items, list) or isinstance(items, tuple) or
             isinstance(items, str)):
           if is_not_head:
@@ -850,7 +1196,12 @@ def WsgiWorker(sock, peer_name, wsgi_application, default_env, date,
           else:
             data = ''
           items = None
-          if headers_sent_ary[0]:
+          if res_chunk_batch:  # The app has called write().
+            if data:
+              data = '%x\r\n%s\r\n0\r\n\r\n' % (len(data), data)
+            else:
+              data = '0\r\n\r\n'
+          elif headers_sent_ary[0]:
             if (res_content_length_ary and
                 len(data) != res_content_length_ary[1]):
               if len(data) > res_content_length_ary[1]:
@@ -877,7 +1228,7 @@ def WsgiWorker(sock, peer_name, wsgi_application, default_env, date,
                     (res_content_length_ary[0], res_content_length_ary[1],
                      len(data)))
                 sockfile.discard_write_buffer()
-                RespondWithBad(500, date, server_software, sockfile, '')
+                RespondWithBad(500, res_date, server_software, sockfile, '')
                 continue
             else:
               if is_not_head:
@@ -886,10 +1237,51 @@ def WsgiWorker(sock, peer_name, wsgi_application, default_env, date,
             sockfile.write('\r\n')
           sockfile.write(data)
           sockfile.flush()
+        elif sendfile_range:
+          # Keep the behavior identical to wsgi_fast_respond_file in
+          # coio_src/nbevent.pxi.
+          fd, offset, size = sendfile_range
+          if headers_sent_ary[0]:
+            if res_content_length_ary and size != res_content_length_ary[1]:
+              if size > res_content_length_ary[1]:
+                logging.error(
+                    'truncated file content: header=%d remaining=%d file=%d'
+                    % (res_content_length_ary[0], res_content_length_ary[1],
+                       size))
+                size = res_content_length_ary[1]
+              else:
+                logging.error(
+                    'content length too large: header=%d remaining=%d file=%d'
+                    % (res_content_length_ary[0], res_content_length_ary[1],
+                       size))
+                do_keep_alive_ary[0] = False
+          else:
+            if input.discard_to_read_limit():
+              raise WsgiReadError(EISDIR, 'could not discard HTTP request body')
+            do_keep_alive_ary[0] = do_req_keep_alive
+            if res_content_length_ary:
+              if size != res_content_length_ary[1]:
+                logging.error(
+                    'invalid content length: header=%d remaining=%d file=%d' %
+                    (res_content_length_ary[0], res_content_length_ary[1],
+                     size))
+                sockfile.discard_write_buffer()
+                RespondWithBad(500, res_date, server_software, sockfile, '')
+                continue
+            else:
+              sockfile.write('Content-Length: %d\r\n' % size)
+            sockfile.write(KEEP_ALIVE_RESPONSES[do_keep_alive_ary[0]])
+            sockfile.write('\r\n')
+            headers_sent_ary[0] = True
+          if sockfile.sendfile(fd, offset, size) != size:
+            logging.error('file truncated while sending')
+            do_keep_alive_ary[0] = False
         elif is_not_head:
           if not headers_sent_ary[0]:
-            do_keep_alive_ary[0] = bool(
-                do_req_keep_alive and res_content_length_ary)
+            if res_content_length_ary:
+              do_keep_alive_ary[0] = do_req_keep_alive
+            else:
+              WriteTransferEncodingHead()
             sockfile.write(KEEP_ALIVE_RESPONSES[do_keep_alive_ary[0]])
             sockfile.write('\r\n')
           # TODO(pts): Speed: iterate over `items' below in another tasklet
@@ -916,6 +1308,8 @@ def WsgiWorker(sock, peer_name, wsgi_application, default_env, date,
                 break
           # TODO(pts): Catch and ignore TypeError in all these conversions.
           data = str(data)
+          if res_chunk_batch and data:
+            data = '%x\r\n%s\r\n' % (len(data), data)
           if 0 < len(data) <= 65536:
             sockfile.write(data)  # Still buffering it.
             sockfile.flush()
@@ -944,6 +1338,25 @@ def WsgiWorker(sock, peer_name, wsgi_application, default_env, date,
                 # Ignore the rest in another tasklet.
                 stackless.tasklet(ConsumerWorker)(items, is_debug)
                 return
+            elif res_chunk_batch:
+              # Keep the output byte-for-byte identical to
+              # wsgi_fast_respond_chunked in coio_src/nbevent.pxi.
+              for data in items:
+                data = str(data)
+                if not data or len(data) >= CHUNKED_RESPONSE_BATCH_SIZE:
+                  if res_chunk_batch[0]:
+                    sockfile.write(PopChunkBatch(res_chunk_batch))
+                  if data:
+                    sockfile.write('%x\r\n%s\r\n' % (len(data), data))
+                else:
+                  res_chunk_batch.append(data)
+                  res_chunk_batch[0] += len(data)
+                  if res_chunk_batch[0] >= CHUNKED_RESPONSE_BATCH_SIZE:
+                    sockfile.write(PopChunkBatch(res_chunk_batch))
+              if res_chunk_batch[0]:
+                sockfile.write(PopChunkBatch(res_chunk_batch) + '0\r\n\r\n')
+              else:
+                sockfile.write('0\r\n\r\n')
             else:
               for data in items:
                 sockfile.write(str(data))
@@ -972,7 +1385,11 @@ def WsgiWorker(sock, peer_name, wsgi_application, default_env, date,
           # other tasklet is working.
           # TODO(pts): Is this optimization safe? Limit the number of tasklets
           # to 1 to prevent DoS attacks.
-          stackless.tasklet(ConsumerWorker)(items, is_debug)  # Don't run it yet.
+          # Don't run it yet, and let the request-serving tasklets run first.
+          consumer_tasklet = stackless.tasklet(ConsumerWorker)(
+              items, is_debug)
+          coio.set_priority(consumer_tasklet, coio.PRIORITY_BACKGROUND)
+          coio.insert_background(consumer_tasklet)
           items = None  # Prevent double items.close(), see below.
 
       except WsgiReadError, e:
@@ -1017,6 +1434,8 @@ def WsgiWorker(sock, peer_name, wsgi_application, default_env, date,
     # sockfile.close calls sockfile.flush, which raises EBADF, because
     # sock.close() below has already been called.
     sockfile.discard_write_buffer()
+    if connection_limiter is not None:
+      connection_limiter.remove(accepted_sock)
     if do_multirequest:
       try:
         sock.close()
@@ -1035,6 +1454,7 @@ def PopulateDefaultWsgiEnv(env, server_socket):
   env['wsgi.multiprocess'] = False
   env['wsgi.run_once']     = False
   env['wsgi.url_scheme']   = 'http'
+  env['wsgi.file_wrapper'] = WsgiFileWrapper
   env['HTTPS']             = 'off'
   if isinstance(server_socket, tuple):
     server_ipaddr, server_port = server_socket
@@ -1050,7 +1470,14 @@ def PopulateDefaultWsgiEnv(env, server_socket):
     env['SERVER_ADDR'] = env['SERVER_NAME'] = socket.gethostname()
 
 
-def WsgiListener(server_socket, wsgi_application, upgrade_ssl_callback=None):
+# Maximum number of connections WsgiListener accepts at once (with
+# coio.nbsocket.accept_many) before spawning their WsgiWorker tasklets.
+ACCEPT_BATCH_SIZE = 64
+
+
+def WsgiListener(server_socket, wsgi_application, upgrade_ssl_callback=None,
+                 connection_limiter=None, max_workers=None,
+                 accept_batch_size=None):
   """HTTP or HTTPS server serving WSGI, listing on server_socket.
 
   WsgiListener should be run in is own tasklet.
@@ -1061,8 +1488,15 @@ def WsgiListener(server_socket, wsgi_application, upgrade_ssl_callback=None):
   errors, request parse errors, invalid HTTP responses, and exceptions
   raised in the WSGI application code).
 
-  WsgiListener supports HTTP Keep-Alive, and it will keep TCP connections
-  alive indefinitely. TODO(pts): Specify a timeout.
+  WsgiListener supports HTTP Keep-Alive. By default it will keep TCP
+  connections alive indefinitely, specify a connection_limiter to close idle
+  connections.
+
+  WsgiListener accepts all pending connections (up to accept_batch_size) at
+  once, and it can limit the number of WsgiWorker tasklets running at the
+  same time. While max_workers connections are being served, it stops
+  accepting new connections (so they wait in the listen queue of the
+  kernel) instead of using more and more memory during a traffic spike.
 
   Args:
     server_socket: An acceptable coio.nbsocket or coio.nbsslsocket.
@@ -1075,27 +1509,255 @@ def WsgiListener(server_socket, wsgi_application, upgrade_ssl_callback=None):
       is possible to make the WSGI server listen as both HTTP and HTTPS on the
       same port using an appropriate upgrade_ssl_callback calling
       accepted_socket.recv(..., socket.MSG_PEEK).
+    connection_limiter: A WsgiConnectionLimiter specifying the keep-alive
+      idle timeout and the maximum number of connections, or None.
+    max_workers: Maximum number of WsgiWorker tasklets (i.e. open accepted
+      connections) at the same time, or None for unlimited.
+    accept_batch_size: Maximum number of connections to accept at once, or
+      None to use ACCEPT_BATCH_SIZE.
   """
   if not hasattr(server_socket, 'getsockname'):
     raise TypeError
   if not callable(wsgi_application):
     raise TypeError
+  if max_workers is not None and max_workers < 1:
+    raise ValueError('max_workers must be positive')
+  if accept_batch_size is None:
+    accept_batch_size = ACCEPT_BATCH_SIZE
+  elif accept_batch_size < 1:
+    raise ValueError('accept_batch_size must be positive')
   env = {}
   PopulateDefaultWsgiEnv(env, server_socket)
+  accept_many = getattr(server_socket, 'accept_many', None)  # Not for SSL.
+  worker_function = WsgiWorker
+  if max_workers is not None:
+    worker_count_ary = [0]
+    worker_channel = stackless.channel()
+    worker_channel.preference = 1  # Prefer the sender.
+
+    def CountedWsgiWorker(*args):
+      try:
+        WsgiWorker(*args)
+      finally:
+        worker_count_ary[0] -= 1
+        if worker_channel.balance < 0:
+          worker_channel.send(None)
+
+    worker_function = CountedWsgiWorker
+
   try:
     while True:
-      accepted_socket, peer_name = server_socket.accept()
-      date = GetHttpDate(time.time())
-      if logging.root.level <= DEBUG:
-        logging.debug('connection accepted from=%r' % (peer_name,))
-      stackless.tasklet(WsgiWorker)(
-          accepted_socket, peer_name, wsgi_application, env, date, True,
-          upgrade_ssl_callback)
-      accepted_socket = peer_name = None  # Help the garbage collector.
+      batch_size = accept_batch_size
+      if connection_limiter is not None:
+        connection_limiter.wait_for_slot()
+        if connection_limiter.max_connections is not None:
+          batch_size = min(batch_size, connection_limiter.max_connections -
+                           connection_limiter.connection_count)
+      if max_workers is not None:
+        while worker_count_ary[0] >= max_workers:
+          worker_channel.receive()
+        batch_size = min(batch_size, max_workers - worker_count_ary[0])
+      if accept_many is None:
+        accepted = (server_socket.accept(),)
+      else:
+        # batch_size is positive here, the waits above have made room.
+        accepted = accept_many(batch_size)
+      date = GetCurrentHttpDate()
+      for accepted_socket, peer_name in accepted:
+        if logging.root.level <= DEBUG:
+          logging.debug('connection accepted from=%r' % (peer_name,))
+        if connection_limiter is not None:
+          connection_limiter.add(accepted_socket)
+        if max_workers is not None:
+          worker_count_ary[0] += 1
+        stackless.tasklet(worker_function)(
+            accepted_socket, peer_name, wsgi_application, env, date, True,
+            upgrade_ssl_callback, connection_limiter)
+      accepted = accepted_socket = peer_name = None  # Help the GC.
   finally:
     server_socket.close()
 
 
+# Socket option for binding multiple listening sockets to the same address,
+# with the kernel distributing the incoming connections between them. Python
+# 2 doesn't define socket.SO_REUSEPORT, 15 is the value on Linux 3.9+.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT',
+                       sys.platform.startswith('linux') and 15 or None)
+
+# Signals received by RunPreforkWorkers which are forwarded to the workers.
+# All but SIGHUP make it stop (without restarting the workers).
+PREFORK_FORWARDED_SIGNALS = (signal.SIGTERM, signal.SIGINT, signal.SIGQUIT,
+                             signal.SIGHUP)
+
+
+def GetCpuCount():
+  """Return the number of CPUs online (at least 1)."""
+  try:
+    return max(1, os.sysconf('SC_NPROCESSORS_ONLN'))
+  except (AttributeError, ValueError, OSError):
+    return 1
+
+
+def RunPreforkWorkers(worker_function, process_count=None, do_pin_cpus=False,
+                      restart_delay=1.0):
+  """Fork worker processes, and supervise them until stopped by a signal.
+
+  Each worker process calls coio.reinit() (so it gets a fresh event loop),
+  resets the signals in PREFORK_FORWARDED_SIGNALS to their default action,
+  and then calls worker_function(worker_index). Workers which exit are
+  restarted (after restart_delay seconds if they had been running for less
+  than that). The signals in PREFORK_FORWARDED_SIGNALS are forwarded to the
+  workers. All but SIGHUP make RunPreforkWorkers return after all workers
+  have exited. SIGHUP (which kills the workers by default) just restarts
+  them.
+
+  The supervisor process blocks in os.waitpid, so it should not run other
+  tasklets.
+
+  Args:
+    worker_function: Callable taking the worker index (0 <= worker_index <
+      process_count), run in the worker processes. The worker process exits
+      when it returns.
+    process_count: Number of worker processes, or None to use GetCpuCount().
+    do_pin_cpus: If true, pin each worker to a single CPU (worker_index
+      modulo GetCpuCount()) with coio.set_cpu_affinity.
+    restart_delay: Minimum number of seconds between starting and
+      restarting a worker.
+  """
+  if process_count is None:
+    process_count = GetCpuCount()
+  if process_count < 1:
+    raise ValueError('process_count must be positive, got %r' %
+                     (process_count,))
+  cpu_count = GetCpuCount()
+  children = {}  # Maps pids to worker indexes.
+  start_times = [0] * process_count
+  stop_signums = []
+
+  def HandleSignal(signum, frame):
+    if signum != signal.SIGHUP:
+      stop_signums.append(signum)
+    for pid in children:
+      try:
+        os.kill(pid, signum)
+      except OSError:
+        pass
+
+  def StartWorker(worker_index):
+    start_times[worker_index] = time.time()
+    pid = os.fork()
+    if pid:
+      children[pid] = worker_index
+      return
+    exit_code = 1
+    try:
+      try:
+        for signum in PREFORK_FORWARDED_SIGNALS:
+          signal.signal(signum, signal.SIG_DFL)
+        coio.reinit()
+        if do_pin_cpus:
+          coio.set_cpu_affinity([worker_index % cpu_count])
+        worker_function(worker_index)
+        exit_code = 0
+      except SystemExit, e:
+        if isinstance(e.code, int):
+          exit_code = e.code
+      except:
+        logging.error('prefork worker %d failed' % worker_index,
+                      exc_info=True)
+    finally:
+      try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+      finally:
+        os._exit(exit_code)
+
+  old_handlers = [(signum, signal.signal(signum, HandleSignal))
+                  for signum in PREFORK_FORWARDED_SIGNALS]
+  try:
+    for worker_index in xrange(process_count):
+      StartWorker(worker_index)
+    while children:
+      try:
+        pid, status = os.waitpid(-1, 0)
+      except OSError, e:
+        if e.errno == errno.EINTR:
+          continue
+        if e.errno == errno.ECHILD:
+          break
+        raise
+      worker_index = children.pop(pid, None)
+      if worker_index is None or stop_signums:
+        continue
+      logging.warning('prefork worker %d (pid %d) exited with status 0x%x, '
+                      'restarting' % (worker_index, pid, status))
+      delay = start_times[worker_index] + restart_delay - time.time()
+      if delay > 0:
+        try:
+          time.sleep(delay)
+        except IOError:  # EINTR.
+          pass
+      if not stop_signums:
+        StartWorker(worker_index)
+  finally:
+    for signum, old_handler in old_handlers:
+      signal.signal(signum, old_handler)
+
+
+def PreforkWsgiListener(server_address, wsgi_application,
+                        upgrade_ssl_callback=None, process_count=None,
+                        listen_queue_size=100, do_pin_cpus=False):
+  """Run WsgiListener in prefork worker processes, see RunPreforkWorkers.
+
+  If SO_REUSEPORT is supported, each worker listens on its own socket, so
+  the kernel distributes the incoming connections evenly between the
+  workers. Otherwise the workers share a single listening socket.
+
+  Args:
+    server_address: TCP address to bind to, e.g. ('', 8080).
+    wsgi_application: The WSGI application callable.
+    upgrade_ssl_callback: Passed to WsgiListener.
+    process_count: Number of worker processes, or None to use GetCpuCount().
+    listen_queue_size: The backlog of the listening socket(s).
+    do_pin_cpus: Passed to RunPreforkWorkers.
+  """
+  # Bind (but don't listen on) a socket in the supervisor to detect errors
+  # early and to reserve the port (useful if the port is 0).
+  address_socket = coio.nbsocket(socket.AF_INET, socket.SOCK_STREAM)
+  address_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  do_reuse_port = SO_REUSEPORT is not None
+  if do_reuse_port:
+    try:
+      address_socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    except socket.error:
+      do_reuse_port = False
+  address_socket.bind(server_address)
+  server_address = address_socket.getsockname()
+  if not do_reuse_port:
+    address_socket.listen(listen_queue_size)
+  logging.info('listening on %r with %s prefork workers%s' %
+               (server_address, process_count or GetCpuCount(),
+                ('', ' (SO_REUSEPORT)')[do_reuse_port]))
+
+  def Worker(worker_index):
+    if do_reuse_port:
+      address_socket.close()
+      server_socket = coio.nbsocket(socket.AF_INET, socket.SOCK_STREAM)
+      server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      server_socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+      server_socket.bind(server_address)
+      server_socket.listen(listen_queue_size)
+    else:
+      server_socket = address_socket
+    WsgiListener(server_socket, wsgi_application, upgrade_ssl_callback)
+
+  try:
+    RunPreforkWorkers(Worker, process_count=process_count,
+                      do_pin_cpus=do_pin_cpus)
+  finally:
+    address_socket.close()
+
+
 class SslUpgrader(object):
   """A simple upgrade_ssl_callback implementation."""
 
@@ -1434,13 +2096,18 @@ def CanBeCherryPyApp(app):
   return False
 
 
-def RunHttpServer(app, server_address=None, listen_queue_size=100):
+def RunHttpServer(app, server_address=None, listen_queue_size=100,
+                  process_count=1, do_pin_cpus=False):
   """Listen as a HTTP server, and run the specified application forever.
 
   Args:
     app: A WSGI application function, or a (web.py) web.application object.
     server_address: TCP address to bind to, e.g. ('', 8080), or None to use
       the default.
+    process_count: Number of prefork worker processes (see
+      PreforkWsgiListener), or None to use one per CPU. The default, 1,
+      serves in the current process.
+    do_pin_cpus: Pin each prefork worker to a single CPU.
   """
   # TODO(pts): Support HTTPS in this function. See examples/demo.py for
   # HTTPS support.
@@ -1519,6 +2186,12 @@ def RunHttpServer(app, server_address=None, listen_queue_size=100):
   else:
     assert 0, 'unsupported application type for %r' % (app,)
 
+  if process_count != 1:
+    PreforkWsgiListener(server_address, wsgi_application,
+                        process_count=process_count,
+                        listen_queue_size=listen_queue_size,
+                        do_pin_cpus=do_pin_cpus)
+    return
   server_socket = coio.nbsocket(socket.AF_INET, socket.SOCK_STREAM)
   server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
   server_socket.bind(server_address)
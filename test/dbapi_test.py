@@ -0,0 +1,92 @@
+#! /usr/local/bin/stackless2.6
+
+import sqlite3
+import thread
+import time
+import unittest
+
+from syncless import coio
+from syncless import dbapi
+from syncless import util
+
+
+def SlowIdentity(value):
+  time.sleep(0.05)  # Blocks the worker thread only.
+  return value
+
+
+class DbapiTest(unittest.TestCase):
+  def setUp(self):
+    self.db_conn = dbapi.connect_sqlite3(':memory:')
+    self.db_conn.execute('CREATE TABLE t (i integer)')
+    self.db_conn.cursor().executemany(
+        'INSERT INTO t (i) VALUES (?)', [(i,) for i in xrange(200)])
+    self.db_conn.commit()
+
+  def tearDown(self):
+    self.db_conn.close()
+
+  def testFetch(self):
+    cursor = self.db_conn.cursor()
+    cursor.batch_size = 16
+    cursor.execute('SELECT i FROM t ORDER BY i')
+    self.assertEqual('i', cursor.description[0][0])
+    self.assertEqual((0,), cursor.fetchone())
+    self.assertEqual([(1,), (2,)], cursor.fetchmany(2))
+    self.assertEqual([(i,) for i in xrange(3, 20)], cursor.fetchmany(17))
+    self.assertEqual([(i,) for i in xrange(20, 200)], list(cursor))
+    self.assertEqual(None, cursor.fetchone())
+    cursor.execute('SELECT i FROM t WHERE i < 3 ORDER BY i')
+    self.assertEqual((0,), cursor.fetchone())
+    self.assertEqual([(1,), (2,)], cursor.fetchall())
+    cursor.close()
+
+  def testInterruptedQuery(self):
+    self.db_conn.call(sqlite3.Connection.create_function, 'slow', 1,
+                      SlowIdentity)
+    results = []
+    with util.Timeout(0.01):
+      results.append(self.db_conn.execute('SELECT slow(42)').fetchall())
+    self.assertEqual([], results)
+    # The next queries don't get the rows of the interrupted one.
+    self.assertEqual([(7,)], self.db_conn.execute('SELECT 7').fetchall())
+    self.assertEqual([(8,)], self.db_conn.execute('SELECT 8').fetchall())
+
+  def testError(self):
+    self.assertRaises(sqlite3.OperationalError, self.db_conn.execute,
+                      'SELECT * FROM missing')
+    self.assertEqual([(200,)],
+                     self.db_conn.execute('SELECT COUNT(*) FROM t').fetchall())
+
+  def testOtherTaskletsRun(self):
+    ticks = []
+    def Ticker():
+      while True:
+        coio.sleep(0.002)
+        ticks.append(1)
+    ticker = coio.stackless.tasklet(Ticker)()
+    query = ('SELECT COUNT(*) FROM t AS t1, t AS t2, t AS t3 '
+             'WHERE t1.i < t2.i AND t2.i < t3.i')
+    self.assertEqual([(1313400,)], self.db_conn.execute(query).fetchall())
+    ticker.kill()
+    self.assertTrue(len(ticks) >= 2, ticks)
+
+  def testDedicatedThread(self):
+    thread_idents = []
+    self.db_conn.call(sqlite3.Connection.create_function, 'f', 1,
+                      lambda i: thread_idents.append(thread.get_ident()) or i)
+    self.assertEqual(
+        [(200,)], self.db_conn.execute('SELECT COUNT(f(i)) FROM t').fetchall())
+    self.assertEqual(200, len(thread_idents))
+    self.assertEqual(1, len(set(thread_idents)))
+    self.assertNotEqual(thread.get_ident(), thread_idents[0])
+
+  def testClose(self):
+    db_conn = dbapi.connect_sqlite3(':memory:')
+    self.assertEqual(1, db_conn._pool.stats()['thread_count'])
+    db_conn.close()
+    self.assertEqual(0, db_conn._pool.stats()['thread_count'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,71 @@
+#! /usr/local/bin/stackless2.6
+
+import time
+import unittest
+
+from syncless import coio
+
+
+LOOPRET = int(bool(coio.has_feature_may_loop_return_1()))
+
+
+class LoopStatsTest(unittest.TestCase):
+  def setUp(self):
+    coio.loop_stats(reset=True)
+
+  def tearDown(self):
+    coio.set_loop_stats_hook(None)
+
+  def testCounters(self):
+    coio.sleep(0.02)
+    stats = coio.loop_stats()
+    self.assertTrue(stats['blocking_count'] >= 1)
+    self.assertTrue(stats['loop_usec_max'] >= 10000)
+    self.assertTrue(stats['loop_usec_total'] >= stats['loop_usec_max'])
+    # The main tasklet was woken up by the sleep.
+    self.assertTrue(stats['inserted_max'] >= 1)
+    self.assertEqual(sum(stats['loop_usec_histogram']),
+                     stats['blocking_count'] + stats['nonblocking_count'])
+    self.assertEqual(len(stats['loop_usec_histogram']),
+                     len(stats['inserted_histogram']))
+
+  def testRunTime(self):
+    def Busy():
+      time.sleep(0.02)  # Blocks the whole process.
+    coio.stackless.tasklet(Busy)()
+    coio.stackless.schedule()
+    coio.stackless.schedule()
+    stats = coio.loop_stats(reset=True)
+    self.assertTrue(stats['nonblocking_count'] >= 1)
+    self.assertTrue(stats['run_usec_max'] >= 10000)
+    self.assertEqual(0, coio.loop_stats()['nonblocking_count'])
+
+  def testHook(self):
+    snapshots = []
+    coio.set_loop_stats_hook(snapshots.append, 0.005)
+    while len(snapshots) < 2:
+      coio.sleep(0.002)
+    coio.set_loop_stats_hook(None)
+    self.assertTrue(snapshots[1]['blocking_count'] >= 1)
+    self.assertRaises(ValueError, coio.set_loop_stats_hook, len, 0)
+    # The hook is not an event which would keep the process alive.
+    coio.set_loop_stats_hook(snapshots.append, 60)
+    self.assertEqual(LOOPRET, coio.nonblocking_loop_for_tests())
+
+  def testBusyPoll(self):
+    coio.set_schedule_policy(busy_poll_usec=500000)
+    try:
+      self.assertEqual(500000, coio.get_schedule_policy()['busy_poll_usec'])
+      coio.sleep(0.005)
+    finally:
+      coio.set_schedule_policy(busy_poll_usec=0)
+    stats = coio.loop_stats()
+    self.assertEqual(0, stats['blocking_count'])
+    self.assertEqual(1, stats['busy_poll_count'])
+    self.assertEqual(1, stats['busy_poll_hit_count'])
+    self.assertTrue(stats['busy_poll_loop_count'] > 1)
+    self.assertTrue(stats['busy_poll_usec_total'] >= 4000)
+
+
+if __name__ == '__main__':
+  unittest.main()
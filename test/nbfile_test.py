@@ -3,7 +3,9 @@
 
 import errno
 import os
+import resource
 import socket
+import tempfile
 import unittest
 
 from syncless import coio
@@ -99,6 +101,22 @@ class NbfileTest(unittest.TestCase):
     self.AssertReadLineWait('', 'foo', 0)
     self.AssertReadLineWait('foo', '', 3)
 
+  def testHighFd(self):
+    if coio.method() == 'minievent-select':
+      return  # select(2) doesn't support fds above FD_SETSIZE.
+    high_fd = 1100
+    if resource.getrlimit(resource.RLIMIT_NOFILE)[0] <= high_fd:
+      return
+    read_fd, write_fd = os.pipe()
+    os.dup2(read_fd, high_fd)
+    os.close(read_fd)
+    f = coio.nbfile(high_fd, write_fd, write_buffer_limit=0, do_close=1)
+    try:
+      coio.stackless.tasklet(f.write)('foo\n')
+      self.assertEqual('foo\n', f.readline())  # Waits for high_fd.
+    finally:
+      f.close()
+
   def testReadLineLongLine(self):
     # SUXX: TODO(pts): Why does this fall to an infinite loop with
     # libevent-1.4.13? It works with libev-3.9.
@@ -137,6 +155,32 @@ class NbfileTest(unittest.TestCase):
       assert reader1_tasklet.alive
     assert not reader2_tasklet.alive
 
+  def testPersistentWatch(self):
+    self.assertTrue(self.f is self.f.set_persistent_watch(True))
+    self.AssertReadLineWait('foo', 'foo\nbar\n', 3)
+    self.AssertReadLineWait('\n', '')
+    self.AssertReadLineWait('bar\n', '')
+    ksn = 'ABCDEFGHI' * 111111 + '\n'  # Needs multiple EAGAINs.
+    self.AssertReadLineWait(ksn, ksn + 'foo')
+    self.AssertReadLineWait('foo', '', 3)
+    self.testTwoReaders()
+    # Stopping the watcher wakes up the parked reader, which then waits
+    # with a one-shot event.
+    read_chars = []
+    reader_tasklet = coio.stackless.tasklet(
+        lambda: read_chars.append(self.f.read(1)))()
+    coio.stackless.schedule()
+    assert not reader_tasklet.scheduled
+    self.f.set_persistent_watch(False)
+    coio.stackless.schedule()
+    assert not reader_tasklet.scheduled
+    self.f.write('c')
+    coio.stackless.schedule()
+    self.assertEqual(['c'], read_chars)
+    assert not reader_tasklet.alive
+    self.f.set_persistent_watch(True)
+    self.AssertReadLineWait('baz\n', 'baz\n')
+
   def testBuffer(self):
     self.assertEqual(0, self.f.read_buffer_len)
     self.f.unread('barb')
@@ -265,6 +309,103 @@ class NbfileTest(unittest.TestCase):
     self.assertEqual(3, self.f.read_more(5))
     self.assertEqual('foobarbazhiHELLO!end', self.f.get_string())
 
+  def testReadHttpRequestEnv(self):
+    default_env = {'wsgi.version': (1, 0)}
+    self.f.write('GET /foo%20bar?x=y HTTP/1.0\r\nHost: example.com\r\n'
+                 'Accept: a\r\naccept: b\r\nX-Foo-Bar: baz \r\n'
+                 'Proxy-Connection: foo\r\nConnection: keep-alive\r\n\r\n'
+                 'POST / HTTP/1.1\r\nContent-Length: 42\r\n'
+                 'Content-Type: text/plain\r\nConnection: close\r\n\r\n'
+                 'GET /<> HTTP/1.1\r\n\r\n')
+    env, content_length, do_keep_alive = self.f.read_http_request_env(
+        8192, default_env)
+    self.assertEqual({'wsgi.version': (1, 0)}, default_env)
+    self.assertEqual({
+        'wsgi.version': (1, 0), 'REQUEST_METHOD': 'GET',
+        'SERVER_PROTOCOL': 'HTTP/1.0', 'SCRIPT_NAME': '',
+        'PATH_INFO': '/foo%20bar', 'QUERY_STRING': 'x=y',
+        'HTTP_HOST': 'example.com', 'HTTP_ACCEPT': 'a, b',
+        'HTTP_X_FOO_BAR': 'baz '}, env)
+    self.assertEqual((None, True), (content_length, do_keep_alive))
+    env, content_length, do_keep_alive = self.f.read_http_request_env(
+        8192, default_env)
+    self.assertEqual('POST', env['REQUEST_METHOD'])
+    self.assertEqual('42', env['CONTENT_LENGTH'])
+    self.assertEqual('text/plain', env['CONTENT_TYPE'])
+    self.assertEqual((42, False), (content_length, do_keep_alive))
+    self.assertRaises(ValueError, self.f.read_http_request_env,
+                      8192, default_env)
+
+  def testSendfile(self):
+    tmp = tempfile.TemporaryFile()
+    try:
+      tmp.write('Hello, World!')
+      tmp.flush()
+      self.f.write('foo')
+      self.assertEqual(6, self.f.sendfile(tmp.fileno(), 7, 10))
+      self.assertEqual(3, self.f.sendfile(tmp.fileno(), 1, 3))
+      self.assertEqual(0, self.f.sendfile(tmp.fileno(), 13, 1))
+      self.assertEqual('fooWorld!ell', self.f.read(12))
+    finally:
+      tmp.close()
+
+  def testAcceptMany(self):
+    server_socket = coio.nbsocket(socket.AF_INET, socket.SOCK_STREAM)
+    client_sockets = []
+    try:
+      server_socket.bind(('127.0.0.1', 0))
+      server_socket.listen(10)
+      for i in xrange(3):
+        client_sockets.append(socket.create_connection(
+            server_socket.getsockname()))
+      accepted = server_socket.accept_many(2)
+      accepted.extend(server_socket.accept_many(2))
+      self.assertEqual(3, len(accepted))
+      self.assertEqual([client_socket.getsockname()
+                        for client_socket in client_sockets],
+                       [peer_name for sock, peer_name in accepted])
+      sock = accepted[0][0]
+      self.assertTrue(isinstance(sock, coio.nbsocket))
+      self.assertEqual(None, sock.gettimeout())
+      client_sockets[0].sendall('foo')
+      self.assertEqual('foo', sock.recv(3))
+      sock.sendall('bar')
+      self.assertEqual('bar', client_sockets[0].recv(3))
+      server_socket.settimeout(0)
+      self.assertRaisesErrno(socket.error, errno.EAGAIN,
+                             server_socket.accept_many, 2)
+      self.assertRaises(ValueError, server_socket.accept_many, 0)
+    finally:
+      for client_socket in client_sockets:
+        client_socket.close()
+      server_socket.close()
+
+  def testNbchunkedreader(self):
+    self.f.write('3\r\nfoo\r\n09;x=y\r\nbar\nbaz\nq\r\n'
+                 '1 \r\n\n\r\n0\r\nX-Trailer: 1\r\n\r\nrest')
+    reader = coio.nbchunkedreader(self.f)
+    self.assertEqual('fo', reader.read(2))
+    self.assertEqual('obar\n', reader.readline())
+    self.assertEqual('ba', reader.readline(2))
+    self.assertEqual('z', reader.readline_stripend())
+    self.assertEqual(['q\n'], reader.readlines())
+    self.assertEqual('', reader.read())
+    self.assertEqual(0, reader.discard_to_read_limit())
+    self.assertEqual('rest', self.f.read(4))
+    self.f.write('5\r\nhello\r\n6\r\n world\r\n0\r\n\r\nrest')
+    self.assertEqual('hello world', coio.nbchunkedreader(self.f).read())
+    self.assertEqual('rest', self.f.read(4))
+    self.f.write('5\r\nhello\r\n6\r\n world\r\n0\r\n\r\nrest')
+    self.assertEqual(0, coio.nbchunkedreader(self.f).discard_to_read_limit())
+    self.assertEqual('rest', self.f.read(4))
+    self.f.write('2\r\nab\r\nx\r\n')
+    reader = coio.nbchunkedreader(self.f)
+    self.assertEqual('ab', reader.read(2))
+    self.assertRaisesErrno(IOError, errno.EINVAL, reader.read)
+    self.f.write('1\r\nabc\r\n')
+    self.assertRaisesErrno(IOError, errno.EINVAL,
+                           coio.nbchunkedreader(self.f).read)
+
 
 class NbfileSocketPairTest(NbfileTest):
   def setUp(self):
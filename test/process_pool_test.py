@@ -0,0 +1,112 @@
+#! /usr/local/bin/stackless2.6
+
+import os
+import socket
+import time
+import unittest
+
+from syncless import coio
+
+
+def Divide(a, b):
+  return a / b
+
+
+def SleepAndGetPid(sleep_sec):
+  time.sleep(sleep_sec)  # Blocks the worker process only.
+  return os.getpid()
+
+
+def ReturnUnpicklable():
+  return lambda: 42
+
+
+def GetOpenFds():
+  fds = []
+  for fd_str in os.listdir('/proc/self/fd'):
+    try:
+      os.fstat(int(fd_str))  # Fails for the already closed fd of listdir.
+    except OSError:
+      continue
+    fds.append(int(fd_str))
+  return sorted(fds)
+
+
+class ProcessPoolTest(unittest.TestCase):
+  def testCall(self):
+    pool = coio.process_pool(2)
+    self.assertEqual(7, pool(Divide, 42, b=6))
+    try:
+      pool(Divide, 1, 0)
+      self.fail('ZeroDivisionError not raised')
+    except ZeroDivisionError, e:
+      self.assertTrue('in Divide' in e.remote_traceback)
+    self.assertRaises(coio.ProcessPoolError, pool, ReturnUnpicklable)
+    self.assertNotEqual(os.getpid(), pool(SleepAndGetPid, 0))
+    pool.close()
+
+  def testConcurrentCalls(self):
+    pool = coio.process_pool(2)
+    pids = []
+    def Worker():
+      pids.append(pool(SleepAndGetPid, 0.05))
+    tasklets = [coio.stackless.tasklet(Worker)() for i in xrange(2)]
+    ticks = 0
+    start = time.time()
+    while [t for t in tasklets if t.alive]:
+      coio.sleep(0.005)
+      ticks += 1
+    self.assertTrue(time.time() - start < 0.09)
+    # The main loop was serving other tasklets meanwhile.
+    self.assertTrue(ticks >= 5)
+    self.assertEqual(2, len(set(pids)))
+    pool.close()
+
+  def testInheritedFdsClosed(self):
+    if not os.path.isdir('/proc/self/fd'):
+      return
+    server_socket = coio.nbsocket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.bind(('127.0.0.1', 0))
+    server_socket.listen(10)
+    pool = coio.process_pool(2)
+    try:
+      pool(GetOpenFds)  # Start the first worker process.
+      def Worker():
+        fds_list.append(pool(GetOpenFds))
+      fds_list = []
+      tasklets = [coio.stackless.tasklet(Worker)() for i in xrange(2)]
+      while [t for t in tasklets if t.alive]:
+        coio.sleep(0.005)
+      # Only the socket to the parent is open (besides stdin, stdout and
+      # stderr), not the listening socket, the event loop fd, the wakeup fd
+      # or the socket of the other worker process.
+      for fds in fds_list:
+        self.assertEqual(1, len([fd for fd in fds if fd > 2]), fds)
+    finally:
+      pool.close()
+      server_socket.close()
+
+  def testRecycle(self):
+    pool = coio.process_pool(1, max_tasks_per_child=2)
+    pids = [pool(SleepAndGetPid, 0) for i in xrange(5)]
+    self.assertEqual(pids[0], pids[1])
+    self.assertEqual(pids[2], pids[3])
+    self.assertEqual(3, len(set(pids)))
+    pool.close()
+    self.assertNotEqual(pids[4], pool(SleepAndGetPid, 0))
+    pool.close()
+
+  def testCrash(self):
+    pool = coio.process_pool(1)
+    pid = pool(SleepAndGetPid, 0)
+    try:
+      pool(os._exit, 3)
+      self.fail('ProcessPoolError not raised')
+    except coio.ProcessPoolError, e:
+      self.assertEqual('worker process %d exited with status 3' % pid, str(e))
+    self.assertNotEqual(pid, pool(SleepAndGetPid, 0))
+    pool.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -4,6 +4,7 @@
 
 import os
 import sys
+import time
 import unittest
 
 from syncless.best_stackless import stackless
@@ -111,6 +112,129 @@ class ScheduleTest(unittest.TestCase):
     finally:
       nbf.close()
 
+  def testWakeupLast(self):
+    events = []
+
+    def Worker(name, count):
+      while count > 0:
+        events.append(name)
+        count -= 1
+        if count > 0:
+          stackless.schedule()
+
+    nbf = coio.nbfile(*os.pipe())
+    coio.set_schedule_policy(wakeup_first=False)
+    try:
+      def SenderWorker(name):
+        events.append(name)
+        nbf.write('S')
+        nbf.flush()
+
+      def ReceiverWorker(name):
+        events.append(name)
+        nbf.read_at_most(1)
+        events.append(name.lower())
+
+      stackless.tasklet(ReceiverWorker)('W')
+      stackless.tasklet(SenderWorker)('A')
+      stackless.tasklet(Worker)('B', 3)
+      stackless.tasklet(Worker)('C', 3)
+      for i in xrange(4):
+        stackless.schedule()
+
+      self.assertEqual(
+          'WABC'
+          'BC'  # W woken up, but inserted after B and C.
+          'wBC',
+          ''.join(events))
+    finally:
+      coio.set_schedule_policy(wakeup_first=True)
+      nbf.close()
+
+  def testRunBatch(self):
+    self.assertEqual(
+        {'run_batch': 0, 'time_budget': 0.0, 'wakeup_first': True,
+         'busy_poll_usec': 0},
+        coio.get_schedule_policy())
+    polls = []
+
+    def Worker(count):
+      while count > 0:
+        stats = coio.loop_stats()
+        polls.append(stats['blocking_count'] + stats['nonblocking_count'])
+        stackless.schedule()
+        count -= 1
+
+    coio.set_schedule_policy(run_batch=1)
+    try:
+      workers = [stackless.tasklet(Worker)(5) for i in xrange(3)]
+      while [worker for worker in workers if worker.alive]:
+        stackless.schedule()
+    finally:
+      coio.set_schedule_policy(run_batch=0)
+    # Exactly 1 tasklet has run after each poll.
+    self.assertEqual(len(polls), len(set(polls)))
+    self.assertRaises(ValueError, coio.set_schedule_policy, -1)
+
+  def testPriorities(self):
+    events = []
+
+    def Worker(name, count):
+      while count > 0:
+        events.append(name)
+        count -= 1
+        time.sleep(0.003)  # Blocks the whole process.
+        if count > 0:
+          stackless.schedule()
+
+    def BackgroundWorker(name, count):
+      while count > 0:
+        events.append(name)
+        count -= 1
+        if count > 0:
+          coio.schedule_background()
+
+    def Sleeper(name):
+      events.append(name)
+      coio.sleep(0.001)
+      events.append(name.lower())
+
+    tasklets = [stackless.tasklet(BackgroundWorker)('b', 3),
+                stackless.tasklet(Sleeper)('S'),
+                stackless.tasklet(Sleeper)('H'),
+                stackless.tasklet(Worker)('N', 4),
+                stackless.tasklet(Worker)('M', 4)]
+    coio.set_priority(tasklets[1], coio.PRIORITY_BACKGROUND)
+    coio.set_priority(tasklets[2], 42)
+    self.assertEqual(coio.PRIORITY_HIGH, coio.get_priority(tasklets[2]))
+    self.assertEqual(coio.PRIORITY_NORMAL, coio.get_priority(tasklets[3]))
+    while [tasklet for tasklet in tasklets if tasklet.alive]:
+      coio.sleep(0.01)
+    self.assertEqual(
+        'bSHNM'  # First iteration, in tasklet creation order.
+        'h'  # High priority, woken up before the others.
+        'NMNMNM'
+        'bsb',  # Background tasklets, when nothing else is runnable.
+        ''.join(events))
+
+  def testInsertBackground(self):
+    events = []
+
+    def Worker(name):
+      events.append(name)
+
+    # Already runnable when created, but moved to the background.
+    background_tasklet = stackless.tasklet(Worker)('b')
+    coio.insert_background(background_tasklet)
+    tasklets = [background_tasklet,
+                stackless.tasklet(Worker)('N'),
+                stackless.tasklet(Worker)('M')]
+    self.assertRaises(RuntimeError, coio.insert_background,
+                      stackless.getcurrent())
+    while [tasklet for tasklet in tasklets if tasklet.alive]:
+      coio.sleep(0.01)
+    self.assertEqual('NMb', ''.join(events))
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -114,6 +114,36 @@ class SleepTest(unittest.TestCase):
     assert not tasklet_obj.alive
     self.assertEqual(LOOPRET, coio.nonblocking_loop_for_tests())  # No registered events.
 
+  def testManySleepersWakeUpInOrder(self):
+    self.assertEqual(LOOPRET, coio.nonblocking_loop_for_tests())  # No registered events.
+    log_items = []
+    sleep_done_channel = coio.stackless.channel()
+    sleep_done_channel.preference = 1  # Prefer the sender.
+
+    def Sleeper(i):
+      coio.sleep(SMALL_SLEEP_SEC * i / 10.0)
+      log_items.append(i)
+      sleep_done_channel.send(None)
+
+    order = [(i * 7) % 23 for i in xrange(23)]  # A permutation of 0..22.
+    tasklets = [coio.stackless.tasklet(Sleeper)(i) for i in order]
+    long_sleepers = [coio.stackless.tasklet(coio.sleep)(30)
+                     for i in xrange(5)]
+    try:
+      coio.stackless.schedule()
+      for tasklet_obj in long_sleepers[1::2]:  # Remove some timers early.
+        tasklet_obj.kill()
+      for i in order:
+        sleep_done_channel.receive()
+    finally:
+      for tasklet_obj in long_sleepers:
+        tasklet_obj.kill()
+    if coio.method() == 'minievent-select':
+      # It fires the timers expiring in the same pass in registration order.
+      log_items.sort()
+    self.assertEqual(range(23), log_items)
+    self.assertEqual(LOOPRET, coio.nonblocking_loop_for_tests())  # No registered events.
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,212 @@
+#! /usr/local/bin/stackless2.6
+
+import signal
+import time
+import unittest
+
+from syncless import coio
+from syncless import util
+
+
+def SleepAndReturn(sleep_sec, value):
+  time.sleep(sleep_sec)
+  return value
+
+
+def SleepAndRaise(sleep_sec, exc):
+  time.sleep(sleep_sec)
+  raise exc
+
+
+class ThreadPoolTest(unittest.TestCase):
+  def setUp(self):
+    self.got_signals = []
+    self.old_sigusr2_handler = signal.signal(
+        signal.SIGUSR2, lambda *args: self.got_signals.append(args[0]))
+    # A non-internal event, so the main loop waits instead of exiting.
+    self.sleeper = coio.stackless.tasklet(coio.sleep)(999999)
+    coio.stackless.schedule()
+
+  def tearDown(self):
+    self.sleeper.insert()  # Cancel the sleep.
+    coio.stackless.schedule()
+    signal.signal(signal.SIGUSR2, self.old_sigusr2_handler)
+
+  def testCall(self):
+    pool = coio.thread_pool(4)
+    results = []
+    def Worker(sleep_sec, value):
+      results.append(pool(SleepAndReturn, sleep_sec, value))
+    for value in (3, 1, 2):
+      coio.stackless.tasklet(Worker)(value * 0.01, value)
+    self.assertEqual(42, pool(SleepAndReturn, 0.01, 42))
+    self.assertRaises(ValueError, pool, SleepAndRaise, 0.01, ValueError)
+    while len(results) < 3:
+      coio.sleep(0.005)
+    self.assertEqual([1, 2, 3], results)
+    # The main loop is woken up without sending a signal.
+    self.assertEqual([], self.got_signals)
+
+  def testCallAfterReinit(self):
+    pool = coio.thread_pool(1)
+    self.assertEqual(5, pool(SleepAndReturn, 0.01, 5))
+    coio.reinit()
+    self.assertEqual(6, pool(SleepAndReturn, 0.01, 6))
+    self.assertEqual([], self.got_signals)
+
+  def testSubmit(self):
+    pool = coio.thread_pool(2)
+    future = pool.submit(SleepAndReturn, 0.01, 5)
+    self.assertFalse(future.done())
+    self.assertEqual(5, future.result())
+    self.assertTrue(future.done())
+    self.assertFalse(future.cancelled())
+    self.assertEqual(5, future.result())
+    future = pool.submit(SleepAndRaise, 0.01, ValueError)
+    self.assertRaises(ValueError, future.result)
+    future = pool.submit(SleepAndReturn, 0.05, 6)
+    self.assertRaises(coio.FutureTimeoutError, future.result, 0.001)
+    self.assertTrue(future.running())
+    self.assertFalse(future.wait(0.001))
+    self.assertTrue(future.wait())
+    self.assertEqual(6, future.result(0))
+
+  def testCancel(self):
+    pool = coio.thread_pool(1)
+    future1 = pool.submit(SleepAndReturn, 0.02, 1)
+    future2 = pool.submit(SleepAndReturn, 0.02, 2)
+    future3 = pool.submit(SleepAndReturn, 0.02, 3)
+    self.assertTrue(future3.cancel())
+    coio.stackless.schedule()
+    self.assertTrue(future1.running())
+    self.assertFalse(future1.cancel())
+    self.assertTrue(future2.cancel())
+    self.assertTrue(future2.done())
+    self.assertRaises(coio.FutureCancelledError, future2.result)
+    self.assertEqual(1, future1.result())
+    self.assertEqual(4, pool(SleepAndReturn, 0.01, 4))
+
+  def testMap(self):
+    pool = coio.thread_pool(3)
+    self.assertEqual([], pool.map(abs, ()))
+    # The results of fast calls are not lost.
+    self.assertEqual(range(100, 0, -1), pool.map(abs, xrange(-100, 0)))
+    self.assertEqual(
+        range(10),
+        pool.map(lambda i: SleepAndReturn((10 - i) * 0.001, i), xrange(10),
+                 max_in_flight=4))
+
+  def testImapUnordered(self):
+    pool = coio.thread_pool(3)
+    self.assertEqual([], list(pool.imap_unordered(abs, ())))
+    self.assertEqual(
+        [2, 3, 1, 0],
+        list(pool.imap_unordered(
+            lambda i: SleepAndReturn((0.07, 0.04, 0.02, 0.01)[i], i),
+            xrange(4))))
+
+  def testBatchedCompletions(self):
+    pool = coio.thread_pool(4)
+    futures = [pool.submit(SleepAndReturn, 0.01, i) for i in xrange(4)]
+    coio.stackless.schedule()  # Start the calls.
+    self.assertEqual(4, pool.stats()['active_count'])
+    coio.loop_stats(reset=True)
+    time.sleep(0.05)  # Blocks the whole process, the calls finish.
+    self.assertEqual(range(4), [future.result() for future in futures])
+    stats = coio.loop_stats()
+    self.assertEqual(4, stats['completion_count'])
+    self.assertEqual(1, stats['completion_batch_count'])
+
+  def testSendFromThread(self):
+    import thread
+    channel = coio.stackless.channel()
+    thread.start_new_thread(coio.send_from_thread, (channel, 42))
+    self.assertEqual(42, channel.receive())
+    # The value is dropped if no tasklet is receiving it.
+    thread.start_new_thread(coio.send_from_thread, (channel, 43))
+    time.sleep(0.02)  # Blocks the whole process.
+    coio.sleep(0.01)
+    thread.start_new_thread(coio.send_from_thread, (channel, 44))
+    self.assertEqual(44, channel.receive())
+
+  def testInterruptedCall(self):
+    pool = coio.thread_pool(2)
+    results = []
+    def Worker():
+      with util.Timeout(0.01):
+        results.append(pool(SleepAndReturn, 0.05, 'first'))
+      results.append('timeout')
+    coio.stackless.tasklet(Worker)()
+    killed_tasklet = coio.stackless.tasklet(pool)(SleepAndReturn, 0.05, 'x')
+    coio.sleep(0.02)
+    killed_tasklet.kill()
+    self.assertEqual(['timeout'], results)
+    # The worker threads are not available until the interrupted calls
+    # finish, and their results are not returned by the next calls.
+    self.assertEqual(2, pool.stats()['active_count'])
+    self.assertEqual(['second', 'third'], pool.map(
+        lambda value: SleepAndReturn(0, value), ('second', 'third')))
+    self.assertRaises(ValueError, pool, SleepAndRaise, 0, ValueError())
+    self.assertEqual('fourth', pool.submit(SleepAndReturn, 0, 'fourth').result())
+    self.assertEqual(0, pool.stats()['active_count'])
+    self.assertEqual(2, pool.stats()['thread_count'])
+
+  def testStats(self):
+    pool = coio.thread_pool(1)
+    self.assertEqual(1, pool(SleepAndReturn, 0.01, 1))
+    stats = pool.stats(reset=True)
+    self.assertEqual((1, 0, 1, 0), (
+        stats['thread_count'], stats['active_count'], stats['idle_count'],
+        stats['queue_length']))
+    self.assertEqual((1, 1), (stats['wait_count'], stats['run_count']))
+    self.assertTrue(stats['run_usec_max'] >= 5000)
+    self.assertEqual(1, sum(stats['run_usec_histogram']))
+    self.assertEqual(0, pool.stats()['run_count'])
+    tasklets = [coio.stackless.tasklet(pool)(SleepAndReturn, 0.01, i)
+                for i in xrange(3)]
+    coio.stackless.schedule()
+    stats = pool.stats()
+    self.assertEqual((1, 0, 2), (
+        stats['active_count'], stats['idle_count'], stats['queue_length']))
+    while [t for t in tasklets if t.alive]:
+      coio.sleep(0.005)
+    stats = pool.stats()
+    self.assertEqual((0, 1, 0), (
+        stats['active_count'], stats['idle_count'], stats['queue_length']))
+    self.assertEqual(3, stats['wait_count'])
+    self.assertTrue(stats['wait_usec_max'] >= 10000)
+
+  def testIdleTimeout(self):
+    pool = coio.thread_pool(3, min_thread_count=1, idle_timeout=0.02)
+    self.assertEqual(1, pool.stats()['thread_count'])
+    self.assertEqual([0, 1, 2], pool.map(
+        lambda i: SleepAndReturn(0.01, i), xrange(3)))
+    stats = pool.stats()
+    self.assertEqual((3, 3, 0), (
+        stats['thread_count'], stats['started_count'],
+        stats['reaped_count']))
+    coio.sleep(0.05)
+    stats = pool.stats()
+    self.assertEqual((1, 2), (stats['thread_count'], stats['reaped_count']))
+    self.assertEqual([3, 4], pool.map(
+        lambda i: SleepAndReturn(0.01, i), xrange(3, 5)))
+    self.assertEqual(4, pool.stats()['started_count'])
+    self.assertRaises(ValueError, coio.thread_pool, 2, None, 3)
+
+  def testStackSize(self):
+    import thread
+    stack_sizes = []
+    class FakeThread(object):
+      allocate_lock = staticmethod(thread.allocate_lock)
+      start_new_thread = staticmethod(thread.start_new_thread)
+      @staticmethod
+      def stack_size(size):
+        stack_sizes.append(size)
+        return thread.stack_size(size)
+    pool = coio.thread_pool(1, thread=FakeThread, stack_size=256 << 10)
+    self.assertEqual(7, pool(SleepAndReturn, 0, 7))
+    self.assertEqual([256 << 10, 0], stack_sizes)
+
+
+if __name__ == '__main__':
+  unittest.main()
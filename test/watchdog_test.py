@@ -0,0 +1,55 @@
+#! /usr/local/bin/stackless2.6
+
+import time
+import unittest
+
+from syncless import coio
+
+
+LOOPRET = int(bool(coio.has_feature_may_loop_return_1()))
+
+
+def BlockingFunction(sleep_sec):
+  time.sleep(sleep_sec)  # Blocks the whole process.
+
+
+class WatchdogTest(unittest.TestCase):
+  def setUp(self):
+    self.reports = []
+
+  def tearDown(self):
+    coio.stop_watchdog()
+
+  def Callback(self, kind, lag, stack):
+    self.reports.append((kind, lag, stack))
+
+  def testStallAndLag(self):
+    coio.start_watchdog(0.05, callback=self.Callback)
+    coio.sleep(0.01)
+    self.assertEqual([], self.reports)
+    BlockingFunction(0.2)
+    coio.sleep(0.01)
+    kinds = [report[0] for report in self.reports]
+    self.assertEqual(['stall', 'lag'], kinds)
+    kind, lag, stack = self.reports[0]
+    self.assertTrue(0.05 <= lag < 0.2)
+    self.assertTrue('BlockingFunction' in stack[-1])
+    kind, lag, stack = self.reports[1]
+    self.assertTrue(lag >= 0.05)
+    self.assertEqual(None, stack)
+
+  def testStop(self):
+    coio.start_watchdog(0.05, callback=self.Callback)
+    coio.stop_watchdog()
+    BlockingFunction(0.1)
+    coio.sleep(0.01)
+    self.assertEqual([], self.reports)
+
+  def testDoesNotKeepProcessAlive(self):
+    coio.start_watchdog(60, callback=self.Callback)
+    self.assertEqual(LOOPRET, coio.nonblocking_loop_for_tests())
+    self.assertRaises(ValueError, coio.start_watchdog, 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,282 @@
+#! /usr/local/bin/stackless2.6
+
+"""Tests comparing coio.wsgi_fast_request with the pure Python WsgiWorker."""
+
+import logging
+import os
+import socket
+import sys
+import tempfile
+import unittest
+from syncless import coio
+from syncless import wsgi
+
+
+def GeneratorApplication(env, start_response):
+  if env['PATH_INFO'] == '/length':
+    start_response('200 OK', [('Content-Length', '6'),
+                              ('X-Foo-bar', ' baz ')])
+  else:
+    start_response('200 OK', [('content-type', 'text/plain')])
+  yield ''
+  yield 'Hel'
+  yield 'lo'
+  yield '!'
+
+
+def WriteApplication(env, start_response):
+  write = start_response('201 Created', [('Content-Type', 'text/plain')])
+  write(env['REQUEST_METHOD'])
+  return [':', env['QUERY_STRING']]
+
+
+def EnvApplication(env, start_response):
+  start_response('200 OK', [('Content-Type', 'text/plain')])
+  return ['%s=%r\n' % item for item in sorted(env.iteritems())
+          if item[0] != 'wsgi.input' and item[0] != 'wsgi.errors']
+
+
+def HeaderApplication(env, start_response):
+  start_response('200 OK', [('Content-Type', 'text/html'),
+                            ('Content-Transfer-Encoding', 'binary'),
+                            ('X-Method', env['REQUEST_METHOD']),
+                            ('x-cached', 'Yes ')])
+  return ['Hello']
+
+
+def ChunkedApplication(env, start_response):
+  write = start_response('200 OK', [('Content-Type', 'text/plain')])
+  if env['PATH_INFO'] == '/write':
+    write('Wr')
+  yield 'Hel'
+  for i in xrange(10):
+    yield 'lo%d' % i
+  yield ''
+  yield ', '
+  yield 'World' * 5
+  if env['PATH_INFO'] == '/write':
+    write('ite')
+  yield '!'
+
+
+def TransferEncodingApplication(env, start_response):
+  start_response('200 OK', [('Content-Type', 'text/plain'),
+                            ('Transfer-Encoding', 'chunked')])
+  yield 'Hello'
+  yield '!'
+
+
+def FileApplication(env, start_response):
+  headers = [('Content-Type', 'text/plain')]
+  if env['PATH_INFO'] == '/length':
+    headers.append(('Content-Length', '10'))
+  elif env['PATH_INFO'] == '/badlength':
+    headers.append(('Content-Length', '9'))
+  write = start_response('200 OK', headers)
+  if env['QUERY_STRING'] == 'pipe':
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, 'Hello, World!')
+    os.close(write_fd)
+    f = os.fdopen(read_fd)
+  else:
+    f = tempfile.TemporaryFile()
+    f.write('Hello, World!')
+    f.seek(0)
+  f.read(3)
+  if env['QUERY_STRING'] == 'write':
+    write('Wr')
+  return env['wsgi.file_wrapper'](f, 4)
+
+
+def BadApplication(env, start_response):
+  if env['PATH_INFO'] == '/status':
+    start_response('2000 OK', [])
+  elif env['PATH_INFO'] == '/header':
+    start_response('200 OK', [('X-Bad', 'a\nb')])
+  elif env['PATH_INFO'] == '/nostart':
+    return ['Hello']
+  raise KeyError(env['PATH_INFO'])
+
+
+TEST_DATE = wsgi.GetHttpDate(1234567890)  # 2009-02-13
+
+
+def Serve(application, request, use_fast_path):
+  """Serve request by application, and return the response string."""
+  old_use_fast_path = wsgi.USE_WSGI_FAST_REQUEST
+  wsgi.USE_WSGI_FAST_REQUEST = use_fast_path
+  try:
+    a, b = coio.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    b.sendall(request)
+    b.shutdown(1)
+    env = {}
+    wsgi.PopulateDefaultWsgiEnv(env, ('127.0.0.1', 80))
+    wsgi.WsgiWorker(a, ('127.0.0.1', 2), application, env, TEST_DATE,
+                    True, None)
+    return b.makefile_samefd().read()
+  finally:
+    wsgi.USE_WSGI_FAST_REQUEST = old_use_fast_path
+
+
+class WsgiFastTest(unittest.TestCase):
+
+  def setUp(self):
+    logging.root.setLevel(logging.CRITICAL)  # Don't print the app errors.
+
+  def tearDown(self):
+    logging.root.setLevel(logging.WARNING)
+
+  def AssertSameResponse(self, application, request):
+    response = Serve(application, request, False)
+    self.assertTrue(response.startswith('HTTP/1.'), repr(response))
+    self.assertEqual(response, Serve(application, request, True))
+
+  def testGenerator(self):
+    self.AssertSameResponse(GeneratorApplication, 'GET / HTTP/1.1\r\n\r\n')
+    self.AssertSameResponse(GeneratorApplication,
+                            'GET /length HTTP/1.1\r\n\r\n')
+    self.AssertSameResponse(GeneratorApplication,
+                            'HEAD /length HTTP/1.1\r\n\r\n')
+
+  def testWrite(self):
+    self.AssertSameResponse(WriteApplication, 'GET /?a=b HTTP/1.0\r\n\r\n')
+    self.AssertSameResponse(WriteApplication, 'HEAD /?a=b HTTP/1.0\r\n\r\n')
+    self.AssertSameResponse(
+        WriteApplication,
+        'POST /? HTTP/1.0\r\nContent-Length: 3\r\n\r\nfoo')
+
+  def testEnv(self):
+    self.AssertSameResponse(
+        EnvApplication,
+        'GET /foo/bar?x=y&z HTTP/1.1\r\nHost: example.com\r\n'
+        'Accept: text/html\r\nAccept: text/plain\r\nX-Foo: 1\r\n'
+        'X-Foo: 2\r\nProxy-Connection: foo\r\nContent-Type: text/foo\r\n'
+        'Connection: close\r\n\r\n')
+    self.AssertSameResponse(
+        EnvApplication,
+        'GET / HTTP/1.0\r\nContent-Length: 0\r\nKeep-Alive: 300\r\n'
+        'Connection: Keep-Alive\r\n\r\n'
+        'HEAD / HTTP/1.0\r\n\r\n')
+
+  def testHeaderCache(self):
+    wsgi.RESPONSE_HEADER_LINE_CACHE.clear()
+    for request in ('GET / HTTP/1.0\r\n\r\n', 'HEAD / HTTP/1.0\r\n\r\n',
+                    'GET / HTTP/1.0\r\n\r\n'):
+      self.AssertSameResponse(HeaderApplication, request)
+    self.assertEqual('X-Cached: Yes\r\n', wsgi.RESPONSE_HEADER_LINE_CACHE[
+        ('x-cached', 'Yes ')])
+    self.assertFalse(('Content-Transfer-Encoding', 'binary') in
+                     wsgi.RESPONSE_HEADER_LINE_CACHE)
+
+  def testChunked(self):
+    old_batch_size = wsgi.CHUNKED_RESPONSE_BATCH_SIZE
+    wsgi.CHUNKED_RESPONSE_BATCH_SIZE = 8
+    try:
+      for suburl in ('/', '/write'):
+        request = 'GET %s HTTP/1.1\r\n\r\n' % suburl
+        self.AssertSameResponse(ChunkedApplication, request + request)
+        response = Serve(ChunkedApplication, request, True)
+        self.assertTrue('\r\nTransfer-Encoding: chunked\r\n' in response)
+        self.assertTrue('\r\nConnection: Keep-Alive\r\n' in response)
+        self.assertTrue(response.endswith('\r\n0\r\n\r\n'), repr(response))
+      self.AssertSameResponse(
+          WriteApplication, 'GET /?a HTTP/1.1\r\n\r\nGET /?b HTTP/1.1\r\n\r\n')
+      for request in ('GET / HTTP/1.1\r\nConnection: close\r\n\r\n',
+                      'GET / HTTP/1.0\r\n\r\n'):
+        self.AssertSameResponse(ChunkedApplication, request)
+        self.assertFalse('chunked' in Serve(ChunkedApplication, request, True))
+    finally:
+      wsgi.CHUNKED_RESPONSE_BATCH_SIZE = old_batch_size
+
+  def testTransferEncodingFromApplication(self):
+    wsgi.RESPONSE_HEADER_LINE_CACHE.clear()
+    # The fast path runs first, so the Python path would see its cached
+    # header lines.
+    for use_fast_path in (True, False):
+      response = Serve(TransferEncodingApplication, 'GET / HTTP/1.1\r\n\r\n',
+                       use_fast_path)
+      self.assertEqual(1, response.lower().count('transfer-encoding'))
+      self.assertTrue(response.endswith('\r\n!\r\n0\r\n\r\n'),
+                      repr(response))
+      response = Serve(TransferEncodingApplication, 'GET / HTTP/1.0\r\n\r\n',
+                       use_fast_path)
+      self.assertFalse('transfer-encoding' in response.lower())
+      self.assertTrue(response.endswith('\r\n\r\nHello!'), repr(response))
+    self.assertFalse(('Transfer-Encoding', 'chunked') in
+                     wsgi.RESPONSE_HEADER_LINE_CACHE)
+
+  def testPipelining(self):
+    self.AssertSameResponse(
+        WriteApplication,
+        'GET /?1 HTTP/1.1\r\n\r\nHEAD /?2 HTTP/1.1\r\n\r\n'
+        'POST /?3 HTTP/1.1\r\nContent-Length: 3\r\n\r\nfoo'
+        'PUT /?4 HTTP/1.1\r\nContent-Length: 0\r\n\r\n'
+        'GET /?5 HTTP/1.1\r\n\r\nGET /?6 HTTP/1.0\r\n\r\n'
+        'GET /?7 HTTP/1.1\r\n\r\n')
+    self.AssertSameResponse(
+        GeneratorApplication,
+        'GET /length HTTP/1.1\r\n\r\nGET / HTTP/1.1\r\n\r\n'
+        'GET /length HTTP/1.1\r\n\r\nGET /length HTTP/1.1\r\n')
+    self.AssertSameResponse(
+        BadApplication,
+        'GET /nostart HTTP/1.1\r\n\r\nGET /raise HTTP/1.1\r\n\r\n'
+        'GET /status HTTP/1.1\r\n\r\nGET / HTTP/1.1\r\nX: \x01\r\n\r\n')
+
+  def testPipeliningBatchesWrites(self):
+    a, b = coio.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    b.sendall('GET /1 HTTP/1.1\r\n\r\nGET /2 HTTP/1.1\r\n\r\n'
+              'GET /3 HTTP/1.0\r\n\r\n')
+    b.shutdown(1)
+    b.setblocking(False)
+    pending_ary = []
+
+    def PendingApplication(env, start_response):
+      # Check that the response to the previous request hasn't been sent.
+      try:
+        pending_ary.append(len(b.recv(8192, socket.MSG_DONTWAIT)))
+      except IOError:
+        pending_ary.append(0)
+      start_response('200 OK', [('Content-Type', 'text/plain')])
+      return [env['PATH_INFO']]
+
+    env = {}
+    wsgi.PopulateDefaultWsgiEnv(env, ('127.0.0.1', 80))
+    wsgi.WsgiWorker(a, ('127.0.0.1', 2), PendingApplication, env, TEST_DATE,
+                    True, None)
+    self.assertEqual([0, 0, 0], pending_ary)
+
+  def testFileWrapper(self):
+    for suburl in ('/', '/length', '/badlength', '/?pipe', '/?write',
+                   '/length?write', '/badlength?write'):
+      for http_version in ('1.0', '1.1'):
+        request = 'GET %s HTTP/%s\r\n\r\n' % (suburl, http_version)
+        self.AssertSameResponse(FileApplication, request + request)
+    self.AssertSameResponse(FileApplication, 'HEAD / HTTP/1.1\r\n\r\n')
+    response = Serve(FileApplication, 'GET / HTTP/1.1\r\n\r\n', True)
+    self.assertTrue('\r\nContent-Length: 10\r\n' in response)
+    self.assertTrue(response.endswith('\r\n\r\nlo, World!'), repr(response))
+
+  def testErrors(self):
+    self.AssertSameResponse(BadApplication, 'GET /status HTTP/1.0\r\n\r\n')
+    self.AssertSameResponse(BadApplication, 'GET /header HTTP/1.0\r\n\r\n')
+    self.AssertSameResponse(BadApplication, 'GET /nostart HTTP/1.0\r\n\r\n')
+    self.AssertSameResponse(BadApplication, 'GET /raise HTTP/1.0\r\n\r\n')
+
+  def testFallback(self):
+    # These requests are served by the pure Python code in WsgiWorker.
+    self.AssertSameResponse(EnvApplication, 'PUT / HTTP/1.0\r\n\r\n')
+    self.AssertSameResponse(EnvApplication, 'GET /% HTTP/1.2\r\n\r\n')
+    self.AssertSameResponse(EnvApplication, 'GET /<> HTTP/1.0\r\n\r\n')
+    self.AssertSameResponse(
+        EnvApplication, 'GET / HTTP/1.0\r\nContent-Length: 5\r\n\r\n')
+    self.AssertSameResponse(
+        EnvApplication, 'POST / HTTP/1.0\r\nContent-Length: x\r\n\r\n')
+    self.AssertSameResponse(
+        EnvApplication, 'POST / HTTP/1.0\r\nExpect: 100-continue\r\n\r\n')
+
+
+if __name__ == '__main__':
+  if '-v' in sys.argv[1:]:
+    logging.BASIC_FORMAT = '[%(created)f] %(levelname)s %(message)s'
+    logging.root.setLevel(logging.DEBUG)
+  unittest.main()
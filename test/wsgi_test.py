@@ -3,8 +3,11 @@
 
 import errno
 import logging
+import os
+import signal
 import socket
 import sys
+import time
 import unittest
 from syncless import coio
 from syncless import wsgi
@@ -20,6 +23,14 @@ def TestApplication(env, start_response):
   if env['PATH_INFO'] == '/save':
     start_response('200 OK', [('Content-Type', 'text/plain')])
     return [env['wsgi.input'].readline().upper()]
+  if env['PATH_INFO'] == '/stream':
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return (c for c in 'Streamed.')
+  if env['PATH_INFO'] == '/pid':
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(os.getpid())]
+  if env['PATH_INFO'] == '/exit':
+    os._exit(3)
   if env['PATH_INFO'] == 'policy-file':
     start_response('200 OK', [('Content-Type', 'text/plain')])
     return 'I hope you like our policy.'
@@ -70,6 +81,9 @@ class WsgiTest(unittest.TestCase):
 
   def testDate(self):
     self.assertEqual('Fri, 13 Feb 2009 23:31:30 GMT', TEST_DATE)
+    date = wsgi.GetCurrentHttpDate()
+    self.assertTrue(date.endswith(' GMT'), date)
+    self.assertEqual(len(TEST_DATE), len(date))
 
   def AssertHelloResponse(self, head, body, http_version='1.0'):
     self.assertEqual('Hello, World!', body)
@@ -228,6 +242,201 @@ class WsgiTest(unittest.TestCase):
     self.AssertAnswerResponse(head, body, http_version='1.0',
                               is_new_date=True)
 
+  def testChunkedHTTP11Response(self):
+    a, b = coio.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    b.sendall('GET /stream HTTP/1.1\r\n\r\n'
+              'GET /answer HTTP/1.1\r\n\r\n')
+    b.shutdown(1)
+    CallWsgiWorker(a)
+    responses = SplitHttpResponses(b.makefile_samefd().read())
+    self.assertEqual(2, len(responses))
+    head, body = ParseHttpResponse(responses[0])
+    self.assertEqual('Keep-Alive', head['Connection'])
+    self.assertEqual('chunked', head['Transfer-Encoding'])
+    self.assertFalse('Content-Length' in head)
+    chunks = []
+    while True:
+      size, body = body.split('\r\n', 1)
+      size = int(size, 16)
+      if not size:
+        break
+      chunks.append(body[:size])
+      self.assertEqual('\r\n', body[size : size + 2])
+      body = body[size + 2:]
+    self.assertEqual('\r\n', body)
+    self.assertEqual('Streamed.', ''.join(chunks))
+    head, body = ParseHttpResponse(responses[1])
+    self.AssertAnswerResponse(head, body, http_version='1.1',
+                              is_new_date=True)
+
+  def testChunkedHTTP11Request(self):
+    a, b = coio.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    b.sendall('POST /save HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n'
+              '2\r\nfo\r\n5;ext=1\r\no\nbar\r\n0\r\nX-Trailer: 1\r\n\r\n'
+              'GET /answer HTTP/1.1\r\n\r\n'
+              'PUT /save HTTP/1.0\r\nTransfer-Encoding: chunked\r\n\r\n'
+              '0\r\n\r\n')
+    b.shutdown(1)
+    CallWsgiWorker(a)
+    responses = SplitHttpResponses(b.makefile_samefd().read())
+    self.assertEqual(3, len(responses))
+    head, body = ParseHttpResponse(responses[0])
+    self.assertEqual('Keep-Alive', head['Connection'])
+    self.AssertSaveResponse(head, body, http_version='1.1')
+    head, body = ParseHttpResponse(responses[1])
+    self.AssertAnswerResponse(head, body, http_version='1.1',
+                              is_new_date=True)
+    self.assertTrue(responses[2].startswith('HTTP/1.0 400 Bad Request\r\n'),
+                    repr(responses[2]))
+
+  def testKeepAliveTimeout(self):
+    limiter = wsgi.WsgiConnectionLimiter(keep_alive_timeout=0.01)
+    a, b = coio.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    limiter.add(a)
+    b.sendall('GET / HTTP/1.1\r\n\r\n')
+    env = {}
+    wsgi.PopulateDefaultWsgiEnv(env, ('127.0.0.1', 80))
+    # Returns when the keep-alive connection times out.
+    wsgi.WsgiWorker(a, ('127.0.0.1', 2), TestApplication, env, TEST_DATE,
+                    True, None, limiter)
+    head, body = ParseHttpResponse(b.makefile_samefd().read())
+    self.assertEqual('Keep-Alive', head['Connection'])
+    self.AssertHelloResponse(head, body, http_version='1.1')
+    self.assertEqual((0, 1, 0),
+                     (limiter.evicted_count, limiter.timed_out_count,
+                      limiter.connection_count))
+
+  def testConnectionLimiterEviction(self):
+    limiter = wsgi.WsgiConnectionLimiter(max_connections=2)
+    env = {}
+    wsgi.PopulateDefaultWsgiEnv(env, ('127.0.0.1', 80))
+    peers = []
+    for i in xrange(2):
+      a, b = coio.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+      limiter.add(a)
+      peers.append(b)
+      b.sendall('GET / HTTP/1.1\r\n\r\n')
+      coio.stackless.tasklet(wsgi.WsgiWorker)(
+          a, ('127.0.0.1', 2), TestApplication, env, TEST_DATE, True, None,
+          limiter)
+      coio.stackless.schedule()
+    self.assertEqual(2, limiter.connection_count)
+    # Both connections are idle now, the oldest one gets evicted.
+    limiter.wait_for_slot()
+    self.assertEqual((1, 0, 1),
+                     (limiter.evicted_count, limiter.timed_out_count,
+                      limiter.connection_count))
+    head, body = ParseHttpResponse(peers[0].makefile_samefd().read())
+    self.AssertHelloResponse(head, body, http_version='1.1')
+    peers[1].shutdown(1)
+    while limiter.connection_count:
+      coio.stackless.schedule()
+    self.assertEqual(1, limiter.evicted_count)
+
+  def testSilentConnectionAtLimit(self):
+    limiter = wsgi.WsgiConnectionLimiter(max_connections=1)
+    env = {}
+    wsgi.PopulateDefaultWsgiEnv(env, ('127.0.0.1', 80))
+    a, b = coio.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    limiter.add(a)
+    worker_tasklet = coio.stackless.tasklet(wsgi.WsgiWorker)(
+        a, ('127.0.0.1', 2), TestApplication, env, TEST_DATE, True, None,
+        limiter)
+    coio.stackless.schedule()
+    # The connection hasn't sent its first request, it gets evicted.
+    limiter.wait_for_slot()
+    self.assertEqual((1, 0, 0),
+                     (limiter.evicted_count, limiter.timed_out_count,
+                      limiter.connection_count))
+    while worker_tasklet.alive:
+      coio.stackless.schedule()
+    self.assertEqual('', b.makefile_samefd().read())
+
+    # A silent connection also times out.
+    limiter = wsgi.WsgiConnectionLimiter(max_connections=1,
+                                         keep_alive_timeout=0.01)
+    a, b = coio.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    limiter.add(a)
+    wsgi.WsgiWorker(a, ('127.0.0.1', 2), TestApplication, env, TEST_DATE,
+                    True, None, limiter)
+    self.assertEqual((0, 1, 0),
+                     (limiter.evicted_count, limiter.timed_out_count,
+                      limiter.connection_count))
+
+  def testWsgiListenerMaxWorkers(self):
+    server_socket = coio.nbsocket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.bind(('127.0.0.1', 0))
+    server_socket.listen(10)
+    server_address = server_socket.getsockname()
+    listener_tasklet = coio.stackless.tasklet(wsgi.WsgiListener)(
+        server_socket, TestApplication, max_workers=2)
+    client_sockets = []
+    try:
+      for i in xrange(3):
+        client_socket = coio.nbsocket(socket.AF_INET, socket.SOCK_STREAM)
+        client_socket.connect(server_address)
+        client_socket.sendall('GET / HTTP/1.1\r\n\r\n')
+        client_sockets.append(client_socket)
+      for client_socket in client_sockets[:2]:
+        head, body = ParseHttpResponse(client_socket.recv(8192))
+        self.assertEqual(('HTTP/1.1 200 OK', 'Hello, World!'),
+                         (head['Status'], body))
+      # The first two keep-alive connections occupy all workers, so the
+      # third connection is not accepted yet.
+      client_sockets[2].settimeout(0.05)
+      self.assertRaises(socket.timeout, client_sockets[2].recv, 8192)
+      client_sockets[0].close()
+      client_sockets[2].settimeout(None)
+      head, body = ParseHttpResponse(client_sockets[2].recv(8192))
+      self.assertEqual(('HTTP/1.1 200 OK', 'Hello, World!'),
+                       (head['Status'], body))
+    finally:
+      for client_socket in client_sockets:
+        client_socket.close()
+      listener_tasklet.kill()
+
+  def testPreforkWsgiListener(self):
+    probe_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    probe_socket.bind(('127.0.0.1', 0))
+    server_address = probe_socket.getsockname()
+    probe_socket.close()
+    pid = os.fork()
+    if not pid:  # Child: the prefork supervisor.
+      try:
+        logging.root.setLevel(logging.CRITICAL)
+        wsgi.PreforkWsgiListener(server_address, TestApplication,
+                                 process_count=2, do_pin_cpus=True)
+      finally:
+        os._exit(0)
+
+    def Get(suburl):
+      # Retry until the workers are listening. Connections queued to a
+      # worker which has just exited get reset, so retry on that as well.
+      for i in xrange(100):
+        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+          try:
+            client_socket.connect(server_address)
+            client_socket.sendall('GET %s HTTP/1.0\r\n\r\n' % suburl)
+            return client_socket.makefile().read()
+          except socket.error:
+            time.sleep(0.02)
+        finally:
+          client_socket.close()
+      self.fail('prefork server not responding')
+
+    try:
+      head, body = ParseHttpResponse(Get('/pid'))
+      self.assertNotEqual(str(pid), body)
+      self.assertNotEqual(str(os.getpid()), body)
+      self.assertEqual('', Get('/exit'))  # Kills a worker.
+      for i in xrange(4):  # Some workers are restarted by now.
+        head, body = ParseHttpResponse(Get('/pid'))
+        self.assertEqual('HTTP/1.0 200 OK', head['Status'])
+    finally:
+      os.kill(pid, signal.SIGTERM)
+      self.assertEqual((pid, 0), os.waitpid(pid, 0))
+
   def testFourPipelinedHTTP11PostFirstRequests(self):
     a, b = coio.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
     b.sendall('POST /save HTTP/1.1\r\nContent-Length: 7\r\n\r\nfoo\nbar'